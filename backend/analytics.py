@@ -0,0 +1,178 @@
+"""Portfolio analytics over a members x companies balance matrix.
+
+The matrix is built once per data version (see ``cached`` in server.py) and
+every figure below is a vectorized reduction over it, so repeated dashboard
+views do not walk the member documents again.
+"""
+import bisect
+from typing import Any, Dict, List
+
+import numpy as np
+
+
+class BalanceMatrix:
+    """Balances, held flags and elite tiers of every program, members x companies.
+
+    Numeric custom fields declared in a company's ``field_schema`` get one
+    float column each (NaN where unset) in ``fields``.
+    """
+
+    def __init__(self, members: List[Dict[str, Any]], companies: List[Dict[str, Any]]):
+        self.member_ids = [member["id"] for member in members]
+        self.member_names = [member["name"] for member in members]
+        # Programs whose company document is gone still count
+        self.company_ids = [company["id"] for company in companies]
+        for member in members:
+            for company_id in member.get("programs") or {}:
+                if company_id not in self.company_ids:
+                    self.company_ids.append(company_id)
+        names = {company["id"]: company["name"] for company in companies}
+        self.company_names = [names.get(company_id, company_id) for company_id in self.company_ids]
+        self.column = {company_id: j for j, company_id in enumerate(self.company_ids)}
+
+        shape = (len(members), len(self.company_ids))
+        self.balances = np.zeros(shape, dtype=np.int64)
+        self.held = np.zeros(shape, dtype=bool)
+        self.tiers = np.full(shape, "", dtype=object)
+        number_fields = [(company["id"], name) for company in companies
+                         for name, spec in (company.get("field_schema") or {}).items()
+                         if spec.get("type") == "number"]
+        self.fields = {key: np.full(len(members), np.nan) for key in number_fields}
+
+        for i, member in enumerate(members):
+            for company_id, program in (member.get("programs") or {}).items():
+                j = self.column[company_id]
+                self.balances[i, j] = program.get("current_balance", 0) or 0
+                self.held[i, j] = True
+                self.tiers[i, j] = program.get("elite_tier") or ""
+                for name, value in (program.get("custom_fields") or {}).items():
+                    column = self.fields.get((company_id, name))
+                    if column is not None and isinstance(value, (int, float)) and not isinstance(value, bool):
+                        column[i] = value
+
+
+def competition_ranks(values: np.ndarray) -> np.ndarray:
+    """1 for the largest value; ties share the best rank (1, 2, 2, 4)."""
+    return np.searchsorted(np.sort(-values), -values, side="left") + 1
+
+
+def shares(values: np.ndarray) -> np.ndarray:
+    total = values.sum()
+    return values / total if total else np.zeros(len(values))
+
+
+def as_number(value: float):
+    return int(value) if float(value).is_integer() else float(value)
+
+
+def summarize(matrix: BalanceMatrix) -> Dict[str, Any]:
+    member_totals = matrix.balances.sum(axis=1)
+    company_totals = matrix.balances.sum(axis=0)
+    member_ranks, company_ranks = competition_ranks(member_totals), competition_ranks(company_totals)
+    member_shares, company_shares = shares(member_totals), shares(company_totals)
+    members_holding = (matrix.held & (matrix.balances > 0)).sum(axis=0)
+
+    # Tiers are per program, so group on (company, tier)
+    rows, cols = np.nonzero(matrix.held)
+    tier_names, tier_codes = np.unique(matrix.tiers[rows, cols].astype(str), return_inverse=True)
+    groups = cols * len(tier_names) + tier_codes
+    size = len(matrix.company_ids) * len(tier_names)
+    tier_totals = np.bincount(groups, weights=matrix.balances[rows, cols], minlength=size)
+    tier_counts = np.bincount(groups, minlength=size)
+
+    return {
+        "total_points": int(member_totals.sum()),
+        "members": sorted([
+            {
+                "member_id": matrix.member_ids[i],
+                "name": matrix.member_names[i],
+                "total": int(member_totals[i]),
+                "share": round(float(member_shares[i]), 4),
+                "rank": int(member_ranks[i]),
+                "programs": int(matrix.held[i].sum()),
+            }
+            for i in range(len(matrix.member_ids))
+        ], key=lambda row: row["rank"]),
+        "companies": sorted([
+            {
+                "company_id": matrix.company_ids[j],
+                "name": matrix.company_names[j],
+                "total": int(company_totals[j]),
+                "share": round(float(company_shares[j]), 4),
+                "rank": int(company_ranks[j]),
+                "members_with_balance": int(members_holding[j]),
+            }
+            for j in range(len(matrix.company_ids))
+        ], key=lambda row: row["rank"]),
+        "elite_tiers": [
+            {
+                "company_id": matrix.company_ids[group // len(tier_names)],
+                "elite_tier": str(tier_names[group % len(tier_names)]),
+                "total": int(tier_totals[group]),
+                "programs": int(tier_counts[group]),
+            }
+            for group in np.flatnonzero(tier_counts)
+        ],
+        "custom_fields": [
+            {
+                "company_id": company_id,
+                "field": name,
+                "total": as_number(np.nansum(values)),
+                "filled": int(np.count_nonzero(~np.isnan(values))),
+            }
+            for (company_id, name), values in matrix.fields.items()
+        ],
+    }
+
+
+def rate_on(rates: List[Dict[str, Any]], day: str):
+    """BRL per 1,000 points in effect on ``day`` (ISO date); None before the first rate."""
+    days = [rate["effective_from"] for rate in rates]
+    index = bisect.bisect_right(days, day)
+    return rates[index - 1]["brl_per_1000"] if index else None
+
+
+def rate_vector(matrix: BalanceMatrix, companies: List[Dict[str, Any]], day: str) -> np.ndarray:
+    """One rate per matrix column, NaN where the company has no rate yet."""
+    tables = {company["id"]: company.get("valuation_rates") or [] for company in companies}
+    rates = [rate_on(tables.get(company_id, []), day) for company_id in matrix.company_ids]
+    return np.array([np.nan if rate is None else rate for rate in rates], dtype=float)
+
+
+def valuate(matrix: BalanceMatrix, rates: np.ndarray) -> Dict[str, Any]:
+    priced = ~np.isnan(rates)
+    values = matrix.balances * np.where(priced, rates, 0.0) / 1000
+    member_values, company_values = values.sum(axis=1), values.sum(axis=0)
+    unpriced_points = matrix.balances[:, ~priced].sum(axis=0)
+    rows, cols = np.nonzero(matrix.held & (matrix.balances > 0))
+    return {
+        "total_brl": round(float(values.sum()), 2),
+        "members": [
+            {
+                "member_id": matrix.member_ids[i],
+                "name": matrix.member_names[i],
+                "value_brl": round(float(member_values[i]), 2),
+            }
+            for i in np.argsort(-member_values, kind="stable")
+        ],
+        "companies": [
+            {
+                "company_id": matrix.company_ids[j],
+                "name": matrix.company_names[j],
+                "brl_per_1000": float(rates[j]) if priced[j] else None,
+                "points": int(matrix.balances[:, j].sum()),
+                "value_brl": round(float(company_values[j]), 2),
+            }
+            for j in np.argsort(-company_values, kind="stable")
+        ],
+        "programs": [
+            {
+                "member_id": matrix.member_ids[i],
+                "company_id": matrix.company_ids[j],
+                "points": int(matrix.balances[i, j]),
+                "value_brl": round(float(values[i, j]), 2),
+            }
+            for i, j in zip(rows, cols)
+        ],
+        "unpriced_points": int(unpriced_points.sum()),
+    }
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""
+Seed the balance history from the current_balance changes already in the global log.
+
+    python backend/backfill_balance_history.py
+
+Uses the engine configured by STORAGE_ENGINE. Programs that already have
+history are skipped, so it is safe to run again.
+"""
+import sys
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from storage import create_storage
+from timeseries import balance_points
+
+ALL_LOGS = 10 ** 9
+
+
+def backfill(storage) -> int:
+    points = balance_points(reversed(storage.recent_logs(ALL_LOGS)))
+    programs = {(point["member_id"], point["company_id"]) for point in points}
+    seeded = {key for key in programs if storage.balance_history(*key)}
+    points = [point for point in points if (point["member_id"], point["company_id"]) not in seeded]
+    storage.insert_balance_points(points)
+    return len(points)
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    storage = create_storage()
+    storage.ensure_indexes()
+    try:
+        print(f"{backfill(storage)} balance samples written")
+    finally:
+        storage.close()
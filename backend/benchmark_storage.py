@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Per-operation cost of a storage engine, measured directly (no HTTP).
+
+Usage: python backend/benchmark_storage.py [engine] [iterations]
+"""
+import sys
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from storage import create_storage
+
+
+def timed(label, iterations, fn):
+    start = time.perf_counter()
+    for i in range(iterations):
+        fn(i)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<22} {elapsed / iterations * 1e6:10.1f} µs/op")
+
+
+def main():
+    engine = sys.argv[1] if len(sys.argv) > 1 else "memory"
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    storage = create_storage(engine)
+    print(f"engine={storage.name} iterations={iterations}")
+
+    now = datetime.utcnow()
+    member_id = str(uuid.uuid4())
+    storage.insert_member({
+        "id": member_id,
+        "name": f"bench-{member_id[:8]}",
+        "programs": {
+            cid: {"company_id": cid, "current_balance": 0, "custom_fields": {}}
+            for cid in ("latam", "smiles", "azul")
+        },
+        "created_at": now,
+        "updated_at": now,
+    })
+
+    timed("get_member", iterations, lambda i: storage.get_member(member_id))
+    timed("update balance", iterations, lambda i: storage.update_member(
+        member_id, {"programs.latam.current_balance": i, "updated_at": datetime.utcnow()}))
+    timed("insert_log", iterations, lambda i: storage.insert_log({
+        "id": str(uuid.uuid4()), "member_id": member_id, "member_name": "bench",
+        "company_id": "latam", "company_name": "LATAM Pass",
+        "field_changed": "current_balance", "old_value": str(i), "new_value": str(i + 1),
+        "timestamp": datetime.utcnow(), "change_type": "update",
+    }))
+    timed("recent_logs(50)", iterations, lambda i: storage.recent_logs(50))
+    timed("total_points", iterations, lambda i: storage.total_points())
+
+    storage.delete_member(member_id)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Move member programs between the embedded and normalized MongoDB layouts.
+
+    python backend/migrate_programs.py normalize   # members.programs -> programs collection
+    python backend/migrate_programs.py embed       # programs collection -> members.programs
+
+Run it with the API stopped, then set MONGO_PROGRAM_LAYOUT to match.
+Both directions are idempotent and work in batches of --batch members.
+"""
+import argparse
+import sys
+from pathlib import Path
+
+from pymongo import DeleteMany, ReplaceOne, UpdateOne
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from storage.mongo import MongoStorage
+
+
+def normalize(storage: MongoStorage, batch: int) -> int:
+    storage.ensure_indexes()
+    moved = 0
+    cursor = storage.members.find({"programs": {"$exists": True}}, {"_id": 0, "id": 1, "programs": 1})
+    members = list(cursor)
+    for start in range(0, len(members), batch):
+        chunk = members[start:start + batch]
+        program_ops = []
+        for member in chunk:
+            for company_id, program in (member.get("programs") or {}).items():
+                key = {"member_id": member["id"], "company_id": company_id}
+                program_ops.append(ReplaceOne(key, {**program, **key}, upsert=True))
+        if program_ops:
+            storage.programs.bulk_write(program_ops, ordered=False)
+        # Only drop the embedded copy once every program is safely written
+        storage.members.bulk_write([
+            UpdateOne({"id": member["id"]}, {"$unset": {"programs": ""}}) for member in chunk
+        ], ordered=False)
+        moved += len(program_ops)
+        print(f"normalized {start + len(chunk)}/{len(members)} members")
+    return moved
+
+
+def embed(storage: MongoStorage, batch: int) -> int:
+    member_ids = storage.programs.distinct("member_id")
+    moved = 0
+    for start in range(0, len(member_ids), batch):
+        chunk = member_ids[start:start + batch]
+        grouped = {member_id: {} for member_id in chunk}
+        for program in storage.programs.find({"member_id": {"$in": chunk}}, {"_id": 0}):
+            grouped[program.pop("member_id")][program["company_id"]] = program
+        storage.members.bulk_write([
+            UpdateOne({"id": member_id}, {"$set": {"programs": programs}})
+            for member_id, programs in grouped.items()
+        ], ordered=False)
+        storage.programs.bulk_write([DeleteMany({"member_id": {"$in": chunk}})])
+        moved += sum(len(programs) for programs in grouped.values())
+        print(f"embedded {start + len(chunk)}/{len(member_ids)} members")
+    # Members without any program still need an (empty) embedded map
+    storage.members.update_many({"programs": {"$exists": False}}, {"$set": {"programs": {}}})
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("direction", choices=["normalize", "embed"])
+    parser.add_argument("--batch", type=int, default=100, help="members per bulk write")
+    args = parser.parse_args()
+
+    storage = MongoStorage()
+    if args.direction == "normalize":
+        moved = normalize(storage, args.batch)
+    else:
+        moved = embed(storage, args.batch)
+    print(f"{moved} programs moved; set MONGO_PROGRAM_LAYOUT={'normalized' if args.direction == 'normalize' else 'embedded'}")
+
+
+if __name__ == "__main__":
+    main()
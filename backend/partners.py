@@ -0,0 +1,80 @@
+"""Transfer-partner graph: which program converts into which, at what yield.
+
+Edges live on the source company as ``transfer_partners`` entries
+(``to_company_id``, ``ratio``, ``bonus`` percent valid until ``bonus_until``,
+``block``). Paths are simple (no company twice) and at most ``MAX_HOPS``
+long; the whole path table depends only on the graph and the day, so it is
+computed once per graph version and reused for every holding.
+"""
+from typing import Any, Dict, List, Tuple
+
+MAX_HOPS = 4
+
+Edge = Tuple[str, str, float, int]  # (from, to, effective ratio, block)
+
+
+def effective_ratio(partner: Dict[str, Any], day: str) -> float:
+    """``ratio`` plus the bonus while it lasts (``bonus_until`` inclusive, ISO dates)."""
+    bonus = partner.get("bonus") or 0
+    until = partner.get("bonus_until")
+    if until and day > until:
+        bonus = 0
+    return partner["ratio"] * (1 + bonus / 100)
+
+
+def partner_edges(companies: List[Dict[str, Any]], day: str) -> List[Edge]:
+    return [
+        (company["id"], partner["to_company_id"], effective_ratio(partner, day), partner.get("block") or 1)
+        for company in companies
+        for partner in company.get("transfer_partners") or []
+    ]
+
+
+def simple_paths(edges: List[Edge], max_hops: int = MAX_HOPS) -> Dict[Tuple[str, str], List[List[Edge]]]:
+    """Every simple path up to ``max_hops`` edges, per (source, target), best ratio first."""
+    outgoing: Dict[str, List[Edge]] = {}
+    for edge in edges:
+        outgoing.setdefault(edge[0], []).append(edge)
+    paths: Dict[Tuple[str, str], List[List[Edge]]] = {}
+
+    def walk(start: str, path: List[Edge], seen: set):
+        for edge in outgoing.get(path[-1][1] if path else start, []):
+            if edge[1] in seen:
+                continue
+            extended = path + [edge]
+            paths.setdefault((start, edge[1]), []).append(extended)
+            if len(extended) < max_hops:
+                walk(start, extended, seen | {edge[1]})
+
+    for start in outgoing:
+        walk(start, [], {start})
+    for options in paths.values():
+        options.sort(key=lambda path: -path_ratio(path))
+    return paths
+
+
+def path_ratio(path: List[Edge]) -> float:
+    ratio = 1.0
+    for edge in path:
+        ratio *= edge[2]
+    return ratio
+
+
+def convert(path: List[Edge], amount: int) -> List[Dict[str, Any]]:
+    """Hop-by-hop amounts when sending as much of ``amount`` as the blocks allow."""
+    steps = []
+    for source, target, ratio, block in path:
+        sent = amount // block * block
+        amount = int(sent * ratio)
+        steps.append({"from_company_id": source, "to_company_id": target, "sent": sent, "credited": amount})
+    return steps
+
+
+def best_route(paths: List[List[Edge]], balance: int):
+    """The path that delivers the most points for ``balance``, with its steps."""
+    best = None
+    for path in paths:
+        steps = convert(path, balance)
+        if steps[-1]["credited"] > 0 and (best is None or steps[-1]["credited"] > best[1][-1]["credited"]):
+            best = (path, steps)
+    return best
@@ -0,0 +1,240 @@
+"""Award redemption planner over pooled family balances.
+
+An award is booked in one of several programs (the cost table), ``seats``
+times at that program's price. Any member holding the program can pay for
+some of the seats; a payer short of points is topped up through transfer
+edges (``from_company`` -> ``to_company`` at ``ratio``, in multiples of
+``block``), either from their own programs or, for ``between_members``
+edges, from anyone's.
+
+The search walks seat allocations with the fewest payers first and finds
+the best funding of each one by branch and bound over the blocks drawn from
+each source (see ``fund``). It stops after ``budget_ms`` or
+``MAX_ALLOCATIONS`` and says whether it saw everything. Complete results
+are memoized on the balance snapshot plus the request, both passed as
+hashable tuples.
+"""
+import copy
+import itertools
+import math
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+MAX_ALLOCATIONS = 20000
+EVERY_AMOUNT_BLOCKS = 64  # routes up to this many blocks get every amount tried
+
+Snapshot = Tuple[Tuple[str, str, int], ...]  # (member_id, company_id, balance)
+Option = Tuple[str, int]  # (company_id, points per seat)
+Edge = Tuple[str, str, float, int, bool]  # (from, to, ratio, block, between_members)
+
+
+def compositions(total: int, parts: int) -> Iterator[Tuple[int, ...]]:
+    """Every way to split ``total`` into ``parts`` positive integers."""
+    for cuts in itertools.combinations(range(1, total), parts - 1):
+        bounds = (0, *cuts, total)
+        yield tuple(b - a for a, b in zip(bounds, bounds[1:]))
+
+
+def allocations(payers: List[str], seats: int) -> Iterator[Dict[str, int]]:
+    for count in range(1, min(len(payers), seats) + 1):
+        for group in itertools.combinations(payers, count):
+            for split in compositions(seats, count):
+                yield dict(zip(group, split))
+
+
+Route = Tuple[str, str, float, int]  # (holder, held company, ratio, block) into the award program
+
+
+def closing_blocks(need: int, ratio: float, block: int) -> int:
+    """Fewest blocks whose credit covers ``need``."""
+    blocks = math.ceil(math.ceil(need / ratio) / block)
+    while int(blocks * block * ratio) < need:
+        blocks += 1
+    return blocks
+
+
+def fund(allocation: Dict[str, int], company_id: str, cost: int, balances: Dict[Tuple[str, str], int],
+         edges: List[Edge], deadline: float = math.inf) -> Tuple[Optional[Dict[str, Any]], bool]:
+    """The transfers that let every payer cover their seats with the fewest
+    transfers, then the fewest points lost to ratios; None if there are none.
+
+    Branch and bound over the blocks each payer draws from each source. Up
+    to ``EVERY_AMOUNT_BLOCKS`` every amount is tried (block rounding makes a
+    partial draw pay off). Past that, a source that a payer later in the
+    order can also use gets the amounts that leave later payers (each, or
+    all) the least or the most they could need from it; the others are
+    drained as far as useful. Any source can also be skipped. The flag says
+    whether the search finished before ``deadline``.
+    """
+    pool = dict(balances)
+    need = {}
+    for member_id, seats in allocation.items():
+        own = min(pool.get((member_id, company_id), 0), seats * cost)
+        pool[(member_id, company_id)] = pool.get((member_id, company_id), 0) - own
+        need[member_id] = seats * cost - own
+
+    payers = sorted((m for m in need if need[m] > 0), key=need.get, reverse=True)
+    routes: Dict[str, List[Route]] = {}
+    for member_id in payers:
+        routes[member_id] = sorted((
+            (holder, held_company, ratio, block)
+            for source_company, target, ratio, block, between_members in edges if target == company_id
+            for (holder, held_company) in pool
+            if held_company == source_company and (holder, held_company) != (member_id, company_id)
+            and (holder == member_id or between_members)
+        ), key=lambda route: -route[2])
+    later_sources = [{(route[0], route[1]) for payer in payers[index + 1:] for route in routes[payer]}
+                     for index in range(len(payers))]
+    # With every ratio <= 1, covering n more points through ratio r loses at
+    # least n * (1/r - 1); otherwise only the transfer count bounds a branch
+    loss_bound = all(edge[2] <= 1 for edge in edges)
+    waste = {m: (1 / max(r[2] for r in routes[m]) - 1) if routes[m] and loss_bound else 0 for m in payers}
+
+    best: Dict[str, Any] = {}
+    stack: List[Tuple[str, Route, int, int]] = []  # (payer, route, amount, credited)
+    finished = True
+
+    def reachable(member_id: str, start: int, remaining: int) -> bool:
+        return sum(int(pool[(h, c)] // block * block * ratio)
+                   for h, c, ratio, block in routes[member_id][start:]) >= remaining
+
+    def amounts(index: int, route: Route, most: int) -> List[int]:
+        """Block counts to try on a route, most first."""
+        if most <= EVERY_AMOUNT_BLOCKS:
+            return list(range(most, 0, -1))
+        source = (route[0], route[1])
+        if source not in later_sources[index]:
+            return [most]
+        usable = pool[source] // route[3]
+        candidates, least_all, most_all = {most}, 0, 0
+        for payer in payers[index + 1:]:
+            for other in routes[payer]:
+                if (other[0], other[1]) != source:
+                    continue
+                elsewhere = sum(int(pool[(h, c)] // block * block * ratio)
+                                for h, c, ratio, block in routes[payer] if (h, c) != source)
+                # in this route's blocks: the least the payer must get here, and all it could use
+                least = math.ceil(closing_blocks(max(need[payer] - elsewhere, 0), other[2], other[3])
+                                  * other[3] / route[3]) if need[payer] > elsewhere else 0
+                full = math.ceil(closing_blocks(need[payer], other[2], other[3]) * other[3] / route[3])
+                candidates |= {usable - least, usable - full}
+                least_all, most_all = least_all + least, most_all + full
+        candidates |= {usable - least_all, usable - most_all}
+        return sorted((k for k in candidates if 0 < k <= most), reverse=True)
+
+    def search(index: int, start: int, remaining: int, loss: int):
+        nonlocal finished
+        if not finished:
+            return
+        if time.monotonic() > deadline:
+            finished = False
+            return
+        if remaining <= 0:
+            index, start = index + 1, 0
+            if index == len(payers):
+                if not best or (len(stack), loss) < (best["count"], best["loss"]):
+                    best.update(count=len(stack), loss=loss, stack=list(stack))
+                return
+            remaining = need[payers[index]]
+            if any(not reachable(payer, 0, need[payer]) for payer in payers[index:]):
+                return
+        if best:
+            # Every payer still short needs at least one more transfer
+            count = len(stack) + len(payers) - index
+            if count > best["count"] or (loss_bound and count == best["count"] and loss + remaining * waste[
+                    payers[index]] + sum(need[m] * waste[m] for m in payers[index + 1:]) >= best["loss"]):
+                return
+        member_id = payers[index]
+        if start == len(routes[member_id]) or not reachable(member_id, start, remaining):
+            return
+        route = routes[member_id][start]
+        holder, held_company, ratio, block = route
+        most = min(pool[(holder, held_company)] // block, closing_blocks(remaining, ratio, block))
+        for blocks in amounts(index, route, most):
+            amount = blocks * block
+            credited = int(amount * ratio)
+            if credited <= 0:
+                break
+            pool[(holder, held_company)] -= amount
+            stack.append((member_id, route, amount, credited))
+            search(index, start + 1, remaining - credited, loss + amount - credited)
+            stack.pop()
+            pool[(holder, held_company)] += amount
+        search(index, start + 1, remaining, loss)
+
+    if not payers:
+        best.update(count=0, loss=0, stack=[])
+    else:
+        search(0, 0, need[payers[0]], 0)
+    if not best:
+        return None, finished
+
+    # Credits beyond the seats stay in the payer's account
+    transfers = [{
+        "from_member_id": holder,
+        "from_company_id": held_company,
+        "to_member_id": member_id,
+        "to_company_id": company_id,
+        "amount": amount,
+        "ratio": ratio,
+        "credited": credited,
+    } for member_id, (holder, held_company, ratio, _), amount, credited in best["stack"]]
+    return {
+        "company_id": company_id,
+        "points_per_seat": cost,
+        "payers": [{"member_id": m, "seats": s, "points": s * cost} for m, s in allocation.items()],
+        "transfers": transfers,
+        "points_debited": sum(s * cost for s in allocation.values()) + best["loss"],
+    }, finished
+
+
+PLAN_CACHE_SIZE = 128
+plan_cache: "OrderedDict[tuple, Tuple[Tuple[Dict[str, Any], ...], bool]]" = OrderedDict()
+
+
+def plan_awards(snapshot: Snapshot, options: Tuple[Option, ...], seats: int, edges: Tuple[Edge, ...],
+                max_plans: int, budget_ms: int) -> Tuple[List[Dict[str, Any]], bool]:
+    """The ``max_plans`` best plans (fewest transfers, then payers, then points) and completeness.
+
+    Complete answers are memoized (they do not depend on the budget); the
+    caller gets copies, so it may decorate them.
+    """
+    key = (snapshot, options, seats, edges, max_plans)
+    hit = plan_cache.get(key)
+    if hit is not None:
+        plan_cache.move_to_end(key)
+    else:
+        hit = search_plans(snapshot, options, seats, edges, max_plans, budget_ms)
+        if hit[1]:
+            plan_cache[key] = hit
+            if len(plan_cache) > PLAN_CACHE_SIZE:
+                plan_cache.popitem(last=False)
+    return copy.deepcopy(list(hit[0])), hit[1]
+
+
+def search_plans(snapshot: Snapshot, options: Tuple[Option, ...], seats: int, edges: Tuple[Edge, ...],
+                 max_plans: int, budget_ms: int) -> Tuple[Tuple[Dict[str, Any], ...], bool]:
+    balances = {(member_id, company_id): balance for member_id, company_id, balance in snapshot}
+    deadline = time.monotonic() + budget_ms / 1000
+    plans = []
+    tried = 0
+    complete = True
+    for company_id, cost in options:
+        payers = sorted({member_id for member_id, held in balances if held == company_id},
+                        key=lambda m: -balances[(m, company_id)])
+        for allocation in allocations(payers, seats):
+            tried += 1
+            if tried > MAX_ALLOCATIONS or time.monotonic() > deadline:
+                complete = False
+                break
+            plan, finished = fund(allocation, company_id, cost, balances, list(edges), deadline)
+            if plan:
+                plans.append(plan)
+            if not finished:
+                complete = False
+                break
+        if not complete:
+            break
+    plans.sort(key=lambda p: (len(p["transfers"]), len(p["payers"]), p["points_debited"]))
+    return tuple(plans[:max_plans]), complete
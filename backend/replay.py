@@ -0,0 +1,121 @@
+"""Point-in-time family state rebuilt from the global log.
+
+A state is ``{member_id: {"name", "programs": {company_id: {field: value}}}}``
+holding the ``TRACKED_FIELDS`` of every program. Log entries store absolute
+old/new values, so the state at any moment is the nearest snapshot with the
+entries in between applied forward (new values) or, before the first
+snapshot, undone backward (old values). Applying an entry twice is harmless,
+which is what makes a snapshot taken while writes are landing safe to replay
+from its own timestamp.
+
+Programs created together with a member or a company are not logged one by
+one; they show up with default values the first time an entry touches them.
+"""
+import copy
+from typing import Any, Dict, Iterable, List
+
+TRACKED_FIELDS = ("current_balance", "elite_tier")
+
+State = Dict[str, Dict[str, Any]]
+
+
+def capture(members: List[Dict[str, Any]]) -> State:
+    return {
+        member["id"]: {
+            "name": member["name"],
+            "programs": {
+                company_id: {field: program.get(field, default_value(field)) for field in TRACKED_FIELDS}
+                for company_id, program in (member.get("programs") or {}).items()
+            }
+        }
+        for member in members
+    }
+
+
+def default_value(field: str) -> Any:
+    return 0 if field == "current_balance" else ""
+
+
+def parse_value(field: str, raw: Any) -> Any:
+    if field == "current_balance":
+        try:
+            return int(raw)
+        except (TypeError, ValueError):
+            return 0
+    return raw or ""
+
+
+def entry_items(entry: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return entry.get("changes") or [entry]
+
+
+def touch(state: State, item: Dict[str, Any]) -> Dict[str, Any]:
+    return state.setdefault(item["member_id"], {"name": item.get("member_name", ""), "programs": {}})
+
+
+def program(member: Dict[str, Any], company_id: str) -> Dict[str, Any]:
+    return member["programs"].setdefault(company_id, {field: default_value(field) for field in TRACKED_FIELDS})
+
+
+def apply(state: State, entry: Dict[str, Any]) -> None:
+    """Move ``state`` forward over ``entry``."""
+    for item in entry_items(entry):
+        member_id, field, value = item.get("member_id"), item.get("field_changed"), item.get("new_value")
+        if not member_id:
+            continue
+        if field == "membro" and value == "deletado":
+            state.pop(member_id, None)
+            continue
+        member = touch(state, item)
+        company_id = item.get("company_id")
+        if field == "nome":
+            member["name"] = value
+        elif field == "programa" and company_id:
+            if value == "removido":
+                member["programs"].pop(company_id, None)
+            else:
+                program(member, company_id)
+        elif field in TRACKED_FIELDS and company_id:
+            program(member, company_id)[field] = parse_value(field, value)
+    # A merge re-keys the source programs onto the survivor (items above)
+    if entry.get("merged_company_id"):
+        for member in state.values():
+            member["programs"].pop(entry["merged_company_id"], None)
+
+
+def undo(state: State, entry: Dict[str, Any]) -> None:
+    """Move ``state`` backward over ``entry``.
+
+    Removed programs come back with default values and merged-away ones do
+    not come back: the log never held their contents.
+    """
+    for item in reversed(entry_items(entry)):
+        member_id, field, value = item.get("member_id"), item.get("field_changed"), item.get("old_value")
+        if not member_id:
+            continue
+        if field == "membro" and item.get("new_value") == "criado":
+            state.pop(member_id, None)
+            continue
+        member = touch(state, item)
+        company_id = item.get("company_id")
+        if field == "nome":
+            member["name"] = value
+        elif field == "programa" and company_id:
+            if item.get("new_value") == "removido":
+                program(member, company_id)
+            else:
+                member["programs"].pop(company_id, None)
+        elif field in TRACKED_FIELDS and company_id:
+            program(member, company_id)[field] = parse_value(field, value)
+
+
+def replay(state: State, entries: Iterable[Dict[str, Any]], forward: bool = True) -> State:
+    """A copy of ``state`` with ``entries`` (oldest first) applied, or undone newest first."""
+    state = copy.deepcopy(state)
+    if forward:
+        for entry in entries:
+            apply(state, entry)
+    else:
+        for entry in reversed(list(entries)):
+            undo(state, entry)
+    return state
@@ -1,17 +1,40 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Header, Response, BackgroundTasks
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
-from pymongo import MongoClient
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
-from datetime import datetime
+from datetime import date, datetime, timedelta, timezone
+from collections import OrderedDict
+from pathlib import Path
+import asyncio
+import base64
+import logging
+import math
+import re
 import uuid
 import os
+import sys
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+# Make sibling modules importable both as `backend.server` and `server`
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from storage import create_storage, DuplicateError
+from storage.buckets import UNITS as ACTIVITY_UNITS, next_bucket, truncate
+from storage.names import name_key
+from storage.paths import get_path
+from timeseries import DOWNSAMPLE_METHODS, balance_points, downsample
+from analytics import BalanceMatrix, rate_vector, summarize, valuate
+from planner import plan_awards
+from partners import best_route, partner_edges, path_ratio, simple_paths
+from replay import capture, entry_items, parse_value, replay
+
 app = FastAPI(title="Programas de Pontos Família Lech API", version="1.0")
+logger = logging.getLogger(__name__)
 
 # CORS middleware
 app.add_middleware(
@@ -22,21 +45,42 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# MongoDB connection
-mongo_client = MongoClient(os.getenv("MONGO_URL"))
-db = mongo_client[os.getenv("DB_NAME")]
+# Storage engine (STORAGE_ENGINE=mongo|memory|journal|sqlite)
+storage = create_storage()
+
+# Derived data (analytics, valuations...) is cached per data version, which
+# every write request bumps once it has been handled
+data_version = 0
+derived_cache: Dict[str, "OrderedDict[Any, Any]"] = {}
+QUERY_ENDPOINTS = {"/api/planner/awards"}  # POST only to carry a body; they write nothing
 
-# Collections
-companies_collection = db.companies
-members_collection = db.members
-global_log_collection = db.global_log
-postits_collection = db.postits
+@app.middleware("http")
+async def track_data_version(request, call_next):
+    global data_version
+    response = await call_next(request)
+    if request.method not in ("GET", "HEAD", "OPTIONS") and request.url.path not in QUERY_ENDPOINTS:
+        data_version += 1
+    return response
+
+def cached(name: str, key: Any, compute, size: int = 1):
+    """`compute()`, reused for the `size` most recently used keys."""
+    entries = derived_cache.setdefault(name, OrderedDict())
+    if key in entries:
+        entries.move_to_end(key)
+        return entries[key]
+    entries[key] = value = compute()
+    if len(entries) > size:
+        entries.popitem(last=False)
+    return value
 
 # Pydantic models
 class Company(BaseModel):
     id: str
     name: str
     color: str
+    field_schema: Dict[str, Dict[str, Any]] = {}  # custom field name -> {"type": ...}
+    valuation_rates: List[Dict[str, Any]] = []  # [{"effective_from", "brl_per_1000"}] by date
+    transfer_partners: List[Dict[str, Any]] = []  # outgoing edges, see TransferPartner
 
 class ProgramData(BaseModel):
     company_id: str
@@ -50,26 +94,75 @@ class ProgramData(BaseModel):
     last_updated: datetime = None
     last_change: str = ""
     custom_fields: Dict[str, Any] = {}
+    next_expiry: Optional[date] = None  # soonest lot still to expire; lot endpoints and a daily refresh keep it
+    next_expiry_amount: int = 0  # points expiring on that day
+    version: int = 0
+
+class ExpiringLot(BaseModel):
+    amount: int
+    expires_on: date
+    note: str = ""
 
 class CustomField(BaseModel):
     name: str
     value: str = ""
     field_type: str = "text"  # text or number
 
+class FieldSchema(BaseModel):
+    field_type: str = "text"  # text or number
+
+class ValuationRate(BaseModel):
+    brl_per_1000: float  # BRL per 1,000 points
+    effective_from: date
+
+class TransferPartner(BaseModel):
+    ratio: float = 1.0  # points credited per point sent
+    bonus: float = 0  # percent on top of the ratio, e.g. 80
+    bonus_until: Optional[date] = None  # last day of the bonus; open-ended if empty
+    block: int = 1  # transfers go in multiples of this
+
+class AwardOption(BaseModel):
+    company_id: str
+    points: int  # per seat
+
+class TransferEdge(BaseModel):
+    from_company_id: str
+    to_company_id: str
+    ratio: float = 1.0  # points credited per point sent
+    block: int = 1  # transfers go in multiples of this
+    between_members: bool = False  # e.g. a family pool inside one program
+
+class AwardPlanRequest(BaseModel):
+    options: List[AwardOption]  # the award's price in each program that can book it
+    seats: int = 1
+    transfers: Optional[List[TransferEdge]] = None  # default: the stored partner graph
+    max_plans: int = 5
+
 class NewCompanyData(BaseModel):
     company_name: str
     color: str = "#4a90e2"
 
+class CompanyUpdate(BaseModel):
+    name: Optional[str] = None
+    color: Optional[str] = None
+
+class CompanyMerge(BaseModel):
+    into: str  # id of the surviving company
+    balance_policy: str = "sum"  # "sum", "max", "target" or "source"
+    custom_fields_policy: str = "target"  # side that wins when both have a field
+
 class Member(BaseModel):
     id: str
     name: str
     programs: Dict[str, ProgramData]
     created_at: datetime
     updated_at: datetime
+    version: int = 0
 
 class MemberUpdate(BaseModel):
     name: Optional[str] = None
     programs: Optional[Dict[str, Dict[str, Any]]] = None
+    expected_version: Optional[int] = None  # or send If-Match
 
 class GlobalLogEntry(BaseModel):
     id: str
@@ -81,7 +174,11 @@ class GlobalLogEntry(BaseModel):
     old_value: str
     new_value: str
     timestamp: datetime
-    change_type: str  # "update", "create", "delete"
+    change_type: str  # "update", "create", "delete", "rename", "changeset", "revert", "rollback"
+    changes: List[Dict[str, Any]] = []  # per-item changes of a "changeset" entry
+    reverts: Optional[str] = None  # on a "revert" entry, the entry it undid
+    reverted_by: Optional[str] = None
+    archived_at: Optional[datetime] = None  # moved to the archive (see archive_old_logs)
 
 class ProgramUpdate(BaseModel):
     login: Optional[str] = None
@@ -91,6 +188,50 @@ class ProgramUpdate(BaseModel):
     current_balance: Optional[int] = None
     elite_tier: Optional[str] = None
     notes: Optional[str] = None
+    expected_version: Optional[int] = None  # or send If-Match
+
+class BalanceDelta(BaseModel):
+    member_id: str
+    company_id: str
+    delta: int
+
+class BalanceAdjustment(BaseModel):
+    deltas: List[BalanceDelta]
+    prevent_negative: bool = True
+    note: str = ""
+
+class ProgramChange(BaseModel):
+    member_id: str
+    company_id: str
+    changes: ProgramUpdate
+
+class BulkProgramUpdate(BaseModel):
+    updates: List[ProgramChange]
+
+class PointsTransfer(BaseModel):
+    from_member_id: str
+    from_company_id: str
+    to_member_id: str
+    to_company_id: str
+    amount: int  # points debited from the source program
+    ratio: float = 1.0  # points credited per point debited
+    note: str = ""
+
+def default_program(company_id: str, now: datetime, last_change: str = "Conta criada") -> Dict[str, Any]:
+    """Empty program data, as created for new members and new companies."""
+    return {
+        "company_id": company_id,
+        "login": "",
+        "password": "",
+        "cpf": "",
+        "card_number": "",
+        "current_balance": 0,
+        "elite_tier": "",
+        "notes": "",
+        "last_updated": now,
+        "last_change": last_change,
+        "custom_fields": {}
+    }
 
 # Initialize default data
 async def init_default_data():
@@ -115,36 +256,23 @@ async def init_default_data():
     
     # Create companies
     for company in default_companies:
-        existing = companies_collection.find_one({"id": company["id"]})
+        existing = storage.get_company(company["id"])
         if not existing:
-            companies_collection.insert_one(company)
+            storage.insert_company(company)
     
     # Family members
     family_members = ["Osvandré", "Marilise", "Graciela", "Leonardo"]
     
     # Create family members with empty program data
     for member_name in family_members:
-        existing_member = members_collection.find_one({"name": member_name})
+        existing_member = storage.find_member_by_name(member_name)
         
         if not existing_member:
             member_id = str(uuid.uuid4())
             now = datetime.utcnow()
             
             # Create empty program data for each company
-            programs = {}
-            for company in default_companies:
-                programs[company["id"]] = {
-                    "company_id": company["id"],
-                    "login": "",
-                    "password": "",
-                    "cpf": "",
-                    "card_number": "",
-                    "current_balance": 0,
-                    "elite_tier": "",
-                    "notes": "",
-                    "last_updated": now,
-                    "last_change": "Conta criada"
-                }
+            programs = {company["id"]: default_program(company["id"], now) for company in default_companies}
             
             member_data = {
                 "id": member_id,
@@ -154,12 +282,37 @@ async def init_default_data():
                 "updated_at": now
             }
             
-            members_collection.insert_one(member_data)
+            storage.insert_member(member_data)
 
 # Startup event
 @app.on_event("startup")
 async def startup_event():
+    global maintenance
+    storage.ensure_indexes()
     await init_default_data()
+    maintenance = asyncio.create_task(maintenance_loop())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if maintenance:
+        maintenance.cancel()
+    storage.close()
+
+# Periodic upkeep (state snapshots, log archival, passed expiries), off the
+# request path.
+# Storage calls block, so each task runs in the thread pool.
+MAINTENANCE_SECONDS = float(os.getenv("MAINTENANCE_SECONDS", "60"))
+maintenance: Optional[asyncio.Task] = None
+
+async def maintenance_loop():
+    while True:
+        for task in MAINTENANCE_TASKS:
+            try:
+                await run_in_threadpool(task)
+            except Exception:
+                # The next round retries
+                logger.exception("%s failed", task.__name__)
+        await asyncio.sleep(MAINTENANCE_SECONDS)
 
 class PostIt(BaseModel):
     id: str
@@ -172,9 +325,9 @@ class PostItCreate(BaseModel):
 
 class PostItUpdate(BaseModel):
     content: str
-def log_change(member_id: str, member_name: str, company_id: str, company_name: str, 
-               field_changed: str, old_value: str, new_value: str, change_type: str = "update"):
-    log_entry = {
+def make_log_entry(member_id: str, member_name: str, company_id: str, company_name: str,
+                   field_changed: str, old_value: str, new_value: str, change_type: str = "update"):
+    return {
         "id": str(uuid.uuid4()),
         "member_id": member_id,
         "member_name": member_name,
@@ -186,129 +339,1103 @@ def log_change(member_id: str, member_name: str, company_id: str, company_name:
         "timestamp": datetime.utcnow(),
         "change_type": change_type
     }
-    global_log_collection.insert_one(log_entry)
+
+def log_change(member_id: str, member_name: str, company_id: str, company_name: str, 
+               field_changed: str, old_value: str, new_value: str, change_type: str = "update"):
+    entry = make_log_entry(member_id, member_name, company_id, company_name,
+                           field_changed, old_value, new_value, change_type)
+    storage.insert_log(entry)
+    record_balances([entry])
+
+def log_changeset(changes: List[Dict[str, Any]], field_changed: str, summary: str,
+                  change_type: str = "changeset", extra: Optional[Dict[str, Any]] = None):
+    """Log a batch as one entry; `changes` holds log_change-style dicts."""
+    members = {c["member_id"]: c["member_name"] for c in changes}
+    companies = {c["company_id"]: c["company_name"] for c in changes}
+    log_entry = {
+        "id": str(uuid.uuid4()),
+        "member_id": next(iter(members)) if len(members) == 1 else "",
+        "member_name": next(iter(members.values())) if len(members) == 1 else f"{len(members)} membros",
+        "company_id": next(iter(companies)) if len(companies) == 1 else "",
+        "company_name": next(iter(companies.values())) if len(companies) == 1 else f"{len(companies)} companhias",
+        "field_changed": field_changed,
+        "old_value": "",
+        "new_value": summary,
+        "timestamp": datetime.utcnow(),
+        "change_type": change_type,
+        "changes": changes,
+        **(extra or {})
+    }
+    storage.insert_log(log_entry)
+    record_balances([log_entry])
+
+def record_balances(entries: List[Dict[str, Any]]):
+    """Append the balance changes among freshly written log entries to the history."""
+    points = balance_points(entries)
+    if points:
+        storage.insert_balance_points(points)
+
+# Optimistic concurrency: every member write bumps the member's `version`;
+# programs and individual fields remember the member version that last
+# changed them, so a stale client only conflicts on fields it touches.
+MAX_WRITE_ATTEMPTS = 3
+
+def version_of(doc: Optional[Dict[str, Any]]) -> int:
+    return (doc or {}).get("version", 0) or 0
+
+def version_filter(version: int) -> Dict[str, Any]:
+    # Documents written before versioning existed have no version field
+    return {"version": version if version else {"$in": [None, 0]}}
+
+def etag(version: int) -> str:
+    return f'"{version}"'
+
+def expected_version(if_match: Optional[str], body_version: Optional[int]) -> Optional[int]:
+    if body_version is not None:
+        return body_version
+    if not if_match or if_match.strip() == "*":
+        return None
+    tag = if_match.strip()
+    if tag.startswith("W/"):
+        tag = tag[2:]
+    try:
+        return int(tag.strip('"'))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Cabeçalho If-Match inválido")
+
+def changed_since(doc: Dict[str, Any], fields, version: int) -> List[str]:
+    field_versions = doc.get("field_versions") or {}
+    return [field for field in fields if field_versions.get(field, 0) > version]
+
+def version_conflict(current: Optional[Dict[str, Any]], version: Optional[int], fields: List[str]) -> HTTPException:
+    return HTTPException(status_code=409, detail=jsonable_encoder({
+        "message": "Registro alterado por outra sessão",
+        "fields": fields,
+        "version": version if version is not None else version_of(current),
+        "current": current,
+    }))
+
+# Background jobs, polled through /api/jobs/{job_id}
+LOG_REWRITE_BATCH = int(os.getenv("LOG_REWRITE_BATCH", "500"))
+jobs: Dict[str, Dict[str, Any]] = {}
+
+def start_job(job_type: str, total: int) -> str:
+    job_id = str(uuid.uuid4())
+    jobs[job_id] = {
+        "id": job_id,
+        "type": job_type,
+        "status": "pending",
+        "total": total,
+        "done": 0,
+        "started_at": datetime.utcnow(),
+        "finished_at": None,
+        "error": None
+    }
+    return job_id
+
+def rewrite_company_logs(job_id: str, company_id: str, name: str):
+    job = jobs[job_id]
+    job["status"] = "running"
+    try:
+        while True:
+            # A newer rename owns the rewrite from here on
+            company = storage.get_company(company_id)
+            if not company or company["name"] != name:
+                job["status"] = "superseded"
+                break
+            renamed = storage.rename_company_logs(company_id, name, LOG_REWRITE_BATCH)
+            job["done"] += renamed
+            if renamed < LOG_REWRITE_BATCH:
+                job["status"] = "completed"
+                break
+    except Exception as e:
+        job["status"] = "failed"
+        job["error"] = str(e)
+    job["finished_at"] = datetime.utcnow()
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Tarefa não encontrada")
+    total = job["total"]
+    return {**job, "progress": 100.0 if not total else round(min(job["done"], total) * 100 / total, 1)}
 
 # Company endpoints
 @app.get("/api/companies", response_model=List[Company])
 async def get_companies():
-    companies = list(companies_collection.find({}, {"_id": 0}))
+    companies = storage.list_companies()
     return companies
 
+def find_or_create_company(new_company: NewCompanyData) -> Dict[str, Any]:
+    existing_company = storage.find_company_by_name(new_company.company_name)
+    if existing_company:
+        return existing_company
+    company_data = {
+        "id": str(uuid.uuid4()),
+        "name": new_company.company_name,
+        "color": new_company.color
+    }
+    try:
+        storage.insert_company(company_data)
+    except DuplicateError:
+        # A concurrent request created it first
+        return storage.find_company_by_name(new_company.company_name)
+    return company_data
+
+@app.post("/api/companies", response_model=Company)
+async def create_company(new_company: NewCompanyData):
+    company_data = {
+        "id": str(uuid.uuid4()),
+        "name": new_company.company_name,
+        "color": new_company.color
+    }
+    try:
+        storage.insert_company(company_data)
+    except DuplicateError:
+        raise HTTPException(status_code=400, detail="Companhia com esse nome já existe")
+    log_change("", "", company_data["id"], company_data["name"], "companhia", "", "criada", "create")
+    return company_data
+
+@app.get("/api/companies/duplicates")
+async def get_duplicate_companies():
+    # Companies whose names only differ in case, accents, spaces or punctuation
+    groups: Dict[str, List[Dict[str, Any]]] = {}
+    for company in storage.list_companies():
+        groups.setdefault(name_key(company["name"]), []).append(company)
+    return [group for group in groups.values() if len(group) > 1]
+
+@app.get("/api/companies/{company_id}", response_model=Company)
+async def get_company(company_id: str):
+    company = storage.get_company(company_id)
+    if not company:
+        raise HTTPException(status_code=404, detail="Companhia não encontrada")
+    return company
+
+@app.put("/api/companies/{company_id}")
+async def update_company(company_id: str, company_update: CompanyUpdate, background_tasks: BackgroundTasks):
+    company = storage.get_company(company_id)
+    if not company:
+        raise HTTPException(status_code=404, detail="Companhia não encontrada")
+    
+    update_data = company_update.dict(exclude_unset=True, exclude_none=True)
+    renamed = "name" in update_data and update_data["name"] != company["name"]
+    if update_data:
+        try:
+            storage.update_company(company_id, update_data)
+        except DuplicateError:
+            raise HTTPException(status_code=400, detail="Companhia com esse nome já existe")
+    
+    job_id = None
+    if renamed:
+        log_change("", "", company_id, update_data["name"], "companhia", company["name"], update_data["name"])
+        # Programs only reference the company id; the denormalized name
+        # lives in the global log, which is rewritten in the background
+        job_id = start_job("rename_company_logs", storage.count_company_logs(company_id, update_data["name"]))
+        background_tasks.add_task(rewrite_company_logs, job_id, company_id, update_data["name"])
+    
+    return {
+        "message": "Companhia atualizada com sucesso",
+        "company": storage.get_company(company_id),
+        "job_id": job_id
+    }
+
+@app.delete("/api/companies/{company_id}")
+async def delete_company(company_id: str):
+    global graph_version
+    company = storage.get_company(company_id)
+    if not company:
+        raise HTTPException(status_code=404, detail="Companhia não encontrada")
+    
+    # Cascade: one $unset over every member holding the program
+    removed = remove_program_everywhere(company)
+    drop_partner_edges(company_id)
+    storage.delete_company(company_id)
+    if company.get("transfer_partners"):
+        graph_version += 1  # its outgoing edges go with it
+    log_change("", "", company_id, company["name"], "companhia", company["name"], "deletada", "delete")
+    
+    return {
+        "message": "Companhia deletada com sucesso",
+        "company_id": company_id,
+        "programs_removed": removed
+    }
+
+MERGE_BALANCE_POLICIES = {
+    "sum": lambda target, source: target + source,
+    "max": max,
+    "target": lambda target, source: target,
+    "source": lambda target, source: source,
+}
+
+def merge_programs(target: Dict[str, Any], source: Dict[str, Any], merge: CompanyMerge) -> Dict[str, Any]:
+    merged = dict(target)
+    # Fill whatever the survivor left empty (login, cpf, notes...)
+    for field, value in source.items():
+        if field not in ("company_id", "current_balance", "custom_fields", "field_versions", "version") \
+                and not merged.get(field):
+            merged[field] = value
+    merged["current_balance"] = MERGE_BALANCE_POLICIES[merge.balance_policy](
+        target.get("current_balance", 0) or 0, source.get("current_balance", 0) or 0)
+    target_fields, source_fields = target.get("custom_fields") or {}, source.get("custom_fields") or {}
+    if merge.custom_fields_policy == "target":
+        merged["custom_fields"] = {**source_fields, **target_fields}
+    else:
+        merged["custom_fields"] = {**target_fields, **source_fields}
+    return merged
+
+@app.post("/api/companies/{company_id}/merge")
+async def merge_company(company_id: str, merge: CompanyMerge):
+    global graph_version, rate_version
+    if merge.balance_policy not in MERGE_BALANCE_POLICIES or merge.custom_fields_policy not in ("target", "source"):
+        raise HTTPException(status_code=400, detail="Política de mesclagem inválida")
+    if merge.into == company_id:
+        raise HTTPException(status_code=400, detail="Uma companhia não pode ser mesclada nela mesma")
+    source = storage.get_company(company_id)
+    target = storage.get_company(merge.into)
+    if not source or not target:
+        raise HTTPException(status_code=404, detail="Companhia não encontrada")
+    
+    # The survivor's field types win; refuse the merge while a custom field
+    # value on either side would not convert to the merged schema
+    merged_company = {"field_schema": {**(source.get("field_schema") or {}), **(target.get("field_schema") or {})}}
+    invalid, retyped = [], []
+    for side in (company_id, merge.into):
+        for program in storage.list_programs_for_company(side):
+            fields = program.get("custom_fields") or {}
+            try:
+                coerced = coerce_custom_fields(merged_company, fields)
+            except HTTPException:
+                invalid.append({"member_id": program["member_id"], "company_id": side, "custom_fields": fields})
+                continue
+            if side == merge.into and custom_fields_changed(fields, coerced):
+                retyped.append(program["member_id"])
+    if invalid:
+        raise HTTPException(status_code=400, detail=jsonable_encoder({
+            "message": f"Campos personalizados de {source['name']} não convertem para os tipos de {target['name']}",
+            "invalid": invalid,
+        }))
+    
+    def retype(fields: Dict[str, Any]) -> Dict[str, Any]:
+        try:
+            return coerce_custom_fields(merged_company, fields)
+        except HTTPException:
+            return fields  # written between the check and the merge; left as is
+    
+    # Re-key programs.<source> to programs.<target> on every member in one bulk pass
+    changes: Dict[str, Dict[str, Any]] = {}
+    pending = [program["member_id"] for program in storage.list_programs_for_company(company_id)]
+    pending += [member_id for member_id in retyped if member_id not in pending]
+    for attempt in range(MAX_WRITE_ATTEMPTS):
+        updates = []
+        for member in storage.get_members(pending):
+            old_program = member["programs"].get(company_id)
+            current = member["programs"].get(merge.into)
+            new_version = version_of(member) + 1
+            now = datetime.utcnow()
+            if old_program is None:
+                # Converted like declare_field_type does for a type the source declared
+                fields = (current or {}).get("custom_fields") or {}
+                coerced = retype(fields)
+                if custom_fields_changed(fields, coerced):
+                    updates.append({
+                        "member_id": member["id"],
+                        "set_fields": {f"programs.{merge.into}.custom_fields": coerced, "version": new_version},
+                        "where": version_filter(version_of(member))
+                    })
+                continue
+            program = merge_programs(current, old_program, merge) if current else dict(old_program)
+            program["custom_fields"] = retype(program.get("custom_fields") or {})
+            program.update({
+                "company_id": merge.into,
+                "version": new_version,
+                "field_versions": {**(program.get("field_versions") or {}), "current_balance": new_version},
+                "last_updated": now,
+                "last_change": f"Mesclado de {source['name']}"
+            })
+            updates.append({
+                "member_id": member["id"],
+                "set_fields": {f"programs.{merge.into}": program, "updated_at": now, "version": new_version},
+                "unset_fields": [f"programs.{company_id}"],
+                "where": version_filter(version_of(member))
+            })
+            changes[member["id"]] = {
+                "member_id": member["id"],
+                "member_name": member["name"],
+                "company_id": merge.into,
+                "company_name": target["name"],
+                "field_changed": "current_balance",
+                "old_value": str((current or {}).get("current_balance", 0)),
+                "new_value": str(program["current_balance"])
+            }
+        results = storage.bulk_update_members(updates) if updates else []
+        pending = [u["member_id"] for u, ok in zip(updates, results) if not ok]
+        if not pending:
+            break
+    else:
+        # Merged members no longer hold the source program, so retrying finishes the job
+        raise version_conflict(None, None, [])
+    
+    # The survivor keeps its own partners and rates; the source's fill the gaps
+    target = storage.get_company(merge.into) or target
+    survivor = dict(merged_company) if source.get("field_schema") else {}
+    partners = target.get("transfer_partners") or []
+    reached = {p["to_company_id"] for p in partners} | {merge.into}
+    added = [p for p in source.get("transfer_partners") or [] if p["to_company_id"] not in reached]
+    if added:
+        survivor["transfer_partners"] = partners + added
+    rates = target.get("valuation_rates") or []
+    days = {r["effective_from"] for r in rates}
+    added_rates = [r for r in source.get("valuation_rates") or [] if r["effective_from"] not in days]
+    if added_rates:
+        survivor["valuation_rates"] = sorted(rates + added_rates, key=lambda r: r["effective_from"])
+        rate_version += 1
+    if survivor:
+        storage.update_company(merge.into, survivor)
+    if source.get("transfer_partners"):
+        graph_version += 1
+    if storage.move_lots(company_id, merge.into):
+        for member_id in changes:
+            sync_next_expiry(member_id, merge.into)
+    drop_partner_edges(company_id, into=merge.into)
+    storage.delete_company(company_id)
+    try:
+        # Claim the normalized name in case the survivor was the un-keyed duplicate
+        storage.update_company(merge.into, {"name": target["name"]})
+    except DuplicateError:
+        pass  # a third duplicate still holds it until it is merged too
+    summary = f"{source['name']} mesclada em {target['name']}"
+    if changes:
+        log_changeset(list(changes.values()), "companhia", summary, extra={"merged_company_id": company_id})
+    else:
+        log_change("", "", merge.into, target["name"], "companhia", source["name"], summary)
+    
+    return {
+        "message": f"{source['name']} mesclada em {target['name']}",
+        "company_id": merge.into,
+        "members_merged": len(changes)
+    }
+
+@app.get("/api/companies/{company_id}/programs")
+async def get_company_programs(company_id: str):
+    if not storage.get_company(company_id):
+        raise HTTPException(status_code=404, detail="Companhia não encontrada")
+    return storage.list_programs_for_company(company_id)
+
+# Custom field schema: each company may declare a type per custom field name;
+# undeclared fields stay free-form
+CUSTOM_FIELD_TYPES = ("text", "number")
+GROUPED_THOUSANDS = re.compile(r"-?\d{1,3}(\.\d{3})+")
+
+def parse_number(value: Any):
+    """int/float from a number or a pt-BR formatted string ("35.000", "1.234,5")."""
+    if isinstance(value, bool):
+        raise ValueError(value)
+    if isinstance(value, (int, float)):
+        number = value
+    else:
+        text = str(value).strip().replace(" ", "")
+        if not text:
+            return None
+        if "," in text:
+            text = text.replace(".", "").replace(",", ".")
+        elif GROUPED_THOUSANDS.fullmatch(text):
+            text = text.replace(".", "")
+        try:
+            return int(text)
+        except ValueError:
+            number = float(text)
+    if not math.isfinite(number):
+        raise ValueError(value)
+    return int(number) if isinstance(number, float) and number.is_integer() else number
+
+def coerce_field_value(field_type: str, value: Any) -> Any:
+    if value is None:
+        return None
+    if field_type == "number":
+        return parse_number(value)
+    return value if isinstance(value, str) else str(value)
+
+def custom_fields_changed(fields: Dict[str, Any], coerced: Dict[str, Any]) -> bool:
+    return any(coerced[name] != value or type(coerced[name]) is not type(value) for name, value in fields.items())
+
+def coerce_custom_fields(company: Optional[Dict[str, Any]], fields: Dict[str, Any]) -> Dict[str, Any]:
+    """Validate and convert values against the company's field schema (400 on bad input)."""
+    schema = (company or {}).get("field_schema") or {}
+    coerced = dict(fields)
+    for name, value in fields.items():
+        if name in schema:
+            try:
+                coerced[name] = coerce_field_value(schema[name]["type"], value)
+            except ValueError:
+                raise HTTPException(status_code=400, detail=f"Valor inválido para o campo numérico {name}: {value!r}")
+    return coerced
+
+@app.get("/api/companies/{company_id}/fields")
+async def get_field_schema(company_id: str):
+    company = storage.get_company(company_id)
+    if not company:
+        raise HTTPException(status_code=404, detail="Companhia não encontrada")
+    return {"company_id": company_id, "fields": company.get("field_schema") or {}}
+
+@app.put("/api/companies/{company_id}/fields/{field_name}")
+async def declare_field_type(company_id: str, field_name: str, field: FieldSchema):
+    """Declare a custom field's type and convert the values already stored."""
+    check_custom_field_name(field_name)
+    if field.field_type not in CUSTOM_FIELD_TYPES:
+        raise HTTPException(status_code=400, detail="Tipo de campo inválido")
+    company = storage.get_company(company_id)
+    if not company:
+        raise HTTPException(status_code=404, detail="Companhia não encontrada")
+    path = f"custom_fields.{field_name}"
+
+    # Refuse the declaration while stored values would not convert
+    invalid = []
+    for program in storage.list_programs_for_company(company_id):
+        try:
+            coerce_field_value(field.field_type, (program.get("custom_fields") or {}).get(field_name))
+        except ValueError:
+            invalid.append({"member_id": program["member_id"], "value": program["custom_fields"][field_name]})
+    if invalid:
+        raise HTTPException(status_code=400, detail=jsonable_encoder({
+            "message": f"Valores existentes não são numéricos: {field_name}",
+            "invalid": invalid,
+        }))
+
+    old_type = ((company.get("field_schema") or {}).get(field_name) or {}).get("type", "")
+    storage.update_company(company_id, {f"field_schema.{field_name}": {"type": field.field_type}})
+
+    # Writes from now on are coerced; convert what is already stored
+    converted = 0
+    pending = [program["member_id"] for program in storage.list_programs_for_company(company_id)]
+    for attempt in range(MAX_WRITE_ATTEMPTS):
+        updates = []
+        for member in storage.get_members(pending):
+            fields = (member["programs"].get(company_id) or {}).get("custom_fields") or {}
+            if field_name not in fields:
+                continue
+            try:
+                value = coerce_field_value(field.field_type, fields[field_name])
+            except ValueError:
+                continue  # written between the check and the declaration; left as is
+            if value == fields[field_name] and type(value) is type(fields[field_name]):
+                continue
+            updates.append({
+                "member_id": member["id"],
+                "set_fields": {f"programs.{company_id}.{path}": value, "version": version_of(member) + 1},
+                "where": version_filter(version_of(member))
+            })
+        results = storage.bulk_update_members(updates) if updates else []
+        converted += sum(results)
+        pending = [u["member_id"] for u, ok in zip(updates, results) if not ok]
+        if not pending:
+            break
+
+    log_change("", "", company_id, company["name"], f"campo: {field_name}", old_type, field.field_type)
+    return {
+        "message": "Tipo do campo atualizado com sucesso",
+        "field": {"name": field_name, "type": field.field_type},
+        "converted": converted
+    }
+
+@app.delete("/api/companies/{company_id}/fields/{field_name}")
+async def remove_field_type(company_id: str, field_name: str):
+    """Drop the declaration; stored values are kept as they are."""
+    company = storage.get_company(company_id)
+    if not company:
+        raise HTTPException(status_code=404, detail="Companhia não encontrada")
+    schema = dict(company.get("field_schema") or {})
+    removed = schema.pop(field_name, None)
+    if removed is None:
+        raise HTTPException(status_code=404, detail="Campo não encontrado")
+    storage.update_company(company_id, {"field_schema": schema})
+    log_change("", "", company_id, company["name"], f"campo: {field_name}", removed["type"], "", "delete")
+    return {"message": "Tipo do campo removido com sucesso"}
+
+@app.post("/api/companies/programs")
+async def add_company_to_all_members(new_company: NewCompanyData):
+    company = find_or_create_company(new_company)
+    company_id = company["id"]
+    path = f"programs.{company_id}"
+    
+    members = [m for m in storage.list_members() if company_id not in m["programs"]]
+    if members:
+        now = datetime.utcnow()
+        storage.update_members(
+            {path: default_program(company_id, now, "Programa criado"), "updated_at": now},
+            inc_fields={"version": 1},
+            where={"id": {"$in": [m["id"] for m in members]}, path: {"$exists": False}}
+        )
+        storage.insert_logs([
+            make_log_entry(m["id"], m["name"], company_id, company["name"], "programa", "", "adicionado")
+            for m in members
+        ])
+    
+    return {
+        "message": f"Programa adicionado a {len(members)} membros",
+        "company_id": company_id,
+        "company_name": company["name"]
+    }
+
+def remove_program_everywhere(company: Dict[str, Any]) -> int:
+    """$unset programs.<company> from every member, logging one entry per member."""
+    company_id = company["id"]
+    path = f"programs.{company_id}"
+    programs = storage.list_programs_for_company(company_id)
+    if not programs:
+        return 0
+    names = {m["id"]: m["name"] for m in storage.get_members([p["member_id"] for p in programs])}
+    storage.update_members({"updated_at": datetime.utcnow()}, [path], inc_fields={"version": 1},
+                           where={path: {"$exists": True}})
+    storage.delete_lots(company_id=company_id)
+    storage.insert_logs([
+        make_log_entry(p["member_id"], names.get(p["member_id"], ""), company_id, company["name"],
+                       "programa", company["name"], "removido")
+        for p in programs
+    ])
+    return len(programs)
+
+@app.delete("/api/companies/{company_id}/programs")
+async def remove_company_from_all_members(company_id: str):
+    company = storage.get_company(company_id)
+    if not company:
+        raise HTTPException(status_code=404, detail="Companhia não encontrada")
+    removed = remove_program_everywhere(company)
+    return {"message": f"Programa removido de {removed} membros"}
+
 # Member endpoints
 @app.get("/api/members", response_model=List[Member])
 async def get_members():
-    members = list(members_collection.find({}, {"_id": 0}))
+    members = storage.list_members()
     return members
 
 @app.get("/api/members/{member_id}", response_model=Member)
 async def get_member(member_id: str):
-    member = members_collection.find_one({"id": member_id}, {"_id": 0})
+    member = storage.get_member(member_id)
     if not member:
         raise HTTPException(status_code=404, detail="Membro não encontrado")
     return Member(**member)
 
 @app.put("/api/members/{member_id}")
-async def update_member(member_id: str, member_update: MemberUpdate):
-    member = members_collection.find_one({"id": member_id})
-    if not member:
-        raise HTTPException(status_code=404, detail="Membro não encontrado")
-    
-    update_data = {"updated_at": datetime.utcnow()}
-    
-    # Update member name if provided
-    if member_update.name:
-        old_name = member["name"]
-        update_data["name"] = member_update.name
-        log_change(member_id, old_name, "", "", "nome", old_name, member_update.name)
+async def update_member(member_id: str, member_update: MemberUpdate, response: Response,
+                        if_match: Optional[str] = Header(None)):
+    expected = expected_version(if_match, member_update.expected_version)
+    companies = {c["id"]: c for c in storage.list_companies()} if member_update.programs else {}
     
-    # Update programs if provided
-    if member_update.programs:
-        companies = {c["id"]: c for c in companies_collection.find({}, {"_id": 0})}
+    for attempt in range(MAX_WRITE_ATTEMPTS):
+        member = storage.get_member(member_id)
+        if not member:
+            raise HTTPException(status_code=404, detail="Membro não encontrado")
         
-        for company_id, program_data in member_update.programs.items():
+        member_version = version_of(member)
+        if expected is None:
+            expected = member_version
+        new_version = member_version + 1
+        update_data = {"updated_at": datetime.utcnow(), "version": new_version}
+        pending_logs = []
+        clashes = []
+        
+        # Update member name if provided
+        if member_update.name:
+            old_name = member["name"]
+            if member_version != expected:
+                clashes += changed_since(member, ["name"], expected)
+            update_data["name"] = member_update.name
+            update_data["field_versions.name"] = new_version
+            pending_logs.append((old_name, "", "", "nome", old_name, member_update.name))
+        
+        # Update programs if provided
+        for company_id, program_data in (member_update.programs or {}).items():
             if company_id in member["programs"]:
                 old_program = member["programs"][company_id]
-                updated_program = old_program.copy()
+                prefix = f"programs.{company_id}"
+                if member_version != expected:
+                    clashes += [f"{company_id}.{f}" for f in changed_since(old_program, program_data, expected)]
+                
+                if "custom_fields" in program_data:
+                    program_data = {**program_data, "custom_fields": coerce_custom_fields(
+                        companies.get(company_id), program_data["custom_fields"] or {})}
                 
                 # Track changes for each field
                 changes = []
                 for field, new_value in program_data.items():
                     if field in old_program and old_program[field] != new_value:
                         old_value = old_program[field]
-                        updated_program[field] = new_value
+                        update_data[f"{prefix}.{field}"] = new_value
+                        update_data[f"{prefix}.field_versions.{field}"] = new_version
                         changes.append(f"{field}: {old_value} → {new_value}")
                         
-                        # Log individual field changes
+                        # Log individual field changes once the write is accepted
                         company_name = companies.get(company_id, {}).get("name", company_id)
-                        log_change(member_id, member["name"], company_id, company_name, 
-                                 field, str(old_value), str(new_value))
+                        pending_logs.append((member["name"], company_id, company_name,
+                                             field, str(old_value), str(new_value)))
                 
-                # Update last_updated and last_change
-                updated_program["last_updated"] = datetime.utcnow()
+                # Update last_updated and last_change (only this program's fields are written)
+                update_data[f"{prefix}.last_updated"] = datetime.utcnow()
                 if changes:
-                    updated_program["last_change"] = ", ".join(changes)
-                
-                # Update the member's program data
-                if "programs" not in update_data:
-                    update_data["programs"] = member["programs"].copy()
-                update_data["programs"][company_id] = updated_program
-    
-    # Update member in database
-    members_collection.update_one(
-        {"id": member_id},
-        {"$set": update_data}
-    )
+                    update_data[f"{prefix}.version"] = new_version
+                    update_data[f"{prefix}.last_change"] = ", ".join(changes)
+        
+        if clashes:
+            raise version_conflict(member, member_version, clashes)
+        
+        # Update member in database, only if nobody wrote it since we read it
+        try:
+            if storage.update_member(member_id, update_data, where=version_filter(member_version)):
+                break
+        except DuplicateError:
+            raise HTTPException(status_code=400, detail="Membro com esse nome já existe")
+    else:
+        raise version_conflict(storage.get_member(member_id), None, [])
+    
+    for entry in pending_logs:
+        log_change(member_id, *entry)
     
     # Return updated member
-    updated_member = members_collection.find_one({"id": member_id}, {"_id": 0})
+    updated_member = storage.get_member(member_id)
+    response.headers["ETag"] = etag(version_of(updated_member))
     return Member(**updated_member)
 
-@app.put("/api/members/{member_id}/programs/{company_id}")
-async def update_program(member_id: str, company_id: str, program_update: ProgramUpdate):
-    member = members_collection.find_one({"id": member_id})
-    if not member:
-        raise HTTPException(status_code=404, detail="Membro não encontrado")
-    
-    if company_id not in member["programs"]:
+@app.get("/api/members/{member_id}/programs/{company_id}", response_model=ProgramData)
+async def get_program(member_id: str, company_id: str, response: Response):
+    program = storage.get_program(member_id, company_id)
+    if program is None:
         raise HTTPException(status_code=404, detail="Programa não encontrado")
+    response.headers["ETag"] = etag(version_of(program))
+    return program
+
+def utc_naive(moment: Optional[datetime]) -> Optional[datetime]:
+    # Stored timestamps are naive UTC (datetime.utcnow())
+    if moment is not None and moment.tzinfo is not None:
+        return moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+@app.get("/api/members/{member_id}/programs/{company_id}/balance-history")
+async def get_balance_history(member_id: str, company_id: str, points: int = 200, method: str = "lttb",
+                              since: Optional[datetime] = None, until: Optional[datetime] = None):
+    """A program's balance over time, downsampled to at most `points` samples.
+
+    `method=lttb` keeps the visual shape of the whole series; `method=day`
+    keeps each day's closing balance (then LTTB if there are still too many).
+    """
+    if method not in DOWNSAMPLE_METHODS:
+        raise HTTPException(status_code=400, detail="Método de amostragem inválido")
+    if points < 3:
+        raise HTTPException(status_code=400, detail="Informe ao menos 3 pontos")
+    series = storage.balance_history(member_id, company_id, utc_naive(since), utc_naive(until))
+    return {
+        "member_id": member_id,
+        "company_id": company_id,
+        "method": method,
+        "total": len(series),
+        "points": [{"ts": point["ts"], "balance": point["balance"]}
+                   for point in downsample(series, points, method)]
+    }
+
+@app.put("/api/members/{member_id}/programs/{company_id}")
+async def update_program(member_id: str, company_id: str, program_update: ProgramUpdate,
+                         response: Response, if_match: Optional[str] = Header(None)):
+    expected = expected_version(if_match, program_update.expected_version)
+    update_dict = program_update.dict(exclude_unset=True, exclude={"expected_version"})
     
-    company = companies_collection.find_one({"id": company_id})
+    company = storage.get_company(company_id)
     company_name = company["name"] if company else company_id
+    prefix = f"programs.{company_id}"
     
-    old_program = member["programs"][company_id]
-    updated_program = old_program.copy()
+    for attempt in range(MAX_WRITE_ATTEMPTS):
+        member = storage.get_member(member_id, programs=False)
+        if not member:
+            raise HTTPException(status_code=404, detail="Membro não encontrado")
+        
+        old_program = storage.get_program(member_id, company_id)
+        if old_program is None:
+            raise HTTPException(status_code=404, detail="Programa não encontrado")
+        
+        # Someone saved since the client's (or our first) read: fine as long
+        # as they did not touch the fields this request changes
+        program_version = version_of(old_program)
+        if expected is None:
+            expected = program_version
+        if program_version != expected:
+            clashes = changed_since(old_program, update_dict, expected)
+            if clashes:
+                raise version_conflict(old_program, program_version, clashes)
+        
+        member_version = version_of(member)
+        new_version = member_version + 1
+        update_data = {"updated_at": datetime.utcnow(), "version": new_version}
+        
+        # Track changes
+        changes = []
+        pending_logs = []
+        for field, new_value in update_dict.items():
+            if field in old_program and old_program[field] != new_value:
+                old_value = old_program[field]
+                update_data[f"{prefix}.{field}"] = new_value
+                update_data[f"{prefix}.field_versions.{field}"] = new_version
+                changes.append(f"{field}: {old_value} → {new_value}")
+                pending_logs.append((field, str(old_value), str(new_value)))
+        
+        # Update timestamps and change info
+        update_data[f"{prefix}.last_updated"] = datetime.utcnow()
+        if changes:
+            update_data[f"{prefix}.version"] = new_version
+            update_data[f"{prefix}.last_change"] = ", ".join(changes)
+        
+        # Update only the changed fields, only if the member is still at the version we read
+        if storage.update_member(member_id, update_data, where=version_filter(member_version)):
+            break
+    else:
+        current = storage.get_program(member_id, company_id)
+        raise version_conflict(current, version_of(current), [])
     
-    # Track changes
-    changes = []
-    update_dict = program_update.dict(exclude_unset=True)
+    # Log what was actually replaced
+    for field, old_value, new_value in pending_logs:
+        log_change(member_id, member["name"], company_id, company_name, field, old_value, new_value)
+    
+    version = new_version if changes else program_version
+    response.headers["ETag"] = etag(version)
+    return {"message": "Programa atualizado com sucesso", "changes": changes, "version": version}
+
+@app.post("/api/programs/bulk-update")
+async def bulk_update_programs(bulk: BulkProgramUpdate):
+    if not bulk.updates:
+        raise HTTPException(status_code=400, detail="Nenhuma alteração informada")
     
-    for field, new_value in update_dict.items():
-        if field in old_program and old_program[field] != new_value:
-            old_value = old_program[field]
-            updated_program[field] = new_value
-            changes.append(f"{field}: {old_value} → {new_value}")
+    items = list(enumerate(bulk.updates))
+    by_member: Dict[str, List[tuple]] = {}
+    for index, item in items:
+        by_member.setdefault(item.member_id, []).append((index, item))
+    expected = {index: item.changes.expected_version for index, item in items}
+    companies = {c["id"]: c["name"] for c in storage.list_companies()}
+    results: Dict[int, Dict[str, Any]] = {}
+    pending_logs: Dict[str, List[tuple]] = {}  # logged once the write has landed
+    pending = list(by_member)
+    
+    for attempt in range(MAX_WRITE_ATTEMPTS):
+        members = {m["id"]: m for m in storage.get_members(pending)}
+        updates = []
+        for member_id in pending:
+            member = members.get(member_id)
+            if member is None:
+                for index, item in by_member[member_id]:
+                    results[index] = {"status": "rejeitado", "detail": "Membro não encontrado"}
+                continue
+            
+            new_version = version_of(member) + 1
+            now = datetime.utcnow()
+            update_data = {"updated_at": now, "version": new_version}
+            logs = pending_logs[member_id] = []
+            for index, item in by_member[member_id]:
+                company_id = item.company_id
+                old_program = member["programs"].get(company_id)
+                if old_program is None:
+                    results[index] = {"status": "rejeitado", "detail": "Programa não encontrado"}
+                    continue
+                
+                # Same rule as update_program: a newer program is only a
+                # conflict when it changed one of the fields sent here
+                update_dict = item.changes.dict(exclude_unset=True, exclude={"expected_version"})
+                program_version = version_of(old_program)
+                if expected[index] is None:
+                    expected[index] = program_version
+                clashes = changed_since(old_program, update_dict, expected[index])
+                if program_version != expected[index] and clashes:
+                    results[index] = {"status": "conflito", "detail": "Registro alterado por outra sessão",
+                                      "fields": clashes, "version": program_version}
+                    continue
+                
+                prefix = f"programs.{company_id}"
+                changes = []
+                for field, new_value in update_dict.items():
+                    old_value = update_data.get(f"{prefix}.{field}", old_program.get(field))
+                    if field in old_program and old_value != new_value:
+                        update_data[f"{prefix}.{field}"] = new_value
+                        update_data[f"{prefix}.field_versions.{field}"] = new_version
+                        changes.append(f"{field}: {old_value} → {new_value}")
+                        logs.append((member["name"], company_id, field, str(old_value), str(new_value)))
+                if changes:
+                    update_data[f"{prefix}.version"] = new_version
+                    update_data[f"{prefix}.last_updated"] = now
+                    update_data[f"{prefix}.last_change"] = ", ".join(changes)
+                    results[index] = {"status": "aplicado", "changes": changes, "version": new_version}
+                else:
+                    results[index] = {"status": "sem alterações", "changes": [],
+                                      "version": update_data.get(f"{prefix}.version", program_version)}
             
-            # Log change
-            log_change(member_id, member["name"], company_id, company_name, 
-                     field, str(old_value), str(new_value))
+            if logs:
+                updates.append({"member_id": member_id, "set_fields": update_data,
+                                "where": version_filter(version_of(member))})
+        
+        outcome = storage.bulk_update_members(updates) if updates else []
+        pending = [u["member_id"] for u, ok in zip(updates, outcome) if not ok]
+        if not pending:
+            break
     
-    # Update timestamps and change info
-    updated_program["last_updated"] = datetime.utcnow()
+    for member_id in pending:
+        pending_logs.pop(member_id, None)
+        for index, item in by_member[member_id]:
+            results[index] = {"status": "conflito", "detail": "Registro alterado por outra sessão"}
+    
+    log_entries = [
+        make_log_entry(member_id, member_name, company_id, companies.get(company_id, company_id),
+                       field, old_value, new_value)
+        for member_id, logs in pending_logs.items()
+        for member_name, company_id, field, old_value, new_value in logs
+    ]
+    if log_entries:
+        storage.insert_logs(log_entries)
+        record_balances(log_entries)
+    
+    response = [{"member_id": item.member_id, "company_id": item.company_id, **results[index]}
+                for index, item in items]
+    applied = sum(result["status"] == "aplicado" for result in response)
+    return {"message": f"{applied} de {len(response)} programas atualizados", "results": response}
+
+# Balance adjustments
+def balance_of(member: Optional[Dict[str, Any]], company_id: str) -> Optional[int]:
+    program = (member or {}).get("programs", {}).get(company_id)
+    return None if program is None else program.get("current_balance", 0) or 0
+
+def balance_update(member: Dict[str, Any], deltas: Dict[str, int], label: str = "") -> Dict[str, Any]:
+    """A bulk_update_members item applying `deltas` ({company_id: points}) with $inc.
+
+    The write is conditioned on the member version that was read, which pins
+    the balances the caller validated: a guarded $inc cannot cross zero even
+    when another session writes in between.
+    """
+    now = datetime.utcnow()
+    new_version = version_of(member) + 1
+    set_fields = {"updated_at": now, "version": new_version}
+    inc_fields = {}
+    for company_id, delta in deltas.items():
+        prefix = f"programs.{company_id}"
+        inc_fields[f"{prefix}.current_balance"] = delta
+        set_fields[f"{prefix}.field_versions.current_balance"] = new_version
+        set_fields[f"{prefix}.version"] = new_version
+        set_fields[f"{prefix}.last_updated"] = now
+        set_fields[f"{prefix}.last_change"] = f"current_balance: {delta:+d}{label}"
+    return {"member_id": member["id"], "set_fields": set_fields, "inc_fields": inc_fields,
+            "where": version_filter(version_of(member))}
+
+PROGRAM_STAMPS = ("version", "last_updated", "last_change", "field_versions")
+_unset = object()
+
+def undo_member_update(member: Dict[str, Any], update: Dict[str, Any], reason: str):
+    """Take back a bulk_update_members item that landed while the rest of its batch did not.
+
+    `member` is the document the item was built from. Every program nobody
+    wrote since gets back the values and stamps the item overwrote; on the
+    others only the $inc is reversed. The member version moves forward either
+    way, and a "rollback" changeset records what went back.
+    """
+    version = update["set_fields"]["version"]
+    now = datetime.utcnow()
+    programs: Dict[str, Dict[str, Any]] = {}  # company_id -> restore/unset/inc for its paths
+    for path in list(update["set_fields"]) + list(update["inc_fields"]):
+        if path.startswith("programs."):
+            programs.setdefault(path.split(".")[1], {"set": {}, "unset": [], "inc": {}})
+    for path in update["set_fields"]:
+        if path.startswith("programs."):
+            old = get_path(member, path, _unset)
+            undo = programs[path.split(".")[1]]
+            if old is _unset:
+                undo["unset"].append(path)
+            else:
+                undo["set"][path] = old
+    for path, delta in update["inc_fields"].items():
+        programs[path.split(".")[1]]["inc"][path] = -delta
+    
+    restored = set()
+    everything = {key: {path: value for undo in programs.values() for path, value in undo[key].items()}
+                  for key in ("set", "inc")}
+    if storage.update_member(member["id"], {**everything["set"], "updated_at": now, "version": version + 1},
+                             [path for undo in programs.values() for path in undo["unset"]],
+                             everything["inc"], where=version_filter(version)):
+        restored = set(programs)
+    else:
+        # Written over since: restore the programs still carrying this write's stamps
+        for company_id, undo in programs.items():
+            if storage.update_member(member["id"], {**undo["set"], "updated_at": now}, undo["unset"],
+                                     {**undo["inc"], "version": 1},
+                                     where={f"programs.{company_id}.version": version}):
+                restored.add(company_id)
+            elif undo["inc"]:
+                storage.update_member(member["id"], {"updated_at": now}, inc_fields={**undo["inc"], "version": 1})
+    current = storage.get_member(member["id"]) or member
+    
+    companies = {c["id"]: c["name"] for c in storage.list_companies()}
+    changes = []
+    for path, value in update["set_fields"].items():
+        parts = path.split(".")
+        # Plain program fields (revert_items sets some); stamps are not logged
+        if len(parts) == 3 and parts[0] == "programs" and parts[2] not in PROGRAM_STAMPS \
+                and parts[1] in restored:
+            changes.append(program_change(member, parts[1], companies, parts[2], value, get_path(member, path, "")))
+    for path, delta in update["inc_fields"].items():
+        company_id = path.split(".")[1]
+        balance = balance_of(current, company_id) or 0
+        changes.append({**program_change(member, company_id, companies, "current_balance",
+                                        balance + delta, balance), "delta": -delta})
     if changes:
-        updated_program["last_change"] = ", ".join(changes)
+        log_changeset(changes, "current_balance" if update["inc_fields"] else changes[0]["field_changed"],
+                      reason, "rollback")
+
+def program_change(member: Dict[str, Any], company_id: str, companies: Dict[str, str], field: str,
+                  old: Any, new: Any) -> Dict[str, Any]:
+    return {"member_id": member["id"], "member_name": member["name"], "company_id": company_id,
+            "company_name": companies.get(company_id, company_id), "field_changed": field,
+            "old_value": str(old), "new_value": str(new)}
+
+@app.post("/api/balances/adjust")
+async def adjust_balances(adjustment: BalanceAdjustment):
+    if not adjustment.deltas:
+        raise HTTPException(status_code=400, detail="Nenhum ajuste informado")
     
-    # Update in database
-    members_collection.update_one(
-        {"id": member_id},
-        {
-            "$set": {
-                f"programs.{company_id}": updated_program,
-                "updated_at": datetime.utcnow()
-            }
-        }
-    )
+    # Net the deltas per program so each one gets a single $inc
+    net: Dict[str, Dict[str, int]] = {}
+    for item in adjustment.deltas:
+        programs = net.setdefault(item.member_id, {})
+        programs[item.company_id] = programs.get(item.company_id, 0) + item.delta
+    
+    companies = {c["id"]: c["name"] for c in storage.list_companies()}
+    errors: Dict[tuple, str] = {}
+    balances: Dict[tuple, tuple] = {}  # (member, company) -> (old, new)
+    names: Dict[str, str] = {}
+    pending = list(net)
+    
+    for attempt in range(MAX_WRITE_ATTEMPTS):
+        members = {m["id"]: m for m in storage.get_members(pending)}
+        updates = []
+        for member_id in pending:
+            member = members.get(member_id)
+            accepted = {}
+            for company_id, delta in net[member_id].items():
+                key = (member_id, company_id)
+                errors.pop(key, None)
+                balance = balance_of(member, company_id)
+                if member is None:
+                    errors[key] = "Membro não encontrado"
+                elif balance is None:
+                    errors[key] = "Programa não encontrado"
+                elif adjustment.prevent_negative and delta < 0 and balance + delta < 0:
+                    errors[key] = "Saldo insuficiente"
+                else:
+                    accepted[company_id] = delta
+                    balances[key] = (balance, balance + delta)
+            if accepted:
+                names[member_id] = member["name"]
+                updates.append(balance_update(member, accepted))
+        
+        results = storage.bulk_update_members(updates) if updates else []
+        pending = [u["member_id"] for u, ok in zip(updates, results) if not ok]
+        if not pending:
+            break
+    
+    for member_id in pending:
+        for company_id in net[member_id]:
+            errors[(member_id, company_id)] = "Registro alterado por outra sessão"
+    
+    changes = []
+    for member_id, programs in net.items():
+        for company_id, delta in programs.items():
+            key = (member_id, company_id)
+            if key in errors or delta == 0:
+                continue
+            old_balance, new_balance = balances[key]
+            changes.append({
+                "member_id": member_id,
+                "member_name": names[member_id],
+                "company_id": company_id,
+                "company_name": companies.get(company_id, company_id),
+                "field_changed": "current_balance",
+                "old_value": str(old_balance),
+                "new_value": str(new_balance),
+                "delta": delta
+            })
+    if changes:
+        summary = f"{len(changes)} saldos ajustados"
+        if adjustment.note:
+            summary += f" ({adjustment.note})"
+        log_changeset(changes, "current_balance", summary)
+    
+    results = []
+    for item in adjustment.deltas:
+        key = (item.member_id, item.company_id)
+        if key in errors:
+            results.append({**item.dict(), "status": "rejeitado", "detail": errors[key]})
+        else:
+            results.append({**item.dict(), "status": "aplicado", "balance": balances[key][1]})
     
-    return {"message": "Programa atualizado com sucesso", "changes": changes}
+    applied = sum(result["status"] == "aplicado" for result in results)
+    return {"message": f"{applied} de {len(results)} ajustes aplicados", "results": results}
+
+@app.post("/api/transfers")
+async def transfer_points(transfer: PointsTransfer):
+    source = (transfer.from_member_id, transfer.from_company_id)
+    target = (transfer.to_member_id, transfer.to_company_id)
+    if transfer.amount <= 0 or transfer.ratio <= 0:
+        raise HTTPException(status_code=400, detail="Quantidade e proporção devem ser positivas")
+    if source == target:
+        raise HTTPException(status_code=400, detail="Origem e destino são o mesmo programa")
+    credited = int(transfer.amount * transfer.ratio)
+    if credited <= 0:
+        raise HTTPException(status_code=400, detail="Transferência não credita nenhum ponto")
+    label = f" (transferência{': ' + transfer.note if transfer.note else ''})"
+    
+    for attempt in range(MAX_WRITE_ATTEMPTS):
+        members = {m["id"]: m for m in storage.get_members([source[0], target[0]])}
+        for member_id, company_id in (source, target):
+            if member_id not in members:
+                raise HTTPException(status_code=404, detail="Membro não encontrado")
+            if balance_of(members[member_id], company_id) is None:
+                raise HTTPException(status_code=404, detail="Programa não encontrado")
+        before = {key: balance_of(members[key[0]], key[1]) for key in (source, target)}
+        if before[source] < transfer.amount:
+            raise HTTPException(status_code=400, detail="Saldo insuficiente")
+        
+        # Both legs in one bulk write; a same-member transfer is a single update
+        legs = {source[0]: {source[1]: -transfer.amount}}
+        legs.setdefault(target[0], {})[target[1]] = credited
+        updates = [balance_update(members[member_id], deltas, label) for member_id, deltas in legs.items()]
+        results = storage.bulk_update_members(updates)
+        if all(results):
+            break
+        
+        # Only one leg landed (the other member changed meanwhile): undo it and retry
+        for update, ok in zip(updates, results):
+            if ok:
+                undo_member_update(members[update["member_id"]], update,
+                                   f"Transferência desfeita: {transfer.amount} → {credited} pontos "
+                                   "(outro membro alterado durante a gravação)")
+    else:
+        raise version_conflict(None, None, [])
+    
+    companies = {c["id"]: c["name"] for c in storage.list_companies()}
+    changes = []
+    for (member_id, company_id), delta in ((source, -transfer.amount), (target, credited)):
+        changes.append({
+            "member_id": member_id,
+            "member_name": members[member_id]["name"],
+            "company_id": company_id,
+            "company_name": companies.get(company_id, company_id),
+            "field_changed": "current_balance",
+            "old_value": str(before[(member_id, company_id)]),
+            "new_value": str(before[(member_id, company_id)] + delta),
+            "delta": delta
+        })
+    summary = f"{transfer.amount} → {credited} pontos"
+    if transfer.note:
+        summary += f" ({transfer.note})"
+    log_changeset(changes, "transferencia", summary)
+    
+    return {
+        "message": "Transferência realizada com sucesso",
+        "debited": transfer.amount,
+        "credited": credited,
+        "from_balance": before[source] - transfer.amount,
+        "to_balance": before[target] + credited
+    }
 
 # Create new member
 class NewMemberData(BaseModel):
@@ -316,34 +1443,12 @@ class NewMemberData(BaseModel):
 
 @app.post("/api/members")
 async def create_member(new_member: NewMemberData):
-    # Check if member with same name already exists
-    existing_member = members_collection.find_one({"name": new_member.name})
-    if existing_member:
-        raise HTTPException(status_code=400, detail="Membro com esse nome já existe")
-    
     # Create new member ID
     member_id = str(uuid.uuid4())
     now = datetime.utcnow()
     
-    # Get all companies to create default programs
-    companies = list(companies_collection.find({}, {"_id": 0}))
-    
     # Create empty program data for each company
-    programs = {}
-    for company in companies:
-        programs[company["id"]] = {
-            "company_id": company["id"],
-            "login": "",
-            "password": "",
-            "cpf": "",
-            "card_number": "",
-            "current_balance": 0,
-            "elite_tier": "",
-            "notes": "",
-            "last_updated": now,
-            "last_change": "Conta criada",
-            "custom_fields": {}
-        }
+    programs = {company["id"]: default_program(company["id"], now) for company in storage.list_companies()}
     
     # Create member data
     member_data = {
@@ -354,8 +1459,12 @@ async def create_member(new_member: NewMemberData):
         "updated_at": now
     }
     
-    # Insert new member
-    members_collection.insert_one(member_data)
+    # Insert new member; the unique name index rejects duplicates
+    # (ignoring case and accents)
+    try:
+        storage.insert_member(member_data)
+    except DuplicateError:
+        raise HTTPException(status_code=400, detail="Membro com esse nome já existe")
     
     # Log the creation
     log_change(member_id, new_member.name, "", "", "membro", "", "criado", "create")
@@ -370,14 +1479,15 @@ async def create_member(new_member: NewMemberData):
 @app.delete("/api/members/{member_id}")
 async def delete_member(member_id: str):
     # Check if member exists
-    member = members_collection.find_one({"id": member_id})
+    member = storage.get_member(member_id)
     if not member:
         raise HTTPException(status_code=404, detail="Membro não encontrado")
     
     # Delete the member
-    result = members_collection.delete_one({"id": member_id})
+    deleted = storage.delete_member(member_id)
     
-    if result.deleted_count == 1:
+    if deleted:
+        storage.delete_lots(member_id=member_id)
         # Log the deletion
         log_change(member_id, member["name"], "", "", "membro", "ativo", "deletado", "delete")
         
@@ -392,52 +1502,18 @@ async def delete_member(member_id: str):
 # Add new company to member
 @app.post("/api/members/{member_id}/companies")
 async def add_company_to_member(member_id: str, new_company: NewCompanyData):
-    member = members_collection.find_one({"id": member_id})
+    member = storage.get_member(member_id)
     if not member:
         raise HTTPException(status_code=404, detail="Membro não encontrado")
     
-    # Create new company ID
-    company_id = str(uuid.uuid4())
-    
-    # Create company entry
-    company_data = {
-        "id": company_id,
-        "name": new_company.company_name,
-        "color": new_company.color
-    }
-    
     # Add to companies collection if it doesn't exist
-    existing_company = companies_collection.find_one({"name": new_company.company_name})
-    if not existing_company:
-        companies_collection.insert_one(company_data)
-    else:
-        company_id = existing_company["id"]
-    
-    # Create default program data for the member
-    default_program = {
-        "company_id": company_id,
-        "login": "",
-        "password": "",
-        "cpf": "",
-        "card_number": "",
-        "current_balance": 0,
-        "elite_tier": "",
-        "notes": "",
-        "last_updated": datetime.utcnow(),
-        "last_change": "Programa criado",
-        "custom_fields": {}
-    }
+    company_id = find_or_create_company(new_company)["id"]
     
     # Add program to member
-    members_collection.update_one(
-        {"id": member_id},
-        {
-            "$set": {
-                f"programs.{company_id}": default_program,
-                "updated_at": datetime.utcnow()
-            }
-        }
-    )
+    storage.update_member(member_id, {
+        f"programs.{company_id}": default_program(company_id, datetime.utcnow(), "Programa criado"),
+        "updated_at": datetime.utcnow()
+    }, inc_fields={"version": 1})
     
     # Log the addition
     log_change(member_id, member["name"], company_id, new_company.company_name, 
@@ -452,28 +1528,43 @@ async def add_company_to_member(member_id: str, new_company: NewCompanyData):
 # Custom fields management
 @app.put("/api/members/{member_id}/programs/{company_id}/fields")
 async def update_custom_fields(member_id: str, company_id: str, custom_fields: Dict[str, Any]):
-    member = members_collection.find_one({"id": member_id})
-    if not member:
-        raise HTTPException(status_code=404, detail="Membro não encontrado")
-    
-    if company_id not in member.get("programs", {}):
-        raise HTTPException(status_code=404, detail="Programa não encontrado")
+    company = storage.get_company(company_id)
+    company_name = company["name"] if company else company_id
+    for name in custom_fields:
+        check_custom_field_name(name)
+    custom_fields = coerce_custom_fields(company, custom_fields)
+    prefix = f"programs.{company_id}"
     
-    # Update custom fields
-    members_collection.update_one(
-        {"id": member_id},
-        {
-            "$set": {
-                f"programs.{company_id}.custom_fields": custom_fields,
-                f"programs.{company_id}.last_updated": datetime.utcnow(),
-                f"programs.{company_id}.last_change": "Campos personalizados atualizados"
-            }
+    for attempt in range(MAX_WRITE_ATTEMPTS):
+        member = storage.get_member(member_id, programs=False)
+        if not member:
+            raise HTTPException(status_code=404, detail="Membro não encontrado")
+        
+        program = storage.get_program(member_id, company_id)
+        if program is None:
+            raise HTTPException(status_code=404, detail="Programa não encontrado")
+        fields = program.get("custom_fields") or {}
+        
+        # Replace the whole map, but stamp only the fields that changed so a
+        # PATCH based on an older version still merges with this one
+        new_version = version_of(member) + 1
+        now = datetime.utcnow()
+        update_data = {
+            f"{prefix}.custom_fields": custom_fields,
+            f"{prefix}.version": new_version,
+            f"{prefix}.last_updated": now,
+            f"{prefix}.last_change": "Campos personalizados atualizados",
+            "updated_at": now,
+            "version": new_version
         }
-    )
-    
-    # Get company name for logging
-    company = companies_collection.find_one({"id": company_id})
-    company_name = company["name"] if company else company_id
+        for name in set(fields) | set(custom_fields):
+            if name not in fields or name not in custom_fields or fields[name] != custom_fields[name]:
+                update_data[f"{prefix}.custom_field_versions.{name}"] = new_version
+        if storage.update_member(member_id, update_data, where=version_filter(version_of(member))):
+            break
+    else:
+        current = storage.get_program(member_id, company_id)
+        raise version_conflict(current, version_of(current), [])
     
     # Log the change
     log_change(member_id, member["name"], company_id, company_name, 
@@ -481,27 +1572,146 @@ async def update_custom_fields(member_id: str, company_id: str, custom_fields: D
     
     return {"message": "Campos personalizados atualizados com sucesso"}
 
+def check_custom_field_name(name: Any) -> str:
+    # Names become path segments (programs.<id>.custom_fields.<name>)
+    if not isinstance(name, str) or not name.strip() or "." in name or name.startswith("$"):
+        raise HTTPException(status_code=400, detail=f"Nome de campo inválido: {name!r}")
+    return name
+
+@app.patch("/api/members/{member_id}/programs/{company_id}/fields")
+async def patch_custom_fields(member_id: str, company_id: str, patch: Dict[str, Any],
+                              response: Response, if_match: Optional[str] = Header(None)):
+    """JSON Merge Patch over custom_fields.
+
+    ``{"campo": "valor"}`` sets a field, ``{"campo": null}`` removes it and
+    ``{"$rename": {"antigo": "novo"}}`` renames one. Only the touched fields
+    are written and each one gets its own log entry.
+    """
+    patch = dict(patch)
+    renames = patch.pop("$rename", None) or {}
+    if not isinstance(renames, dict):
+        raise HTTPException(status_code=400, detail="$rename deve ser um objeto")
+    touched = [check_custom_field_name(name) for name in patch]
+    for old_name, new_name in renames.items():
+        touched += [check_custom_field_name(old_name), check_custom_field_name(new_name)]
+    if len(set(touched)) != len(touched):
+        raise HTTPException(status_code=400, detail="Cada campo só pode ser alterado uma vez por requisição")
+    if not touched:
+        raise HTTPException(status_code=400, detail="Nenhuma alteração informada")
+
+    expected = expected_version(if_match, None)
+    company = storage.get_company(company_id)
+    company_name = company["name"] if company else company_id
+    prefix = f"programs.{company_id}"
+    patch = coerce_custom_fields(company, patch)
+
+    for attempt in range(MAX_WRITE_ATTEMPTS):
+        member = storage.get_member(member_id, programs=False)
+        if not member:
+            raise HTTPException(status_code=404, detail="Membro não encontrado")
+
+        old_program = storage.get_program(member_id, company_id)
+        if old_program is None:
+            raise HTTPException(status_code=404, detail="Programa não encontrado")
+        fields = old_program.get("custom_fields") or {}
+
+        # Same rule as update_program, tracked per custom field
+        program_version = version_of(old_program)
+        if expected is None:
+            expected = program_version
+        if program_version != expected:
+            field_versions = old_program.get("custom_field_versions") or {}
+            clashes = [name for name in touched if field_versions.get(name, 0) > expected]
+            if clashes:
+                raise version_conflict(old_program, program_version, clashes)
+
+        for old_name, new_name in renames.items():
+            if old_name not in fields:
+                raise HTTPException(status_code=404, detail=f"Campo não encontrado: {old_name}")
+            if new_name in fields:
+                raise HTTPException(status_code=400, detail=f"Campo já existe: {new_name}")
+
+        new_version = version_of(member) + 1
+        now = datetime.utcnow()
+        update_data = {"updated_at": now, "version": new_version}
+        unset_fields = []
+        changes = []
+        pending_logs = []
+
+        def touch(name: str, value: Any = None, remove: bool = False):
+            path = f"{prefix}.custom_fields.{name}"
+            if remove:
+                unset_fields.append(path)
+            else:
+                update_data[path] = value
+            update_data[f"{prefix}.custom_field_versions.{name}"] = new_version
+
+        for name, value in patch.items():
+            if value is None:
+                if name not in fields:
+                    continue
+                touch(name, remove=True)
+                changes.append(f"{name} removido")
+                pending_logs.append((f"campo: {name}", fields[name], "", "delete"))
+            elif name not in fields or fields[name] != value:
+                touch(name, value)
+                changes.append(f"{name}: {fields.get(name, '')} → {value}")
+                pending_logs.append((f"campo: {name}", fields.get(name, ""), value,
+                                     "update" if name in fields else "create"))
+
+        # Engines take $set/$unset paths only: a rename moves the value we
+        # read, which the version condition below keeps current
+        for old_name, new_name in renames.items():
+            touch(old_name, remove=True)
+            touch(new_name, coerce_custom_fields(company, {new_name: fields[old_name]})[new_name])
+            changes.append(f"{old_name} → {new_name}")
+            pending_logs.append((f"campo: {old_name}", old_name, new_name, "rename"))
+
+        if not changes:
+            response.headers["ETag"] = etag(program_version)
+            return {"message": "Nenhuma alteração", "changes": [], "version": program_version}
+
+        update_data[f"{prefix}.version"] = new_version
+        update_data[f"{prefix}.last_updated"] = now
+        update_data[f"{prefix}.last_change"] = ", ".join(changes)
+        if storage.update_member(member_id, update_data, unset_fields,
+                                 where=version_filter(version_of(member))):
+            break
+    else:
+        current = storage.get_program(member_id, company_id)
+        raise version_conflict(current, version_of(current), [])
+
+    storage.insert_logs([
+        make_log_entry(member_id, member["name"], company_id, company_name,
+                       field, old_value, new_value, change_type)
+        for field, old_value, new_value, change_type in pending_logs
+    ])
+
+    response.headers["ETag"] = etag(new_version)
+    return {"message": "Campos personalizados atualizados com sucesso", "changes": changes,
+            "version": new_version}
+
 @app.delete("/api/members/{member_id}/programs/{company_id}")
 async def delete_member_program(member_id: str, company_id: str):
-    member = members_collection.find_one({"id": member_id})
+    member = storage.get_member(member_id, programs=False)
     if not member:
         raise HTTPException(status_code=404, detail="Membro não encontrado")
     
-    if company_id not in member.get("programs", {}):
+    if storage.get_program(member_id, company_id) is None:
         raise HTTPException(status_code=404, detail="Programa não encontrado")
     
     # Get company name for logging
-    company = companies_collection.find_one({"id": company_id})
+    company = storage.get_company(company_id)
     company_name = company["name"] if company else company_id
     
     # Remove program from member
-    members_collection.update_one(
-        {"id": member_id},
-        {
-            "$unset": {f"programs.{company_id}": ""},
-            "$set": {"updated_at": datetime.utcnow()}
-        }
+    storage.update_member(
+        member_id,
+        {"updated_at": datetime.utcnow()},
+        [f"programs.{company_id}"],
+        inc_fields={"version": 1}
     )
+    storage.delete_lots(member_id, company_id)
     
     # Log the deletion
     log_change(member_id, member["name"], company_id, company_name, 
@@ -509,34 +1719,354 @@ async def delete_member_program(member_id: str, company_id: str):
     
     return {"message": "Programa removido com sucesso"}
 
+# Per-member and per-program history, newest first. Pages are keyset-paginated
+# on (timestamp, id): `next_cursor` encodes the last entry of the page and the
+# next request continues strictly below it, so every page is an index range read.
+MAX_HISTORY_PAGE = 500
+
+def encode_cursor(entry: Dict[str, Any]) -> str:
+    raw = f"{entry['timestamp'].isoformat()}|{entry['id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        timestamp, log_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+        return datetime.fromisoformat(timestamp), log_id
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
+def history_page(member_id: str, company_id: Optional[str], before: Optional[str], limit: int) -> Dict[str, Any]:
+    if not 1 <= limit <= MAX_HISTORY_PAGE:
+        raise HTTPException(status_code=400, detail=f"O limite deve estar entre 1 e {MAX_HISTORY_PAGE}")
+    # One extra entry tells whether there is a next page
+    entries = storage.member_logs(member_id, company_id, decode_cursor(before) if before else None, limit + 1)
+    return {
+        "entries": entries[:limit],
+        "next_cursor": encode_cursor(entries[limit - 1]) if len(entries) > limit else None
+    }
+
+@app.get("/api/members/{member_id}/history")
+async def get_member_history(member_id: str, before: Optional[str] = None, limit: int = 50):
+    """Every log entry about a member, changesets included. Deleted members keep their history."""
+    return history_page(member_id, None, before, limit)
+
+@app.get("/api/members/{member_id}/programs/{company_id}/history")
+async def get_program_history(member_id: str, company_id: str, before: Optional[str] = None, limit: int = 50):
+    return history_page(member_id, company_id, before, limit)
+
+# Point-in-time state: periodic snapshots of every program's balance and tier,
+# with the log replayed from the nearest one (see replay.py)
+STATE_SNAPSHOT_EVERY = int(os.getenv("STATE_SNAPSHOT_EVERY", "500"))  # log entries
+STATE_SNAPSHOT_HOURS = float(os.getenv("STATE_SNAPSHOT_HOURS", "24"))
+last_state_snapshot: Optional[datetime] = None
+
+def take_state_snapshot() -> Dict[str, Any]:
+    global last_state_snapshot
+    snapshot = {"id": str(uuid.uuid4()), "taken_at": datetime.utcnow(), "state": capture(storage.list_members())}
+    storage.insert_state_snapshot(snapshot)
+    last_state_snapshot = snapshot["taken_at"]
+    return snapshot
+
+def maybe_snapshot_state():
+    """Snapshot when STATE_SNAPSHOT_EVERY entries or STATE_SNAPSHOT_HOURS have passed since the last one."""
+    global last_state_snapshot
+    now = datetime.utcnow()
+    if last_state_snapshot is None:
+        latest = storage.state_snapshot(now)
+        last_state_snapshot = latest["taken_at"] if latest else None
+    if last_state_snapshot is None or now - last_state_snapshot >= timedelta(hours=STATE_SNAPSHOT_HOURS) \
+            or storage.count_logs_since(last_state_snapshot) >= STATE_SNAPSHOT_EVERY:
+        take_state_snapshot()
+
+@app.post("/api/state/snapshots")
+async def create_state_snapshot():
+    snapshot = take_state_snapshot()
+    return {"id": snapshot["id"], "taken_at": snapshot["taken_at"]}
+
+@app.get("/api/state")
+async def get_state_at(at: datetime):
+    """Every program's balance and elite tier as they were at `at`.
+
+    Starts from the latest snapshot taken before `at` and replays the entries
+    since; before the first snapshot it walks back from the oldest one.
+    """
+    at = utc_naive(at)
+    snapshot = storage.state_snapshot(at)
+    if snapshot:
+        entries = storage.logs_between(snapshot["taken_at"], at)
+        state = replay(snapshot["state"], entries)
+    else:
+        snapshot = storage.state_snapshot(at, after=True) or {
+            "taken_at": datetime.utcnow(), "state": capture(storage.list_members())}
+        entries = [e for e in storage.logs_between(at, snapshot["taken_at"]) if e["timestamp"] > at]
+        state = replay(snapshot["state"], entries, forward=False)
+    
+    companies = {c["id"]: c["name"] for c in storage.list_companies()}
+    members = [{
+        "member_id": member_id,
+        "name": member["name"],
+        "total": sum(program["current_balance"] or 0 for program in member["programs"].values()),
+        "programs": [{"company_id": company_id, "company_name": companies.get(company_id, company_id), **program}
+                     for company_id, program in member["programs"].items()]
+    } for member_id, member in state.items()]
+    return {
+        "at": at,
+        "snapshot_taken_at": snapshot["taken_at"],
+        "entries_replayed": len(entries),
+        "total_points": sum(member["total"] for member in members),
+        "members": sorted(members, key=lambda member: member["name"])
+    }
+
+# Reverting one logged change. Balances get the opposite delta, so movements
+# made since are kept; other fields only go back if nothing changed them since.
+REVERTIBLE_FIELDS = ("current_balance", "elite_tier", "login", "password", "cpf", "card_number", "notes")
+
+def revert_items(by_member: Dict[str, List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """Write the inverse of `by_member`'s items; returns log_changeset-style changes."""
+    companies = {c["id"]: c["name"] for c in storage.list_companies()}
+    for attempt in range(MAX_WRITE_ATTEMPTS):
+        members = {m["id"]: m for m in storage.get_members(list(by_member))}
+        updates, changes = [], []
+        for member_id, items in by_member.items():
+            member = members.get(member_id)
+            if member is None:
+                raise HTTPException(status_code=404, detail="Membro não encontrado")
+            deltas, fields = {}, {}
+            for item in items:
+                company_id, field = item["company_id"], item["field_changed"]
+                program = member["programs"].get(company_id)
+                if program is None:
+                    raise HTTPException(status_code=404, detail="Programa não encontrado")
+                if field == "current_balance":
+                    delta = parse_value(field, item["old_value"]) - parse_value(field, item["new_value"])
+                    deltas[company_id] = deltas.get(company_id, 0) + delta
+                elif str(program.get(field, "")) != item["new_value"]:
+                    raise version_conflict(program, version_of(program), [f"{company_id}.{field}"])
+                else:
+                    fields[(company_id, field)] = (program.get(field, ""), item["old_value"])
+            
+            update = balance_update(member, deltas, " (reversão)")
+            
+            for company_id, delta in deltas.items():
+                balance = balance_of(member, company_id)
+                if balance + delta < 0:
+                    raise HTTPException(status_code=400, detail="Saldo insuficiente para reverter")
+                changes.append({**program_change(member, company_id, companies, "current_balance", balance, balance + delta),
+                                "delta": delta})
+            for (company_id, field), (current, value) in fields.items():
+                prefix = f"programs.{company_id}"
+                update["set_fields"].update({
+                    f"{prefix}.{field}": value,
+                    f"{prefix}.field_versions.{field}": update["set_fields"]["version"],
+                    f"{prefix}.version": update["set_fields"]["version"],
+                    f"{prefix}.last_updated": update["set_fields"]["updated_at"],
+                    f"{prefix}.last_change": f"{field}: {current} → {value} (reversão)"
+                })
+                changes.append(program_change(member, company_id, companies, field, current, value))
+            updates.append(update)
+        
+        results = storage.bulk_update_members(updates)
+        if all(results):
+            return changes
+        # Some members changed meanwhile: take back the legs that landed and retry
+        for update, ok in zip(updates, results):
+            if ok:
+                undo_member_update(members[update["member_id"]], update,
+                                   "Reversão desfeita (outro membro alterado durante a gravação)")
+    raise version_conflict(None, None, [])
+
+@app.post("/api/global-log/{log_id}/revert")
+async def revert_change(log_id: str):
+    entry = storage.get_log(log_id)
+    if not entry:
+        raise HTTPException(status_code=404, detail="Registro não encontrado")
+    if entry.get("reverted_by"):
+        raise HTTPException(status_code=409, detail="Esta alteração já foi revertida")
+    if entry.get("archived_at"):
+        raise HTTPException(status_code=400, detail="Alterações arquivadas não podem ser revertidas")
+    items = entry_items(entry)
+    if entry.get("merged_company_id") or entry.get("change_type") == "rollback" or any(
+            not item.get("member_id") or not item.get("company_id")
+            or item.get("field_changed") not in REVERTIBLE_FIELDS for item in items):
+        raise HTTPException(status_code=400, detail="Esta alteração não pode ser revertida")
+    
+    by_member: Dict[str, List[Dict[str, Any]]] = {}
+    for item in items:
+        by_member.setdefault(item["member_id"], []).append(item)
+    # Claimed first, so two concurrent reverts cannot both apply
+    revert_id = str(uuid.uuid4())
+    if not storage.claim_log_revert(log_id, revert_id):
+        raise HTTPException(status_code=409, detail="Esta alteração já foi revertida")
+    try:
+        changes = revert_items(by_member)
+    except HTTPException:
+        storage.release_log_revert(log_id)
+        raise
+    
+    if entry.get("changes"):
+        summary = f"Reversão: {entry['new_value']}"
+    else:
+        summary = f"Reversão: {entry['new_value']} → {entry['old_value']}"
+    log_changeset(changes, entry["field_changed"], summary, "revert", extra={"id": revert_id, "reverts": log_id})
+    return {"message": "Alteração revertida com sucesso", "revert_id": revert_id, "changes": changes}
+
+# Log retention: entries older than LOG_RETENTION_DAYS move to the archive
+# tier, which history, state and activity queries still read. The
+# maintenance loop archives hourly, in batches of LOG_ARCHIVE_BATCH so other
+# writes get in between.
+LOG_RETENTION_DAYS = int(os.getenv("LOG_RETENTION_DAYS", "365"))  # 0 keeps everything live
+LOG_ARCHIVE_BATCH = int(os.getenv("LOG_ARCHIVE_BATCH", "1000"))
+LOG_ARCHIVE_INTERVAL = timedelta(hours=1)
+next_log_archive = datetime.min
+
+def archive_old_logs() -> int:
+    """Archive entries past the retention period; returns how many moved."""
+    if LOG_RETENTION_DAYS <= 0:
+        return 0
+    cutoff = datetime.utcnow() - timedelta(days=LOG_RETENTION_DAYS)
+    archived = 0
+    while True:
+        moved = storage.archive_logs(cutoff, LOG_ARCHIVE_BATCH)
+        archived += moved
+        if moved < LOG_ARCHIVE_BATCH:
+            return archived
+
+def maybe_archive_logs():
+    global next_log_archive
+    now = datetime.utcnow()
+    if now >= next_log_archive:
+        archive_old_logs()
+        next_log_archive = now + LOG_ARCHIVE_INTERVAL
+
+@app.post("/api/logs/archive")
+async def archive_logs_now():
+    if LOG_RETENTION_DAYS <= 0:
+        raise HTTPException(status_code=400, detail="Retenção de registros desativada (LOG_RETENTION_DAYS=0)")
+    return {"archived": await run_in_threadpool(archive_old_logs), "retention_days": LOG_RETENTION_DAYS}
+
+# Expiring lots: one record per batch of points and the day it expires
+def sync_next_expiry(member_id: str, company_id: str) -> Dict[str, Any]:
+    """Recompute the program's next_expiry fields from its lots."""
+    lots = [lot for lot in storage.program_lots(member_id, company_id) if lot["expires_on"] >= today()]
+    next_expiry = lots[0]["expires_on"] if lots else None
+    fields = {
+        "next_expiry": next_expiry,
+        "next_expiry_amount": sum(lot["amount"] for lot in lots if lot["expires_on"] == next_expiry)
+    }
+    prefix = f"programs.{company_id}"
+    storage.update_member(member_id, {**{f"{prefix}.{k}": v for k, v in fields.items()},
+                                      "updated_at": datetime.utcnow()},
+                          inc_fields={"version": 1}, where={prefix: {"$exists": True}})
+    return fields
+
+expiries_checked_through: Optional[str] = None  # last day whose expired lots were synced
+
+def refresh_passed_expiries():
+    """Daily: recompute next_expiry on programs whose next lot expired since the last run."""
+    global expiries_checked_through
+    yesterday = (datetime.utcnow().date() - timedelta(days=1)).isoformat()
+    if expiries_checked_through == yesterday:
+        return
+    since = (date.fromisoformat(expiries_checked_through) + timedelta(days=1)).isoformat() \
+        if expiries_checked_through else None
+    for member_id, company_id in {(lot["member_id"], lot["company_id"])
+                                  for lot in storage.lots_expiring(since, yesterday)}:
+        program = storage.get_program(member_id, company_id)
+        if program and program.get("next_expiry") and program["next_expiry"] <= yesterday:
+            sync_next_expiry(member_id, company_id)
+    expiries_checked_through = yesterday
+
+MAINTENANCE_TASKS = (maybe_snapshot_state, maybe_archive_logs, refresh_passed_expiries)
+
+@app.get("/api/members/{member_id}/programs/{company_id}/lots")
+async def get_program_lots(member_id: str, company_id: str):
+    if storage.get_program(member_id, company_id) is None:
+        raise HTTPException(status_code=404, detail="Programa não encontrado")
+    return storage.program_lots(member_id, company_id)
+
+@app.post("/api/members/{member_id}/programs/{company_id}/lots")
+async def add_program_lot(member_id: str, company_id: str, lot: ExpiringLot):
+    if lot.amount <= 0:
+        raise HTTPException(status_code=400, detail="A quantidade de pontos deve ser positiva")
+    member = storage.get_member(member_id, programs=False)
+    if not member:
+        raise HTTPException(status_code=404, detail="Membro não encontrado")
+    if storage.get_program(member_id, company_id) is None:
+        raise HTTPException(status_code=404, detail="Programa não encontrado")
+    company = storage.get_company(company_id)
+    company_name = company["name"] if company else company_id
+    
+    record = {
+        "id": str(uuid.uuid4()),
+        "member_id": member_id,
+        "company_id": company_id,
+        "amount": lot.amount,
+        "expires_on": lot.expires_on.isoformat(),
+        "note": lot.note,
+        "created_at": datetime.utcnow()
+    }
+    storage.insert_lot(record)
+    fields = sync_next_expiry(member_id, company_id)
+    log_change(member_id, member["name"], company_id, company_name, "pontos_expirando", "",
+               f"{lot.amount} em {record['expires_on']}", "create")
+    return {"message": "Lote de pontos adicionado com sucesso", "lot": record, **fields}
+
+@app.delete("/api/members/{member_id}/programs/{company_id}/lots/{lot_id}")
+async def delete_program_lot(member_id: str, company_id: str, lot_id: str):
+    lot = storage.get_lot(lot_id)
+    if not lot or lot["member_id"] != member_id or lot["company_id"] != company_id:
+        raise HTTPException(status_code=404, detail="Lote de pontos não encontrado")
+    member = storage.get_member(member_id, programs=False)
+    company = storage.get_company(company_id)
+    storage.delete_lot(lot_id)
+    fields = sync_next_expiry(member_id, company_id)
+    log_change(member_id, member["name"] if member else "", company_id,
+               company["name"] if company else company_id, "pontos_expirando",
+               f"{lot['amount']} em {lot['expires_on']}", "removido", "delete")
+    return {"message": "Lote de pontos removido com sucesso", **fields}
+
+@app.get("/api/expiring")
+async def get_expiring_points(days: int = 90):
+    """Every lot across the family expiring from today through `days` days ahead, soonest first."""
+    if days < 0:
+        raise HTTPException(status_code=400, detail="Informe um número de dias válido")
+    since = datetime.utcnow().date()
+    until = since + timedelta(days=days)
+    lots = storage.lots_expiring(since.isoformat(), until.isoformat())
+    members = {m["id"]: m["name"] for m in storage.get_members({lot["member_id"] for lot in lots})}
+    companies = {c["id"]: c["name"] for c in storage.list_companies()}
+    return {
+        "since": since,
+        "until": until,
+        "total_amount": sum(lot["amount"] for lot in lots),
+        "lots": [{
+            **lot,
+            "member_name": members.get(lot["member_id"], ""),
+            "company_name": companies.get(lot["company_id"], lot["company_id"]),
+            "days_left": (date.fromisoformat(lot["expires_on"]) - since).days
+        } for lot in lots]
+    }
+
 # Global log endpoint
 @app.get("/api/global-log")
 async def get_global_log(limit: int = 50):
-    log_entries = list(global_log_collection.find(
-        {}, 
-        {"_id": 0}
-    ).sort("timestamp", -1).limit(limit))
+    log_entries = storage.recent_logs(limit)
     
     return log_entries
 
 # Dashboard stats
 @app.get("/api/dashboard/stats")
 async def get_dashboard_stats():
-    total_members = members_collection.count_documents({})
-    total_companies = companies_collection.count_documents({})
+    total_members = storage.count_members()
+    total_companies = storage.count_companies()
     
     # Calculate total points across all programs
-    total_points = 0
-    members = list(members_collection.find({}, {"programs": 1}))
-    
-    for member in members:
-        for program in member.get("programs", {}).values():
-            total_points += program.get("current_balance", 0)
+    total_points = storage.total_points()
     
     # Get recent activity count
-    recent_logs = global_log_collection.count_documents({
-        "timestamp": {"$gte": datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)}
-    })
+    recent_logs = storage.count_logs_since(
+        datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    )
     
     return {
         "total_members": total_members,
@@ -545,15 +2075,306 @@ async def get_dashboard_stats():
         "recent_activity": recent_logs
     }
 
+# Activity histogram. Log entries are only ever written at "now", so a bucket
+# that has ended never changes: closed buckets are cached per (unit, breakdown)
+# and only the open one (and any not seen yet) goes to the database.
+ACTIVITY_BREAKDOWNS = {"member": "member_id", "company": "company_id", "change_type": "change_type"}
+ACTIVITY_DEFAULT_SPAN = {"hour": timedelta(hours=48), "day": timedelta(days=30), "week": timedelta(weeks=26)}
+MAX_ACTIVITY_BUCKETS = 1000
+MAX_CACHED_BUCKETS = 20000
+activity_cache: Dict[tuple, Dict[datetime, Dict[str, int]]] = {}
+
+def activity_buckets(unit: str, by: Optional[str], starts: List[datetime]) -> Dict[datetime, Dict[str, int]]:
+    """Counts per key for each bucket start, from the cache where the bucket is closed."""
+    now = datetime.utcnow()
+    closed = activity_cache.setdefault((unit, by), {})
+    missing = [start for start in starts if start not in closed]
+    fresh: Dict[datetime, Dict[str, int]] = {start: {} for start in missing}
+    if missing:
+        for row in storage.activity_counts(missing[0], next_bucket(missing[-1], unit), unit,
+                                           ACTIVITY_BREAKDOWNS.get(by)):
+            bucket, key = fresh.get(row["bucket"]), row["key"] or ""
+            if bucket is not None:
+                bucket[key] = bucket.get(key, 0) + row["count"]
+        if sum(map(len, activity_cache.values())) > MAX_CACHED_BUCKETS:
+            closed.clear()
+        closed.update({start: counts for start, counts in fresh.items() if next_bucket(start, unit) <= now})
+    return {start: fresh[start] if start in fresh else closed[start] for start in starts}
+
+@app.get("/api/activity")
+async def get_activity(unit: str = "day", by: Optional[str] = None,
+                       since: Optional[datetime] = None, until: Optional[datetime] = None):
+    """Log entries per hour, day or week (UTC, weeks from Monday), optionally per
+    member, company or change_type. The range is widened to whole buckets."""
+    if unit not in ACTIVITY_UNITS:
+        raise HTTPException(status_code=400, detail="Unidade inválida (use hour, day ou week)")
+    if by is not None and by not in ACTIVITY_BREAKDOWNS:
+        raise HTTPException(status_code=400, detail="Agrupamento inválido (use member, company ou change_type)")
+    until = utc_naive(until) or datetime.utcnow()
+    since = utc_naive(since) or until - ACTIVITY_DEFAULT_SPAN[unit]
+    if since > until:
+        raise HTTPException(status_code=400, detail="Período inválido")
+    
+    starts = [truncate(since, unit)]
+    while next_bucket(starts[-1], unit) <= until:
+        starts.append(next_bucket(starts[-1], unit))
+        if len(starts) > MAX_ACTIVITY_BUCKETS:
+            raise HTTPException(status_code=400,
+                                detail=f"Período longo demais: máximo de {MAX_ACTIVITY_BUCKETS} intervalos")
+    counts = activity_buckets(unit, by, starts)
+    
+    labels = {}
+    if by == "member":
+        labels = {m["id"]: m["name"] for m in storage.list_members()}
+    elif by == "company":
+        labels = {c["id"]: c["name"] for c in storage.list_companies()}
+    keys = sorted({key for bucket in counts.values() for key in bucket})
+    return {
+        "unit": unit,
+        "by": by,
+        "since": starts[0],
+        "until": next_bucket(starts[-1], unit),
+        "total": sum(sum(bucket.values()) for bucket in counts.values()),
+        "keys": [{"key": key, "label": labels.get(key, key)} for key in keys] if by else [],
+        "buckets": [{
+            "start": start,
+            "total": sum(counts[start].values()),
+            "counts": counts[start] if by else {}
+        } for start in starts]
+    }
+
+# Portfolio analytics
+def balance_matrix() -> BalanceMatrix:
+    return cached("balance_matrix", data_version,
+                  lambda: BalanceMatrix(storage.list_members(), storage.list_companies()))
+
+@app.get("/api/analytics")
+async def get_analytics():
+    """Totals, shares and rankings per member, company and elite tier."""
+    summary = cached("analytics", data_version, lambda: summarize(balance_matrix()))
+    return {"data_version": data_version, **summary}
+
+# Valuation: BRL per 1,000 points per company, each rate valid from its
+# effective date until the next one
+rate_version = 0
+
+@app.get("/api/valuation/rates")
+async def get_valuation_rates():
+    return {company["id"]: company.get("valuation_rates") or [] for company in storage.list_companies()}
+
+@app.put("/api/companies/{company_id}/rates")
+async def set_valuation_rate(company_id: str, rate: ValuationRate):
+    """Add a rate, or replace the one with the same effective date."""
+    global rate_version
+    if rate.brl_per_1000 < 0:
+        raise HTTPException(status_code=400, detail="Valor do milheiro inválido")
+    company = storage.get_company(company_id)
+    if not company:
+        raise HTTPException(status_code=404, detail="Companhia não encontrada")
+    day = rate.effective_from.isoformat()
+    rates = [r for r in company.get("valuation_rates") or [] if r["effective_from"] != day]
+    rates.append({"effective_from": day, "brl_per_1000": rate.brl_per_1000})
+    rates.sort(key=lambda r: r["effective_from"])
+    storage.update_company(company_id, {"valuation_rates": rates})
+    rate_version += 1
+    log_change("", "", company_id, company["name"], "valor_milheiro", day, str(rate.brl_per_1000))
+    return {"message": "Valor do milheiro atualizado com sucesso", "rates": rates}
+
+@app.delete("/api/companies/{company_id}/rates/{effective_from}")
+async def delete_valuation_rate(company_id: str, effective_from: date):
+    global rate_version
+    company = storage.get_company(company_id)
+    if not company:
+        raise HTTPException(status_code=404, detail="Companhia não encontrada")
+    day = effective_from.isoformat()
+    rates = company.get("valuation_rates") or []
+    remaining = [r for r in rates if r["effective_from"] != day]
+    if len(remaining) == len(rates):
+        raise HTTPException(status_code=404, detail="Valor do milheiro não encontrado")
+    storage.update_company(company_id, {"valuation_rates": remaining})
+    rate_version += 1
+    log_change("", "", company_id, company["name"], "valor_milheiro", day, "removido", "delete")
+    return {"message": "Valor do milheiro removido com sucesso", "rates": remaining}
+
+VALUATION_CACHE_SIZE = 32
+
+@app.get("/api/valuation")
+async def get_valuation(on: Optional[date] = None):
+    """Current holdings in BRL, at the rates in effect on `on` (default today)."""
+    day = (on or datetime.utcnow().date()).isoformat()
+    
+    def compute():
+        matrix = balance_matrix()
+        return valuate(matrix, rate_vector(matrix, storage.list_companies(), day))
+    
+    # Keyed per day too, so alternating dates don't evict each other
+    result = cached("valuation", (data_version, rate_version, day), compute, VALUATION_CACHE_SIZE)
+    return {"on": day, **result}
+
+# Award planner
+PLANNER_BUDGET_MS = int(os.getenv("PLANNER_BUDGET_MS", "250"))
+MAX_AWARD_SEATS = 20
+
+def balance_snapshot() -> tuple:
+    """Every held program as (member_id, company_id, balance), hashable for memoization."""
+    def compute():
+        matrix = balance_matrix()
+        return tuple((matrix.member_ids[i], matrix.company_ids[j], int(matrix.balances[i, j]))
+                     for i, j in zip(*matrix.held.nonzero()))
+    return cached("balance_snapshot", data_version, compute)
+
+@app.post("/api/planner/awards")
+async def plan_award(request: AwardPlanRequest):
+    """Ways to book `seats` x an award from the family's balances, fewest transfers first."""
+    if not request.options:
+        raise HTTPException(status_code=400, detail="Informe ao menos uma opção de resgate")
+    if not 1 <= request.seats <= MAX_AWARD_SEATS or not 1 <= request.max_plans <= 50:
+        raise HTTPException(status_code=400, detail="Quantidade de assentos ou de planos inválida")
+    if any(option.points <= 0 for option in request.options) or \
+            any(edge.ratio <= 0 or edge.block < 1 for edge in request.transfers or []):
+        raise HTTPException(status_code=400, detail="Custos, proporções e blocos devem ser positivos")
+    
+    plans, complete = plan_awards(
+        balance_snapshot(),
+        tuple((option.company_id, option.points) for option in request.options),
+        request.seats,
+        tuple((e.from_company_id, e.to_company_id, e.ratio, e.block, e.between_members)
+              for e in request.transfers) if request.transfers is not None else
+        tuple((*edge, False) for edge in partner_edges(storage.list_companies(), today())),
+        request.max_plans,
+        PLANNER_BUDGET_MS,
+    )
+    names = dict(zip(balance_matrix().member_ids, balance_matrix().member_names))
+    return {
+        "complete": complete,
+        "plans": [{
+            **plan,
+            "payers": [{**payer, "name": names.get(payer["member_id"], "")} for payer in plan["payers"]],
+            "transfer_count": len(plan["transfers"])
+        } for plan in plans]
+    }
+
+# Transfer-partner graph
+graph_version = 0
+
+def today() -> str:
+    return datetime.utcnow().date().isoformat()
+
+def drop_partner_edges(company_id: str, into: Optional[str] = None):
+    """Remove every edge pointing at a company that is going away, or re-point it
+    at `into` when the company is merged (an edge already reaching `into` wins)."""
+    global graph_version
+    for company in storage.list_companies():
+        partners = company.get("transfer_partners") or []
+        if company["id"] == company_id or not any(p["to_company_id"] == company_id for p in partners):
+            continue
+        kept = [p for p in partners if p["to_company_id"] != company_id]
+        reached = {p["to_company_id"] for p in kept} | {company["id"]}
+        if into is not None and into not in reached:
+            edge = next(p for p in partners if p["to_company_id"] == company_id)
+            kept.append({**edge, "to_company_id": into})
+        storage.update_company(company["id"], {"transfer_partners": kept})
+        graph_version += 1
+
+@app.get("/api/transfer-partners")
+async def get_transfer_partners():
+    return [
+        {"from_company_id": company["id"], **partner}
+        for company in storage.list_companies()
+        for partner in company.get("transfer_partners") or []
+    ]
+
+@app.put("/api/companies/{company_id}/partners/{to_company_id}")
+async def set_transfer_partner(company_id: str, to_company_id: str, partner: TransferPartner):
+    """Add or replace the edge `company_id` -> `to_company_id`."""
+    global graph_version
+    if partner.ratio <= 0 or partner.block < 1 or partner.bonus < 0:
+        raise HTTPException(status_code=400, detail="Proporção, bônus ou bloco inválido")
+    if company_id == to_company_id:
+        raise HTTPException(status_code=400, detail="Origem e destino são a mesma companhia")
+    company = storage.get_company(company_id)
+    if not company or not storage.get_company(to_company_id):
+        raise HTTPException(status_code=404, detail="Companhia não encontrada")
+    edge = {
+        "to_company_id": to_company_id,
+        "ratio": partner.ratio,
+        "bonus": partner.bonus,
+        "bonus_until": partner.bonus_until.isoformat() if partner.bonus_until else None,
+        "block": partner.block
+    }
+    partners = [p for p in company.get("transfer_partners") or [] if p["to_company_id"] != to_company_id]
+    storage.update_company(company_id, {"transfer_partners": partners + [edge]})
+    graph_version += 1
+    log_change("", "", company_id, company["name"], "parceiro", to_company_id,
+               f"{partner.ratio} (+{partner.bonus:g}%)")
+    return {"message": "Parceiro de transferência salvo com sucesso", "partner": edge}
+
+@app.delete("/api/companies/{company_id}/partners/{to_company_id}")
+async def delete_transfer_partner(company_id: str, to_company_id: str):
+    global graph_version
+    company = storage.get_company(company_id)
+    if not company:
+        raise HTTPException(status_code=404, detail="Companhia não encontrada")
+    partners = company.get("transfer_partners") or []
+    kept = [p for p in partners if p["to_company_id"] != to_company_id]
+    if len(kept) == len(partners):
+        raise HTTPException(status_code=404, detail="Parceiro de transferência não encontrado")
+    storage.update_company(company_id, {"transfer_partners": kept})
+    graph_version += 1
+    log_change("", "", company_id, company["name"], "parceiro", to_company_id, "removido", "delete")
+    return {"message": "Parceiro de transferência removido com sucesso"}
+
+def partner_paths() -> Dict[tuple, list]:
+    day = today()
+    return cached("partner_paths", (graph_version, day),
+                  lambda: simple_paths(partner_edges(storage.list_companies(), day)))
+
+CONVERSIONS_CACHE_SIZE = 64  # one entry per (company, member) asked about at this data version
+
+@app.get("/api/conversions/{company_id}")
+async def get_conversions(company_id: str, member_id: Optional[str] = None):
+    """Best route from every held program into `company_id`, and what it would yield."""
+    if not storage.get_company(company_id):
+        raise HTTPException(status_code=404, detail="Companhia não encontrada")
+    
+    def compute():
+        paths = partner_paths()
+        matrix = balance_matrix()
+        routes = []
+        for i, j in zip(*matrix.held.nonzero()):
+            source, balance = matrix.company_ids[j], int(matrix.balances[i, j])
+            if source == company_id or balance <= 0 or (member_id and matrix.member_ids[i] != member_id):
+                continue
+            best = best_route(paths.get((source, company_id), []), balance)
+            if best is None:
+                continue
+            path, steps = best
+            routes.append({
+                "member_id": matrix.member_ids[i],
+                "name": matrix.member_names[i],
+                "from_company_id": source,
+                "balance": balance,
+                "path": [source] + [edge[1] for edge in path],
+                "ratio": round(path_ratio(path), 4),
+                "obtained": steps[-1]["credited"],
+                "steps": steps
+            })
+        routes.sort(key=lambda route: -route["obtained"])
+        return {"total_obtainable": sum(route["obtained"] for route in routes), "routes": routes}
+    
+    result = cached("conversions", (data_version, graph_version, today(), company_id, member_id), compute,
+                    CONVERSIONS_CACHE_SIZE)
+    return {"company_id": company_id, **result}
+
 # Health check
 @app.get("/api/health")
 async def health_check():
-    return {"status": "healthy", "timestamp": datetime.utcnow()}
+    return {"status": "healthy", "timestamp": datetime.utcnow(), "storage": storage.status()}
 
 # Post-it endpoints
 @app.get("/api/postits", response_model=List[PostIt])
 async def get_postits():
-    postits = list(postits_collection.find({}, {"_id": 0}).sort("created_at", 1))
+    postits = storage.list_postits()
     return postits
 
 @app.post("/api/postits", response_model=PostIt)
@@ -568,12 +2389,12 @@ async def create_postit(postit: PostItCreate):
         "updated_at": now
     }
     
-    postits_collection.insert_one(postit_data)
+    storage.insert_postit(postit_data)
     return PostIt(**postit_data)
 
 @app.put("/api/postits/{postit_id}", response_model=PostIt)
 async def update_postit(postit_id: str, postit_update: PostItUpdate):
-    postit = postits_collection.find_one({"id": postit_id})
+    postit = storage.get_postit(postit_id)
     if not postit:
         raise HTTPException(status_code=404, detail="Post-it não encontrado")
     
@@ -582,18 +2403,14 @@ async def update_postit(postit_id: str, postit_update: PostItUpdate):
         "updated_at": datetime.utcnow()
     }
     
-    postits_collection.update_one(
-        {"id": postit_id},
-        {"$set": update_data}
-    )
+    storage.update_postit(postit_id, update_data)
     
-    updated_postit = postits_collection.find_one({"id": postit_id}, {"_id": 0})
+    updated_postit = storage.get_postit(postit_id)
     return PostIt(**updated_postit)
 
 @app.delete("/api/postits/{postit_id}")
 async def delete_postit(postit_id: str):
-    result = postits_collection.delete_one({"id": postit_id})
-    if result.deleted_count == 0:
+    if not storage.delete_postit(postit_id):
         raise HTTPException(status_code=404, detail="Post-it não encontrado")
     
     return {"message": "Post-it excluído com sucesso"}
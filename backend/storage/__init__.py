@@ -0,0 +1,46 @@
+"""Pluggable storage engines for the API.
+
+Select one with the ``STORAGE_ENGINE`` environment variable:
+
+* ``mongo`` (default) - MongoDB at ``MONGO_URL``/``DB_NAME``; set
+  ``MONGO_OFFLINE_JOURNAL`` to a file path to keep accepting writes while
+  Mongo is unreachable (see storage/offline.py)
+* ``memory`` - in-process, nothing persisted
+* ``journal`` - in-process with an fsync-batched journal and snapshots under
+  ``STORAGE_PATH`` (point it at the Fly volume)
+* ``sqlite`` - normalized SQLite database in WAL mode at ``SQLITE_PATH``
+  (default ``$STORAGE_PATH/milhas.db``)
+"""
+import os
+
+from .base import DuplicateError, Storage
+from .journal import JournalStorage
+from .memory import MemoryStorage
+from .sqlite import SQLiteStorage
+
+ENGINES = ("mongo", "memory", "journal", "sqlite")
+
+
+def create_storage(engine: str = None) -> Storage:
+    engine = (engine or os.getenv("STORAGE_ENGINE") or "mongo").lower()
+    if engine == "memory":
+        return MemoryStorage()
+    if engine == "journal":
+        return JournalStorage()
+    if engine == "sqlite":
+        return SQLiteStorage()
+    if engine == "mongo":
+        # Imported lazily so the other engines run without pymongo installed
+        from .mongo import MongoStorage
+        journal_path = os.getenv("MONGO_OFFLINE_JOURNAL")
+        if journal_path:
+            from .offline import OfflineJournalStorage
+            timeout_ms = int(os.getenv("MONGO_TIMEOUT_MS", "2000"))
+            primary = MongoStorage(serverSelectionTimeoutMS=timeout_ms,
+                                   connectTimeoutMS=timeout_ms, socketTimeoutMS=timeout_ms)
+            return OfflineJournalStorage(primary, journal_path)
+        return MongoStorage()
+    raise ValueError(f"Unknown STORAGE_ENGINE {engine!r}; expected one of {ENGINES}")
+
+
+__all__ = ["DuplicateError", "ENGINES", "JournalStorage", "MemoryStorage", "SQLiteStorage", "Storage", "create_storage"]
@@ -0,0 +1,272 @@
+"""Repository interface every API endpoint goes through.
+
+Documents keep the exact shape the API has always exposed (members with an
+embedded ``programs`` map, flat log entries, post-its), so engines are free to
+store them however they like as long as they hand back plain dicts without
+Mongo's ``_id``.
+"""
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+
+class DuplicateError(ValueError):
+    """A write would break a unique constraint (e.g. a company name)."""
+
+
+class Storage:
+    """Abstract storage engine.
+
+    Member updates use dotted paths (``programs.<company_id>.<field>``) for
+    ``set_fields``/``unset_fields``/``inc_fields``/``where`` so the same payload
+    works on every engine.
+    """
+
+    name = "abstract"
+
+    def close(self) -> None:
+        """Flush and release resources; called on application shutdown."""
+
+    def ensure_indexes(self) -> None:
+        """Create the indexes/schema the engine relies on (idempotent)."""
+
+    def status(self) -> Dict[str, Any]:
+        """Engine details reported by the health check."""
+        return {"engine": self.name}
+
+    # Companies
+    def list_companies(self) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def get_company(self, company_id: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def find_company_by_name(self, name: str) -> Optional[Dict[str, Any]]:
+        """Match on ``names.name_key``, so "Tudo Azul" finds "TudoAzul"."""
+        raise NotImplementedError
+
+    def insert_company(self, company: Dict[str, Any]) -> None:
+        """Raises DuplicateError when the normalized name is taken."""
+        raise NotImplementedError
+
+    def update_company(self, company_id: str, set_fields: Dict[str, Any]) -> bool:
+        """Raises DuplicateError when renaming onto a taken normalized name."""
+        raise NotImplementedError
+
+    def delete_company(self, company_id: str) -> bool:
+        """Delete the company document only; programs are removed by the caller."""
+        raise NotImplementedError
+
+    def count_companies(self) -> int:
+        return len(self.list_companies())
+
+    # Members
+    def list_members(self) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def get_member(self, member_id: str, programs: bool = True) -> Optional[Dict[str, Any]]:
+        """The member document; ``programs=False`` leaves out the programs map."""
+        raise NotImplementedError
+
+    def get_members(self, member_ids: Iterable[str]) -> List[Dict[str, Any]]:
+        """Several members in one round trip; unknown ids are skipped."""
+        wanted = set(member_ids)
+        return [member for member in self.list_members() if member["id"] in wanted]
+
+    def find_member_by_name(self, name: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def insert_member(self, member: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def update_member(self, member_id: str, set_fields: Dict[str, Any] = None,
+                      unset_fields: Iterable[str] = (), inc_fields: Dict[str, Any] = None,
+                      where: Dict[str, Any] = None) -> bool:
+        """Apply a partial update atomically.
+
+        ``where`` is a Mongo-style filter on the member document (see
+        ``paths.matches``); returns False when the member is missing or the
+        filter does not match, in which case nothing is written.
+        """
+        raise NotImplementedError
+
+    def bulk_update_members(self, updates: List[Dict[str, Any]]) -> List[bool]:
+        """Apply many ``update_member`` calls, batched where the engine can.
+
+        MongoDB's embedded layout sends them as one ``bulk_write``; the
+        in-process engines and the normalized layout apply them in turn.
+
+        Each item is a dict with ``member_id`` and any of ``set_fields``,
+        ``unset_fields``, ``inc_fields`` and ``where``; at most one item per
+        member. Items succeed or fail independently (each one atomically);
+        returns one matched flag per item.
+        """
+        return [
+            self.update_member(u["member_id"], u.get("set_fields"), u.get("unset_fields", ()),
+                               u.get("inc_fields"), u.get("where"))
+            for u in updates
+        ]
+
+    def update_members(self, set_fields: Dict[str, Any] = None, unset_fields: Iterable[str] = (),
+                       inc_fields: Dict[str, Any] = None, where: Dict[str, Any] = None) -> int:
+        """Apply one update to every member matching ``where`` (``update_many``).
+
+        Each member is updated atomically, the set as a whole is not. Returns
+        the number of members matched.
+        """
+        return sum(
+            self.update_member(member["id"], set_fields, unset_fields, inc_fields, where)
+            for member in self.list_members()
+        )
+
+    def delete_member(self, member_id: str) -> bool:
+        raise NotImplementedError
+
+    # Programs
+    def get_program(self, member_id: str, company_id: str) -> Optional[Dict[str, Any]]:
+        member = self.get_member(member_id)
+        return member["programs"].get(company_id) if member else None
+
+    def list_programs_for_company(self, company_id: str) -> List[Dict[str, Any]]:
+        """Every member's program for ``company_id``, each tagged with ``member_id``."""
+        return [
+            {**member["programs"][company_id], "member_id": member["id"]}
+            for member in self.list_members()
+            if company_id in member.get("programs", {})
+        ]
+
+    def count_members(self) -> int:
+        return len(self.list_members())
+
+    def total_points(self) -> int:
+        return sum(
+            program.get("current_balance", 0) or 0
+            for member in self.list_members()
+            for program in member.get("programs", {}).values()
+        )
+
+    # Global log. Entries older than the retention period move to an archive
+    # (``archive_logs``); get_log, logs_between, count_logs_since, member_logs
+    # and activity_counts read both tiers, the rest only the live one.
+    def insert_log(self, entry: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def insert_logs(self, entries: List[Dict[str, Any]]) -> None:
+        """Insert a batch of log entries in one round trip."""
+        for entry in entries:
+            self.insert_log(entry)
+
+    def recent_logs(self, limit: int = 50) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def get_log(self, log_id: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def logs_between(self, since: datetime, until: datetime) -> List[Dict[str, Any]]:
+        """Entries with ``since <= timestamp <= until``, oldest first (ties by id)."""
+        raise NotImplementedError
+
+    def claim_log_revert(self, log_id: str, revert_id: str) -> bool:
+        """Set ``reverted_by`` on an entry unless it is already set; False if it is (or no entry)."""
+        raise NotImplementedError
+
+    def release_log_revert(self, log_id: str) -> None:
+        """Clear ``reverted_by`` after a revert that could not be applied."""
+        raise NotImplementedError
+
+    def count_logs_since(self, since: datetime) -> int:
+        raise NotImplementedError
+
+    def member_logs(self, member_id: str, company_id: str = None, before: Tuple[datetime, str] = None,
+                    limit: int = 50) -> List[Dict[str, Any]]:
+        """A member's (or one program's) entries, newest first, for keyset pagination.
+
+        Changesets count for every member/program among their ``changes``.
+        ``before`` is the ``(timestamp, id)`` of the last entry of the previous
+        page; entries are ordered by that pair, descending.
+        """
+        raise NotImplementedError
+
+    def activity_counts(self, since: datetime, until: datetime, unit: str,
+                        by: str = None) -> List[Dict[str, Any]]:
+        """Log entries with ``since <= timestamp < until`` grouped by bucket (see ``buckets``).
+
+        ``by`` is ``member_id``, ``company_id``, ``change_type`` or None; returns
+        ``{bucket, key, count}`` rows, ``key`` being None when ``by`` is.
+        """
+        raise NotImplementedError
+
+    def count_company_logs(self, company_id: str, other_than: str = None) -> int:
+        """Log entries of a company, optionally only those whose ``company_name`` differs."""
+        raise NotImplementedError
+
+    def rename_company_logs(self, company_id: str, name: str, limit: int) -> int:
+        """Set ``company_name`` on up to ``limit`` stale entries; returns how many."""
+        raise NotImplementedError
+
+    def archive_logs(self, before: datetime, limit: int) -> int:
+        """Move up to ``limit`` of the oldest entries older than ``before`` to the archive,
+        stamping ``archived_at``; returns how many moved."""
+        raise NotImplementedError
+
+    # Balance history
+    def insert_balance_points(self, points: List[Dict[str, Any]]) -> None:
+        """Append ``{member_id, company_id, ts, balance}`` samples."""
+        raise NotImplementedError
+
+    def balance_history(self, member_id: str, company_id: str, since: datetime = None,
+                        until: datetime = None) -> List[Dict[str, Any]]:
+        """One program's samples ordered by ``ts``, optionally within ``since``..``until``."""
+        raise NotImplementedError
+
+    # State snapshots (see replay.py)
+    def insert_state_snapshot(self, snapshot: Dict[str, Any]) -> None:
+        """Store ``{id, taken_at, state}``."""
+        raise NotImplementedError
+
+    def state_snapshot(self, at: datetime, after: bool = False) -> Optional[Dict[str, Any]]:
+        """The latest snapshot taken at or before ``at``; with ``after``, the earliest one taken after it."""
+        raise NotImplementedError
+
+    # Expiring lots
+    def insert_lot(self, lot: Dict[str, Any]) -> None:
+        """Store ``{id, member_id, company_id, amount, expires_on, ...}``; ``expires_on`` is an ISO date."""
+        raise NotImplementedError
+
+    def get_lot(self, lot_id: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def delete_lot(self, lot_id: str) -> bool:
+        raise NotImplementedError
+
+    def program_lots(self, member_id: str, company_id: str) -> List[Dict[str, Any]]:
+        """One program's lots ordered by ``expires_on``."""
+        raise NotImplementedError
+
+    def lots_expiring(self, since: str = None, until: str = None) -> List[Dict[str, Any]]:
+        """Lots with ``expires_on`` within ``since``..``until`` (inclusive), soonest first."""
+        raise NotImplementedError
+
+    def delete_lots(self, member_id: str = None, company_id: str = None) -> int:
+        """Drop the lots of a member, a company or one program; returns how many."""
+        raise NotImplementedError
+
+    def move_lots(self, company_id: str, to_company_id: str) -> int:
+        """Re-key a company's lots onto another one (company merge); returns how many."""
+        raise NotImplementedError
+
+    # Post-its
+    def list_postits(self) -> List[Dict[str, Any]]:
+        """Post-its ordered by creation time."""
+        raise NotImplementedError
+
+    def get_postit(self, postit_id: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def insert_postit(self, postit: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def update_postit(self, postit_id: str, set_fields: Dict[str, Any]) -> bool:
+        raise NotImplementedError
+
+    def delete_postit(self, postit_id: str) -> bool:
+        raise NotImplementedError
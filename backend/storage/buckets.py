@@ -0,0 +1,23 @@
+"""Calendar buckets for activity counts (UTC, weeks start on Monday).
+
+Engines that cannot truncate dates natively group with ``truncate``; Mongo
+uses ``$dateTrunc`` with the same units and week start, so every engine
+returns the same bucket boundaries.
+"""
+from datetime import datetime, timedelta
+
+UNITS = ("hour", "day", "week")
+
+
+def truncate(moment: datetime, unit: str) -> datetime:
+    """Start of the bucket holding ``moment``."""
+    if unit == "hour":
+        return moment.replace(minute=0, second=0, microsecond=0)
+    day = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    if unit == "week":
+        return day - timedelta(days=day.weekday())
+    return day
+
+
+def next_bucket(start: datetime, unit: str) -> datetime:
+    return start + {"hour": timedelta(hours=1), "day": timedelta(days=1), "week": timedelta(weeks=1)}[unit]
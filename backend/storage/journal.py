@@ -0,0 +1,146 @@
+"""Embedded durable engine: in-memory state plus an append-only journal.
+
+Reads are served by MemoryStorage. Every mutation is appended to
+``journal.log`` as one JSON line; a background thread fsyncs the journal in
+batches every ``JOURNAL_FSYNC_MS`` milliseconds (``0`` fsyncs on every write).
+After ``SNAPSHOT_EVERY`` mutations the full state is written to
+``snapshot.json`` and the journal is truncated. Recovery loads the snapshot
+and replays journal entries with a higher sequence number; a torn last line
+left by a crash is discarded.
+"""
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Any
+
+from . import codec
+from .memory import MemoryStorage
+
+logger = logging.getLogger(__name__)
+
+
+class JournalStorage(MemoryStorage):
+    name = "journal"
+
+    def __init__(self, path: str = None, fsync_ms: float = None, snapshot_every: int = None):
+        super().__init__()
+        self.path = Path(path or os.getenv("STORAGE_PATH", "data"))
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.snapshot_file = self.path / "snapshot.json"
+        self.journal_file = self.path / "journal.log"
+        if fsync_ms is None:
+            fsync_ms = float(os.getenv("JOURNAL_FSYNC_MS", "20"))
+        self.fsync_interval = fsync_ms / 1000
+        self.snapshot_every = snapshot_every or int(os.getenv("SNAPSHOT_EVERY", "5000"))
+
+        self._seq = 0
+        self._since_snapshot = 0
+        self._dirty = False
+        self._recover()
+        self._journal = open(self.journal_file, "a", encoding="utf-8")
+
+        self._stop = threading.Event()
+        self._flusher = None
+        if self.fsync_interval > 0:
+            self._flusher = threading.Thread(target=self._flush_loop, name="journal-fsync", daemon=True)
+            self._flusher.start()
+
+    def _apply(self, op: str, *args) -> Any:
+        with self._lock:
+            # Encode before applying: the _do_* handlers may consume their args
+            line = codec.dumps({"seq": self._seq + 1, "op": op, "args": args})
+            result = super()._apply(op, *args)
+            self._seq += 1
+            self._journal.write(line + "\n")
+            if self.fsync_interval > 0:
+                self._dirty = True
+            else:
+                self._sync()
+            self._since_snapshot += 1
+            if self._since_snapshot >= self.snapshot_every:
+                self.snapshot()
+            return result
+
+    def _sync(self) -> None:
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def _flush_loop(self) -> None:
+        while not self._stop.wait(self.fsync_interval):
+            with self._lock:
+                if not self._dirty:
+                    continue
+                self._journal.flush()
+                fd = self._journal.fileno()
+                self._dirty = False
+            # fsync outside the lock so writers only pay for the append
+            os.fsync(fd)
+
+    def snapshot(self) -> None:
+        """Write a compacted snapshot and truncate the journal."""
+        with self._lock:
+            payload = codec.dumps({"seq": self._seq, "state": self._dump_state()})
+            tmp = self.snapshot_file.with_suffix(".tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.snapshot_file)
+            self._fsync_dir()
+            # Entries up to self._seq are in the snapshot; replay skips them
+            # even if we crash before the truncate below.
+            self._journal.close()
+            self._journal = open(self.journal_file, "w", encoding="utf-8")
+            self._sync()
+            self._since_snapshot = 0
+            self._dirty = False
+
+    def _fsync_dir(self) -> None:
+        if os.name != "posix":
+            return
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _recover(self) -> None:
+        if self.snapshot_file.exists():
+            data = codec.loads(self.snapshot_file.read_text(encoding="utf-8"))
+            self._load_state(data["state"])
+            self._seq = data["seq"]
+        if not self.journal_file.exists():
+            return
+
+        good_offset = 0
+        with open(self.journal_file, "rb") as f:
+            for raw in f:
+                try:
+                    if not raw.endswith(b"\n"):
+                        raise ValueError("torn journal line")
+                    entry = codec.loads(raw.decode("utf-8"))
+                except ValueError:
+                    break
+                good_offset += len(raw)
+                if entry["seq"] <= self._seq:
+                    continue
+                MemoryStorage._apply(self, entry["op"], *entry["args"])
+                self._seq = entry["seq"]
+                self._since_snapshot += 1
+        if good_offset < self.journal_file.stat().st_size:
+            logger.warning("Journal: discarding torn tail of %s", self.journal_file)
+            with open(self.journal_file, "r+b") as f:
+                f.truncate(good_offset)
+
+    def close(self) -> None:
+        if self._flusher:
+            self._stop.set()
+            self._flusher.join()
+        with self._lock:
+            if self._journal.closed:
+                return
+            if self._since_snapshot:
+                self.snapshot()
+            self._sync()
+            self._journal.close()
@@ -0,0 +1,608 @@
+"""In-process storage engine.
+
+Everything lives in indexed dicts: members by id and by name, each member's
+programs as separate flat records and a company -> members index, so lookups
+never scan.
+The running points total is kept up to date on write, which makes the
+dashboard aggregate O(1).
+"""
+import bisect
+import threading
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+from .base import DuplicateError, Storage
+from .buckets import truncate
+from .names import fold, name_key
+from .paths import apply_update, clone, matches
+
+PROGRAMS_PREFIX = "programs."
+
+
+def log_order(entry: Dict[str, Any]) -> tuple:
+    return entry["timestamp"], entry["id"]
+
+
+def log_subjects(entry: Dict[str, Any]) -> tuple:
+    """Members and (member, company) programs an entry is about, changeset items included."""
+    members, programs = set(), set()
+    for item in [entry, *(entry.get("changes") or [])]:
+        if item.get("member_id"):
+            members.add(item["member_id"])
+            if item.get("company_id"):
+                programs.add((item["member_id"], item["company_id"]))
+    return members, programs
+
+
+class LogIndex:
+    """Log entries sorted by timestamp (for bisect range counts), by id, and
+    per member / (member, company) ordered by (timestamp, id)."""
+
+    def __init__(self):
+        self.entries: List[Dict[str, Any]] = []
+        self.times: List[datetime] = []
+        self.ids: Dict[str, Dict[str, Any]] = {}
+        self.members: Dict[str, List[Dict[str, Any]]] = {}
+        self.programs: Dict[tuple, List[Dict[str, Any]]] = {}
+
+    def insert(self, entry: Dict[str, Any]) -> None:
+        timestamp = entry["timestamp"]
+        if self.times and timestamp < self.times[-1]:
+            index = bisect.bisect_right(self.times, timestamp)
+            self.times.insert(index, timestamp)
+            self.entries.insert(index, entry)
+        else:
+            self.times.append(timestamp)
+            self.entries.append(entry)
+        self.ids[entry["id"]] = entry
+        members, programs = log_subjects(entry)
+        for index, keys in ((self.members, members), (self.programs, programs)):
+            for key in keys:
+                bisect.insort(index.setdefault(key, []), entry, key=log_order)
+
+    def pop_before(self, before: datetime, limit: int) -> List[Dict[str, Any]]:
+        """Remove and return up to ``limit`` of the oldest entries older than ``before``."""
+        count = min(bisect.bisect_left(self.times, before), limit)
+        popped, self.entries, self.times = self.entries[:count], self.entries[count:], self.times[count:]
+        members, programs = set(), set()
+        for entry in popped:
+            del self.ids[entry["id"]]
+            entry_members, entry_programs = log_subjects(entry)
+            members |= entry_members
+            programs |= entry_programs
+        gone = {entry["id"] for entry in popped}
+        for index, keys in ((self.members, members), (self.programs, programs)):
+            for key in keys:
+                index[key] = [entry for entry in index[key] if entry["id"] not in gone]
+        return popped
+
+    def between(self, since: datetime, until: datetime, include_until: bool = True) -> List[Dict[str, Any]]:
+        start = bisect.bisect_left(self.times, since)
+        end = (bisect.bisect_right if include_until else bisect.bisect_left)(self.times, until)
+        return self.entries[start:end]
+
+    def count_since(self, since: datetime) -> int:
+        return len(self.times) - bisect.bisect_left(self.times, since)
+
+    def page(self, member_id: str, company_id: Optional[str], before: Optional[tuple],
+             limit: int) -> List[Dict[str, Any]]:
+        """Newest ``limit`` entries of a member or program strictly below ``before``, newest first."""
+        if company_id:
+            entries = self.programs.get((member_id, company_id), [])
+        else:
+            entries = self.members.get(member_id, [])
+        end = bisect.bisect_left(entries, tuple(before), key=log_order) if before else len(entries)
+        return list(reversed(entries[max(0, end - limit):end]))
+
+
+class MemoryStorage(Storage):
+    name = "memory"
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self) -> None:
+        self._companies: Dict[str, Dict[str, Any]] = {}
+        self._company_names: Dict[str, str] = {}  # name_key -> id
+        self._members: Dict[str, Dict[str, Any]] = {}
+        self._member_names: Dict[str, str] = {}  # fold(name) -> id
+        self._programs: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._company_members: Dict[str, Set[str]] = {}
+        self._total_points = 0
+        self._log = LogIndex()
+        self._archive = LogIndex()  # entries past the retention period
+        self._state_snapshots: List[Dict[str, Any]] = []  # by taken_at
+        self._balances: Dict[tuple, List[Dict[str, Any]]] = {}  # (member_id, company_id) -> samples by ts
+        self._lots: Dict[str, Dict[str, Any]] = {}
+        self._lot_expiry: List[tuple] = []  # (expires_on, lot id), sorted
+        self._postits: Dict[str, Dict[str, Any]] = {}
+
+    # Full-state export/import, used for snapshots
+    def _dump_state(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "companies": self.list_companies(),
+                "members": self.list_members(),
+                "logs": [clone(entry) for entry in self._log.entries],
+                "archived_logs": [clone(entry) for entry in self._archive.entries],
+                "balance_history": [clone(p) for points in self._balances.values() for p in points],
+                "state_snapshots": [clone(s) for s in self._state_snapshots],
+                "expiring_lots": [clone(lot) for lot in self._lots.values()],
+                "postits": [clone(p) for p in self._postits.values()],
+            }
+
+    def _load_state(self, state: Dict[str, Any]) -> None:
+        with self._lock:
+            self._reset()
+            for company in state.get("companies", []):
+                self._do_insert_company(company)
+            for member in state.get("members", []):
+                self._do_insert_member(member)
+            for entry in state.get("logs", []):
+                self._do_insert_log(entry)
+            for entry in state.get("archived_logs", []):
+                self._archive.insert(entry)
+            self._do_insert_balance_points(state.get("balance_history", []))
+            for snapshot in state.get("state_snapshots", []):
+                self._do_insert_state_snapshot(snapshot)
+            for lot in state.get("expiring_lots", []):
+                self._do_insert_lot(lot)
+            for postit in state.get("postits", []):
+                self._do_insert_postit(postit)
+
+    # Every mutation goes through _apply so subclasses can record it
+    # (see JournalStorage) before it touches memory.
+    def _apply(self, op: str, *args) -> Any:
+        with self._lock:
+            return getattr(self, "_do_" + op)(*args)
+
+    # Companies
+    def list_companies(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [clone(c) for c in self._companies.values()]
+
+    def get_company(self, company_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            company = self._companies.get(company_id)
+            return clone(company) if company else None
+
+    def find_company_by_name(self, name: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            company_id = self._company_names.get(name_key(name))
+            return self.get_company(company_id) if company_id else None
+
+    def insert_company(self, company: Dict[str, Any]) -> None:
+        with self._lock:
+            self._check_company_name(company["name"], company["id"])
+            self._apply("insert_company", clone(company))
+
+    def _do_insert_company(self, company: Dict[str, Any]) -> None:
+        self._companies[company["id"]] = company
+        # Duplicates from before the check existed keep loading; the first wins the name
+        self._company_names.setdefault(name_key(company["name"]), company["id"])
+
+    def update_company(self, company_id: str, set_fields: Dict[str, Any]) -> bool:
+        with self._lock:
+            if "name" in set_fields:
+                self._check_company_name(set_fields["name"], company_id)
+            return self._apply("update_company", company_id, clone(set_fields))
+
+    def _do_update_company(self, company_id: str, set_fields: Dict[str, Any]) -> bool:
+        company = self._companies.get(company_id)
+        if company is None:
+            return False
+        if "name" in set_fields:
+            self._unindex_company(company)
+            self._company_names.setdefault(name_key(set_fields["name"]), company_id)
+        apply_update(company, set_fields)
+        return True
+
+    def _check_company_name(self, name: str, company_id: str) -> None:
+        if self._company_names.get(name_key(name), company_id) != company_id:
+            raise DuplicateError(f"company name {name!r} already exists")
+
+    def delete_company(self, company_id: str) -> bool:
+        return self._apply("delete_company", company_id)
+
+    def _do_delete_company(self, company_id: str) -> bool:
+        company = self._companies.pop(company_id, None)
+        if company is None:
+            return False
+        self._unindex_company(company)
+        return True
+
+    def _unindex_company(self, company: Dict[str, Any]) -> None:
+        key = name_key(company["name"])
+        if self._company_names.get(key) == company["id"]:
+            del self._company_names[key]
+
+    def count_companies(self) -> int:
+        return len(self._companies)
+
+    # Members
+    def _assemble(self, member_id: str) -> Dict[str, Any]:
+        member = clone(self._members[member_id])
+        member["programs"] = clone(self._programs.get(member_id, {}))
+        return member
+
+    def list_members(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            order = sorted(self._members, key=lambda mid: (fold(self._members[mid]["name"]),
+                                                           self._members[mid]["name"]))
+            return [self._assemble(member_id) for member_id in order]
+
+    def get_member(self, member_id: str, programs: bool = True) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            if member_id not in self._members:
+                return None
+            if not programs:
+                return clone(self._members[member_id])
+            return self._assemble(member_id)
+
+    def get_members(self, member_ids: Iterable[str]) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [self._assemble(mid) for mid in dict.fromkeys(member_ids) if mid in self._members]
+
+    def find_member_by_name(self, name: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            member_id = self._member_names.get(fold(name))
+            return self._assemble(member_id) if member_id else None
+
+    def insert_member(self, member: Dict[str, Any]) -> None:
+        with self._lock:
+            self._check_member_name(member["name"], member["id"])
+            self._apply("insert_member", clone(member))
+
+    def _check_member_name(self, name: str, member_id: str) -> None:
+        if self._member_names.get(fold(name), member_id) != member_id:
+            raise DuplicateError(f"member name {name!r} already exists")
+
+    def _do_insert_member(self, member: Dict[str, Any]) -> None:
+        programs = member.pop("programs", {}) or {}
+        member_id = member["id"]
+        self._members[member_id] = member
+        self._member_names.setdefault(fold(member["name"]), member_id)
+        self._programs[member_id] = {}
+        self._replace_programs(member_id, programs)
+
+    def update_member(self, member_id: str, set_fields: Dict[str, Any] = None,
+                      unset_fields: Iterable[str] = (), inc_fields: Dict[str, Any] = None,
+                      where: Dict[str, Any] = None) -> bool:
+        with self._lock:
+            if set_fields and "name" in set_fields and member_id in self._members:
+                self._check_member_name(set_fields["name"], member_id)
+            return self._apply("update_member", member_id, clone(set_fields or {}),
+                               list(unset_fields or ()), dict(inc_fields or {}), clone(where or {}))
+
+    def _do_update_member(self, member_id: str, set_fields: Dict[str, Any],
+                          unset_fields: List[str], inc_fields: Dict[str, Any] = None,
+                          where: Dict[str, Any] = None) -> bool:
+        member = self._members.get(member_id)
+        if member is None:
+            return False
+        if where and not matches({**member, "programs": self._programs[member_id]}, where):
+            return False
+
+        member_set, member_unset, member_inc = {}, [], {}
+        program_set, program_unset, program_inc = {}, [], {}
+        for path, value in set_fields.items():
+            if path == "programs":
+                self._replace_programs(member_id, value or {})
+            elif path.startswith(PROGRAMS_PREFIX):
+                program_set[path[len(PROGRAMS_PREFIX):]] = value
+            else:
+                member_set[path] = value
+        for path in unset_fields:
+            if path.startswith(PROGRAMS_PREFIX):
+                program_unset.append(path[len(PROGRAMS_PREFIX):])
+            else:
+                member_unset.append(path)
+        for path, amount in (inc_fields or {}).items():
+            if path.startswith(PROGRAMS_PREFIX):
+                program_inc[path[len(PROGRAMS_PREFIX):]] = amount
+            else:
+                member_inc[path] = amount
+
+        if "name" in member_set and member_set["name"] != member["name"]:
+            self._unindex_member(member)
+            self._member_names.setdefault(fold(member_set["name"]), member_id)
+        apply_update(member, member_set, member_unset, member_inc)
+
+        if program_set or program_unset or program_inc:
+            programs = self._programs[member_id]
+            touched = {p.split(".", 1)[0] for p in [*program_set, *program_unset, *program_inc]}
+            before = {cid: self._balance(programs.get(cid)) for cid in touched}
+            apply_update(programs, program_set, program_unset, program_inc)
+            for cid in touched:
+                self._total_points += self._balance(programs.get(cid)) - before[cid]
+                self._index_program(member_id, cid, cid in programs)
+        return True
+
+    def update_members(self, set_fields: Dict[str, Any] = None, unset_fields: Iterable[str] = (),
+                       inc_fields: Dict[str, Any] = None, where: Dict[str, Any] = None) -> int:
+        return self._apply("update_members", clone(set_fields or {}), list(unset_fields or ()),
+                           dict(inc_fields or {}), clone(where or {}))
+
+    def _do_update_members(self, set_fields: Dict[str, Any], unset_fields: List[str],
+                           inc_fields: Dict[str, Any], where: Dict[str, Any]) -> int:
+        return sum(
+            self._do_update_member(member_id, clone(set_fields), unset_fields, inc_fields, where)
+            for member_id in list(self._members)
+        )
+
+    def delete_member(self, member_id: str) -> bool:
+        return self._apply("delete_member", member_id)
+
+    def _do_delete_member(self, member_id: str) -> bool:
+        member = self._members.pop(member_id, None)
+        if member is None:
+            return False
+        self._unindex_member(member)
+        self._replace_programs(member_id, {})
+        del self._programs[member_id]
+        return True
+
+    def _unindex_member(self, member: Dict[str, Any]) -> None:
+        key = fold(member["name"])
+        if self._member_names.get(key) == member["id"]:
+            del self._member_names[key]
+
+    def _replace_programs(self, member_id: str, programs: Dict[str, Any]) -> None:
+        current = self._programs[member_id]
+        for cid in list(current):
+            self._total_points -= self._balance(current.pop(cid))
+            self._index_program(member_id, cid, False)
+        for cid, program in programs.items():
+            current[cid] = clone(program)
+            self._total_points += self._balance(program)
+            self._index_program(member_id, cid, True)
+
+    def _index_program(self, member_id: str, company_id: str, present: bool) -> None:
+        if present:
+            self._company_members.setdefault(company_id, set()).add(member_id)
+        else:
+            self._company_members.get(company_id, set()).discard(member_id)
+
+    # Programs
+    def get_program(self, member_id: str, company_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            program = self._programs.get(member_id, {}).get(company_id)
+            return clone(program) if program is not None else None
+
+    def list_programs_for_company(self, company_id: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [
+                {**clone(self._programs[member_id][company_id]), "member_id": member_id}
+                for member_id in self._company_members.get(company_id, ())
+            ]
+
+    @staticmethod
+    def _balance(program: Optional[Dict[str, Any]]) -> int:
+        if not isinstance(program, dict):
+            return 0
+        return program.get("current_balance", 0) or 0
+
+    def count_members(self) -> int:
+        return len(self._members)
+
+    def total_points(self) -> int:
+        return self._total_points
+
+    # Global log; archived entries are only read, never rewritten
+    def insert_log(self, entry: Dict[str, Any]) -> None:
+        self._apply("insert_log", clone(entry))
+
+    def _do_insert_log(self, entry: Dict[str, Any]) -> None:
+        self._log.insert(entry)
+
+    def recent_logs(self, limit: int = 50) -> List[Dict[str, Any]]:
+        with self._lock:
+            if limit <= 0:
+                return []
+            return [clone(entry) for entry in reversed(self._log.entries[-limit:])]
+
+    def get_log(self, log_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._log.ids.get(log_id) or self._archive.ids.get(log_id)
+            return clone(entry) if entry else None
+
+    def logs_between(self, since: datetime, until: datetime) -> List[Dict[str, Any]]:
+        with self._lock:
+            entries = self._archive.between(since, until) + self._log.between(since, until)
+            return [clone(entry) for entry in sorted(entries, key=log_order)]
+
+    def claim_log_revert(self, log_id: str, revert_id: str) -> bool:
+        return self._apply("claim_log_revert", log_id, revert_id)
+
+    def _do_claim_log_revert(self, log_id: str, revert_id: str) -> bool:
+        entry = self._log.ids.get(log_id)
+        if entry is None or entry.get("reverted_by"):
+            return False
+        entry["reverted_by"] = revert_id
+        return True
+
+    def release_log_revert(self, log_id: str) -> None:
+        self._apply("release_log_revert", log_id)
+
+    def _do_release_log_revert(self, log_id: str) -> None:
+        entry = self._log.ids.get(log_id)
+        if entry is not None:
+            entry.pop("reverted_by", None)
+
+    def count_company_logs(self, company_id: str, other_than: str = None) -> int:
+        with self._lock:
+            return sum(1 for entry in self._log.entries if entry.get("company_id") == company_id
+                       and (other_than is None or entry.get("company_name") != other_than))
+
+    def rename_company_logs(self, company_id: str, name: str, limit: int) -> int:
+        return self._apply("rename_company_logs", company_id, name, limit)
+
+    def _do_rename_company_logs(self, company_id: str, name: str, limit: int) -> int:
+        renamed = 0
+        for entry in self._log.entries:
+            if renamed >= limit:
+                break
+            if entry.get("company_id") == company_id and entry.get("company_name") != name:
+                entry["company_name"] = name
+                renamed += 1
+        return renamed
+
+    def count_logs_since(self, since: datetime) -> int:
+        with self._lock:
+            return self._log.count_since(since) + self._archive.count_since(since)
+
+    def member_logs(self, member_id: str, company_id: str = None, before: tuple = None,
+                    limit: int = 50) -> List[Dict[str, Any]]:
+        with self._lock:
+            entries = (self._log.page(member_id, company_id, before, limit)
+                       + self._archive.page(member_id, company_id, before, limit))
+            return [clone(entry) for entry in sorted(entries, key=log_order, reverse=True)[:limit]]
+
+    def activity_counts(self, since: datetime, until: datetime, unit: str,
+                        by: str = None) -> List[Dict[str, Any]]:
+        with self._lock:
+            counts: Dict[tuple, int] = {}
+            for index in (self._archive, self._log):
+                for entry in index.between(since, until, include_until=False):
+                    group = (truncate(entry["timestamp"], unit), entry.get(by) if by else None)
+                    counts[group] = counts.get(group, 0) + 1
+            return [{"bucket": bucket, "key": key, "count": count}
+                    for (bucket, key), count in sorted(counts.items(), key=lambda item: item[0][0])]
+
+    def archive_logs(self, before: datetime, limit: int) -> int:
+        return self._apply("archive_logs", before, limit, datetime.utcnow())
+
+    def _do_archive_logs(self, before: datetime, limit: int, archived_at: datetime) -> int:
+        entries = self._log.pop_before(before, limit)
+        for entry in entries:
+            entry["archived_at"] = archived_at
+            self._archive.insert(entry)
+        return len(entries)
+
+    # Balance history
+    def insert_balance_points(self, points: List[Dict[str, Any]]) -> None:
+        self._apply("insert_balance_points", clone(points))
+
+    def _do_insert_balance_points(self, points: List[Dict[str, Any]]) -> None:
+        for point in points:
+            series = self._balances.setdefault((point["member_id"], point["company_id"]), [])
+            if series and point["ts"] < series[-1]["ts"]:
+                bisect.insort_right(series, point, key=lambda p: p["ts"])
+            else:
+                series.append(point)
+
+    def balance_history(self, member_id: str, company_id: str, since: datetime = None,
+                        until: datetime = None) -> List[Dict[str, Any]]:
+        with self._lock:
+            series = self._balances.get((member_id, company_id), [])
+            start = bisect.bisect_left(series, since, key=lambda p: p["ts"]) if since else 0
+            end = bisect.bisect_right(series, until, key=lambda p: p["ts"]) if until else len(series)
+            return [clone(point) for point in series[start:end]]
+
+    # State snapshots
+    def insert_state_snapshot(self, snapshot: Dict[str, Any]) -> None:
+        self._apply("insert_state_snapshot", clone(snapshot))
+
+    def _do_insert_state_snapshot(self, snapshot: Dict[str, Any]) -> None:
+        bisect.insort_right(self._state_snapshots, snapshot, key=lambda s: s["taken_at"])
+
+    def state_snapshot(self, at: datetime, after: bool = False) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            index = bisect.bisect_right(self._state_snapshots, at, key=lambda s: s["taken_at"])
+            if after:
+                found = self._state_snapshots[index] if index < len(self._state_snapshots) else None
+            else:
+                found = self._state_snapshots[index - 1] if index else None
+            return clone(found) if found else None
+
+    # Expiring lots
+    def insert_lot(self, lot: Dict[str, Any]) -> None:
+        self._apply("insert_lot", clone(lot))
+
+    def _do_insert_lot(self, lot: Dict[str, Any]) -> None:
+        self._lots[lot["id"]] = lot
+        bisect.insort(self._lot_expiry, (lot["expires_on"], lot["id"]))
+
+    def get_lot(self, lot_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            lot = self._lots.get(lot_id)
+            return clone(lot) if lot else None
+
+    def delete_lot(self, lot_id: str) -> bool:
+        return self._apply("delete_lot", lot_id)
+
+    def _do_delete_lot(self, lot_id: str) -> bool:
+        lot = self._lots.pop(lot_id, None)
+        if lot is None:
+            return False
+        self._lot_expiry.remove((lot["expires_on"], lot_id))
+        return True
+
+    def program_lots(self, member_id: str, company_id: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [clone(self._lots[lot_id]) for _, lot_id in self._lot_expiry
+                    if self._lots[lot_id]["member_id"] == member_id
+                    and self._lots[lot_id]["company_id"] == company_id]
+
+    def lots_expiring(self, since: str = None, until: str = None) -> List[Dict[str, Any]]:
+        with self._lock:
+            start = bisect.bisect_left(self._lot_expiry, since, key=lambda e: e[0]) if since else 0
+            end = (bisect.bisect_right(self._lot_expiry, until, key=lambda e: e[0]) if until
+                   else len(self._lot_expiry))
+            return [clone(self._lots[lot_id]) for _, lot_id in self._lot_expiry[start:end]]
+
+    def delete_lots(self, member_id: str = None, company_id: str = None) -> int:
+        return self._apply("delete_lots", member_id, company_id)
+
+    def _do_delete_lots(self, member_id: str = None, company_id: str = None) -> int:
+        doomed = [lot_id for lot_id, lot in self._lots.items()
+                  if (member_id is None or lot["member_id"] == member_id)
+                  and (company_id is None or lot["company_id"] == company_id)]
+        for lot_id in doomed:
+            self._do_delete_lot(lot_id)
+        return len(doomed)
+
+    def move_lots(self, company_id: str, to_company_id: str) -> int:
+        return self._apply("move_lots", company_id, to_company_id)
+
+    def _do_move_lots(self, company_id: str, to_company_id: str) -> int:
+        moved = 0
+        for lot in self._lots.values():
+            if lot["company_id"] == company_id:
+                lot["company_id"] = to_company_id
+                moved += 1
+        return moved
+
+    # Post-its
+    def list_postits(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            postits = sorted(self._postits.values(), key=lambda p: p["created_at"])
+            return [clone(p) for p in postits]
+
+    def get_postit(self, postit_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            postit = self._postits.get(postit_id)
+            return clone(postit) if postit else None
+
+    def insert_postit(self, postit: Dict[str, Any]) -> None:
+        self._apply("insert_postit", clone(postit))
+
+    def _do_insert_postit(self, postit: Dict[str, Any]) -> None:
+        self._postits[postit["id"]] = postit
+
+    def update_postit(self, postit_id: str, set_fields: Dict[str, Any]) -> bool:
+        return self._apply("update_postit", postit_id, clone(set_fields))
+
+    def _do_update_postit(self, postit_id: str, set_fields: Dict[str, Any]) -> bool:
+        postit = self._postits.get(postit_id)
+        if postit is None:
+            return False
+        apply_update(postit, set_fields)
+        return True
+
+    def delete_postit(self, postit_id: str) -> bool:
+        return self._apply("delete_postit", postit_id)
+
+    def _do_delete_postit(self, postit_id: str) -> bool:
+        return self._postits.pop(postit_id, None) is not None
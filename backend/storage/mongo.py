@@ -0,0 +1,639 @@
+"""MongoDB storage engine.
+
+``MONGO_PROGRAM_LAYOUT`` picks where programs live:
+
+* ``embedded`` (default) - inside each member document, as ``programs.<company_id>``
+* ``normalized`` - one document per (member_id, company_id) in the ``programs``
+  collection, so per-program reads and writes touch only that document and
+  per-company queries are index scans. Convert existing data with
+  ``backend/migrate_programs.py``.
+
+Either way the engine hands back members with the embedded ``programs`` map.
+"""
+import logging
+import os
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from pymongo import (ASCENDING, DeleteMany, DeleteOne, InsertOne, MongoClient, ReplaceOne, UpdateMany,
+                     UpdateOne)
+from pymongo.collation import Collation
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError, OperationFailure
+
+from .base import DuplicateError, Storage
+from .names import name_key
+from .paths import get_path, matches
+
+NO_ID = {"_id": 0}
+COMPANY_FIELDS = {"_id": 0, "name_key": 0}
+# Case- and accent-insensitive: "Osvandre" == "osvandré"
+NAME_COLLATION = Collation(locale="pt", strength=1)
+LAYOUTS = ("embedded", "normalized")
+
+logger = logging.getLogger(__name__)
+
+
+class MongoStorage(Storage):
+    name = "mongo"
+
+    def __init__(self, mongo_url: str = None, db_name: str = None, layout: str = None,
+                 **client_options):
+        self.client = MongoClient(mongo_url or os.getenv("MONGO_URL"), **client_options)
+        self.db = self.client[db_name or os.getenv("DB_NAME")]
+        self.companies = self.db.companies
+        self.members = self.db.members
+        self.programs = self.db.programs
+        self.global_log = self.db.global_log
+        self.log_archive = self.db.global_log_archive
+        self.balances = self.db.balance_history
+        self.lots = self.db.expiring_lots
+        self.state_snapshots = self.db.state_snapshots
+        self.postits = self.db.postits
+
+        self.layout = (layout or os.getenv("MONGO_PROGRAM_LAYOUT") or "embedded").lower()
+        if self.layout not in LAYOUTS:
+            raise ValueError(f"Unknown MONGO_PROGRAM_LAYOUT {self.layout!r}; expected one of {LAYOUTS}")
+        self.normalized = self.layout == "normalized"
+        self._indexes_ready = False
+
+    def ensure_indexes(self) -> None:
+        if self._indexes_ready:
+            return
+        self.members.create_index([("id", ASCENDING)], unique=True, name="id")
+        try:
+            self.members.create_index([("name", ASCENDING)], unique=True, name="name",
+                                      collation=NAME_COLLATION)
+        except OperationFailure as e:
+            # Existing members clash under the collation; rename one and restart
+            logger.warning("members.name unique index not created: %s", e)
+        self._backfill_company_keys()
+        # Partial, so duplicates still waiting for a merge (no key) are allowed
+        self.companies.create_index([("name_key", ASCENDING)], unique=True, name="name_key",
+                                    partialFilterExpression={"name_key": {"$type": "string"}})
+        self.global_log.create_index([("timestamp", ASCENDING)], name="timestamp")
+        self.global_log.create_index([("company_id", ASCENDING)], name="company")
+        self.global_log.create_index([("id", ASCENDING)], name="id")
+        self.state_snapshots.create_index([("taken_at", ASCENDING)], name="taken_at")
+        # Histories: each $or branch of member_logs walks one of these in
+        # (timestamp, id) order, so a page is a merge of index ranges
+        for prefix in ("", "changes."):  # changes.*: multikey, for changesets
+            self.global_log.create_index([(prefix + "member_id", ASCENDING), ("timestamp", ASCENDING),
+                                          ("id", ASCENDING)], name=prefix + "member_timestamp")
+            self.global_log.create_index([(prefix + "member_id", ASCENDING), (prefix + "company_id", ASCENDING),
+                                          ("timestamp", ASCENDING), ("id", ASCENDING)],
+                                         name=prefix + "program_timestamp")
+        self._create_log_archive()
+        self.programs.create_index([("member_id", ASCENDING), ("company_id", ASCENDING)],
+                                   unique=True, name="member_company")
+        self.programs.create_index([("company_id", ASCENDING)], name="company")
+        self.balances.create_index([("member_id", ASCENDING), ("company_id", ASCENDING),
+                                           ("ts", ASCENDING)], name="program_ts")
+        self.lots.create_index([("id", ASCENDING)], unique=True, name="id")
+        self.lots.create_index([("expires_on", ASCENDING)], name="expires_on")
+        self.lots.create_index([("member_id", ASCENDING), ("company_id", ASCENDING),
+                                ("expires_on", ASCENDING)], name="program_expiry")
+        self._indexes_ready = True
+
+    def _create_log_archive(self) -> None:
+        # Cold tier: rarely read, so trade some CPU for zstd instead of the default snappy
+        if self.log_archive.name not in self.db.list_collection_names():
+            try:
+                self.db.create_collection(self.log_archive.name, storageEngine={
+                    "wiredTiger": {"configString": "block_compressor=zstd"}})
+            except (CollectionInvalid, OperationFailure) as e:
+                logger.warning("global_log_archive created with default compression: %s", e)
+        self.log_archive.create_index([("id", ASCENDING)], unique=True, name="id")
+        self.log_archive.create_index([("timestamp", ASCENDING)], name="timestamp")
+        for prefix in ("", "changes."):
+            self.log_archive.create_index([(prefix + "member_id", ASCENDING), ("timestamp", ASCENDING),
+                                           ("id", ASCENDING)], name=prefix + "member_timestamp")
+            self.log_archive.create_index([(prefix + "member_id", ASCENDING), (prefix + "company_id", ASCENDING),
+                                           ("timestamp", ASCENDING), ("id", ASCENDING)],
+                                          name=prefix + "program_timestamp")
+
+    def _backfill_company_keys(self) -> None:
+        taken = set(self.companies.distinct("name_key"))
+        for company in self.companies.find({"name_key": {"$exists": False}}, {"_id": 1, "name": 1}):
+            key = name_key(company["name"])
+            if key not in taken:
+                self.companies.update_one({"_id": company["_id"]}, {"$set": {"name_key": key}})
+                taken.add(key)
+
+    def status(self) -> Dict[str, Any]:
+        return {**super().status(), "program_layout": self.layout}
+
+    def close(self) -> None:
+        self.client.close()
+
+    # Companies
+    def list_companies(self) -> List[Dict[str, Any]]:
+        return list(self.companies.find({}, COMPANY_FIELDS))
+
+    def get_company(self, company_id: str) -> Optional[Dict[str, Any]]:
+        return self.companies.find_one({"id": company_id}, COMPANY_FIELDS)
+
+    def find_company_by_name(self, name: str) -> Optional[Dict[str, Any]]:
+        return (self.companies.find_one({"name_key": name_key(name)}, COMPANY_FIELDS)
+                or self.companies.find_one({"name": name}, COMPANY_FIELDS))
+
+    def insert_company(self, company: Dict[str, Any]) -> None:
+        try:
+            self.companies.insert_one({**company, "name_key": name_key(company["name"])})
+        except DuplicateKeyError as e:
+            raise DuplicateError(str(e)) from e
+
+    def update_company(self, company_id: str, set_fields: Dict[str, Any]) -> bool:
+        set_fields = dict(set_fields)
+        if "name" in set_fields:
+            set_fields["name_key"] = name_key(set_fields["name"])
+        try:
+            return self.companies.update_one({"id": company_id}, {"$set": set_fields}).matched_count == 1
+        except DuplicateKeyError as e:
+            raise DuplicateError(str(e)) from e
+
+    def delete_company(self, company_id: str) -> bool:
+        return self.companies.delete_one({"id": company_id}).deleted_count == 1
+
+    def count_companies(self) -> int:
+        return self.companies.count_documents({})
+
+    # Members
+    def _attach_programs(self, members: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Rebuild the embedded ``programs`` map from the normalized collection."""
+        if not self.normalized or not members:
+            return members
+        by_id = {member["id"]: member for member in members}
+        for member in members:
+            member["programs"] = {}
+        for program in self.programs.find({"member_id": {"$in": list(by_id)}}, NO_ID):
+            member = by_id.get(program.pop("member_id"))
+            if member is not None:
+                member["programs"][program["company_id"]] = program
+        return members
+
+    def list_members(self) -> List[Dict[str, Any]]:
+        members = self.members.find({}, NO_ID, collation=NAME_COLLATION).sort("name", ASCENDING)
+        return self._attach_programs(list(members))
+
+    def get_members(self, member_ids: Iterable[str]) -> List[Dict[str, Any]]:
+        return self._attach_programs(list(self.members.find({"id": {"$in": list(member_ids)}}, NO_ID)))
+
+    def get_member(self, member_id: str, programs: bool = True) -> Optional[Dict[str, Any]]:
+        projection = NO_ID if programs else {"_id": 0, "programs": 0}
+        member = self.members.find_one({"id": member_id}, projection)
+        if member is None or not programs:
+            return member
+        return self._attach_programs([member])[0]
+
+    def find_member_by_name(self, name: str) -> Optional[Dict[str, Any]]:
+        member = self.members.find_one({"name": name}, NO_ID, collation=NAME_COLLATION)
+        return self._attach_programs([member])[0] if member else None
+
+    def insert_member(self, member: Dict[str, Any]) -> None:
+        member = dict(member)
+        programs = (member.pop("programs", {}) or {}) if self.normalized else {}
+        # The member goes first: a duplicate name must not leave orphan programs behind
+        try:
+            self.members.insert_one(member)
+        except DuplicateKeyError as e:
+            raise DuplicateError(str(e)) from e
+        if programs:
+            self.programs.insert_many([
+                {**program, "member_id": member["id"], "company_id": company_id}
+                for company_id, program in programs.items()
+            ])
+
+    def update_member(self, member_id: str, set_fields: Dict[str, Any] = None,
+                      unset_fields: Iterable[str] = (), inc_fields: Dict[str, Any] = None,
+                      where: Dict[str, Any] = None) -> bool:
+        set_fields, unset_fields = dict(set_fields or {}), list(unset_fields or ())
+        inc_fields, where = dict(inc_fields or {}), dict(where or {})
+        if not self.normalized:
+            return self._update_member_doc(member_id, set_fields, unset_fields, inc_fields, where)
+
+        # Normalized layout: program paths become writes on the programs
+        # collection. There is no multi-document transaction, so the order is
+        # chosen to make the filters the commit point: a guarded program
+        # write first, then the (conditional) member write, then the rest.
+        if self.members.count_documents({"id": member_id}, limit=1) == 0:
+            return False
+        guarded, requests = self._program_requests(member_id, set_fields, unset_fields,
+                                                   inc_fields, where)
+        if guarded is not None:
+            key, condition, update = guarded
+            if self.programs.update_one({**key, **condition}, update).matched_count == 0:
+                return False
+        if not self._update_member_doc(member_id, set_fields, unset_fields, inc_fields, where):
+            return False
+        if requests:
+            self.programs.bulk_write(requests, ordered=True)
+        return True
+
+    def bulk_update_members(self, updates: List[Dict[str, Any]]) -> List[bool]:
+        member_ids = [u["member_id"] for u in updates]
+        if len(set(member_ids)) != len(member_ids):
+            raise ValueError("bulk_update_members takes at most one update per member")
+        specs = [_update_spec(u.get("set_fields"), u.get("unset_fields") or (), u.get("inc_fields"))
+                 for u in updates]
+        if self.normalized or len(updates) < 2 or not all(specs):
+            # Normalized updates span two collections and need their ordering
+            return super().bulk_update_members(updates)
+        requests = [UpdateOne({"id": u["member_id"], **(u.get("where") or {})}, spec)
+                    for u, spec in zip(updates, specs)]
+        try:
+            matched = self.members.bulk_write(requests, ordered=False).matched_count
+        except BulkWriteError as e:
+            if all(error.get("code") == 11000 for error in e.details.get("writeErrors", [])):
+                raise DuplicateError(str(e)) from e
+            raise
+        if matched == len(requests):
+            return [True] * len(requests)
+        return self._bulk_results(updates, matched)
+
+    def _bulk_results(self, updates: List[Dict[str, Any]], matched: int) -> List[bool]:
+        """Tell which items of a short bulk_write matched, by reading the members back.
+
+        bulk_write only reports a total. An item did not match when its
+        member is gone, still passes its ``where`` although the update changes
+        a guarded path, or holds the version the item set but another write's
+        updated_at (each version is written once). When the matched count
+        does not settle the rest, the version/updated_at an item set tells
+        whether it landed.
+        """
+        docs = {doc["id"]: doc for doc in self.members.find(
+            {"id": {"$in": [u["member_id"] for u in updates]}}, NO_ID)}
+        possible = []
+        for index, u in enumerate(updates):
+            doc, where = docs.get(u["member_id"]), u.get("where") or {}
+            written = set(u.get("set_fields") or {}) | set(u.get("unset_fields") or ()) | set(u.get("inc_fields") or {})
+            if doc is None or (written & set(where) and matches(doc, where)):
+                continue
+            set_fields = u.get("set_fields") or {}
+            if "version" in set_fields and doc.get("version") == set_fields["version"] \
+                    and not _carries_stamps(doc, set_fields):
+                continue
+            possible.append(index)
+        if len(possible) != matched:
+            stamped = [index for index in possible if _carries_stamps(docs[updates[index]["member_id"]],
+                                                                      updates[index].get("set_fields") or {})]
+            if len(stamped) != matched:
+                logger.warning("bulk_update_members: %d of %d items matched but %d carry their stamps; "
+                               "reporting those", matched, len(updates), len(stamped))
+            possible = stamped
+        applied = set(possible)
+        return [index in applied for index in range(len(updates))]
+
+    def update_members(self, set_fields: Dict[str, Any] = None, unset_fields: Iterable[str] = (),
+                       inc_fields: Dict[str, Any] = None, where: Dict[str, Any] = None) -> int:
+        set_fields, unset_fields = dict(set_fields or {}), list(unset_fields or ())
+        inc_fields, where = dict(inc_fields or {}), dict(where or {})
+        if not self.normalized:
+            update = _update_spec(set_fields, unset_fields, inc_fields)
+            if not update:
+                return self.members.count_documents(where)
+            return self.members.update_many(where, update).matched_count
+
+        # Normalized layout: resolve the matching members once, then write
+        # each collection in bulk
+        member_ids = self.members.distinct("id", self._member_filter(where))
+        if not member_ids:
+            return 0
+        owned = {"member_id": {"$in": member_ids}}
+        requests = []
+        for path in [p for p in set_fields if p.startswith("programs.")]:
+            _, company_id, *rest = path.split(".", 2)
+            value = set_fields.pop(path)
+            if rest:
+                requests.append(UpdateMany({**owned, "company_id": company_id}, {"$set": {rest[0]: value}}))
+            else:
+                requests += [ReplaceOne({"member_id": member_id, "company_id": company_id},
+                                        {**value, "member_id": member_id, "company_id": company_id},
+                                        upsert=True) for member_id in member_ids]
+        for path in [p for p in unset_fields if p.startswith("programs.")]:
+            _, company_id, *rest = path.split(".", 2)
+            unset_fields.remove(path)
+            if rest:
+                requests.append(UpdateMany({**owned, "company_id": company_id}, {"$unset": {rest[0]: ""}}))
+            else:
+                requests.append(DeleteMany({**owned, "company_id": company_id}))
+        for path in [p for p in inc_fields if p.startswith("programs.")]:
+            _, company_id, field = path.split(".", 2)
+            requests.append(UpdateMany({**owned, "company_id": company_id},
+                                       {"$inc": {field: inc_fields.pop(path)}}))
+        if requests:
+            self.programs.bulk_write(requests, ordered=True)
+        update = _update_spec(set_fields, unset_fields, inc_fields)
+        if update:
+            self.members.update_many({"id": {"$in": member_ids}}, update)
+        return len(member_ids)
+
+    def _member_filter(self, where: Dict[str, Any]) -> Dict[str, Any]:
+        """Translate ``programs.*`` conditions into member-id conditions (normalized layout)."""
+        query = {path: cond for path, cond in where.items() if not path.startswith("programs.")}
+        clauses = []
+        for path in [p for p in where if p.startswith("programs.")]:
+            _, company_id, *rest = path.split(".", 2)
+            condition = where[path]
+            if rest:
+                owners = self.programs.distinct("member_id", {"company_id": company_id, rest[0]: condition})
+                clauses.append({"id": {"$in": owners}})
+            else:
+                # Whole-program conditions are existence checks
+                owners = self.programs.distinct("member_id", {"company_id": company_id})
+                exists = condition.get("$exists", True) if isinstance(condition, dict) else True
+                clauses.append({"id": {"$in" if exists else "$nin": owners}})
+        if clauses:
+            query["$and"] = clauses
+        return query
+
+    def _update_member_doc(self, member_id: str, set_fields: Dict[str, Any], unset_fields: List[str],
+                           inc_fields: Dict[str, Any], where: Dict[str, Any]) -> bool:
+        query = {"id": member_id, **where}
+        update = _update_spec(set_fields, unset_fields, inc_fields)
+        if not update:
+            return self.members.count_documents(query, limit=1) == 1
+        try:
+            return self.members.update_one(query, update).matched_count == 1
+        except DuplicateKeyError as e:
+            raise DuplicateError(str(e)) from e
+
+    def _program_requests(self, member_id: str, set_fields: Dict[str, Any], unset_fields: List[str],
+                          inc_fields: Dict[str, Any], where: Dict[str, Any]):
+        """Move ``programs.*`` paths out of a member update into per-program writes.
+
+        Only the touched program documents are written; the matching paths are
+        removed from the arguments in place. Returns the guarded write for the
+        program named in ``where`` (if any) and the remaining bulk requests.
+        """
+        requests = []
+        if "programs" in set_fields:
+            requests.append(DeleteMany({"member_id": member_id}))
+            for company_id, program in (set_fields.pop("programs") or {}).items():
+                requests.append(InsertOne({**program, "member_id": member_id, "company_id": company_id}))
+
+        def take(container, paths):
+            for path in [p for p in paths if p.startswith("programs.")]:
+                _, company_id, *rest = path.split(".", 2)
+                value = container.pop(path) if isinstance(container, dict) else container.remove(path)
+                yield company_id, (rest[0] if rest else None), value
+
+        per_program: Dict[str, Dict[str, Any]] = {}
+        for company_id, field, value in take(set_fields, list(set_fields)):
+            key = {"member_id": member_id, "company_id": company_id}
+            if field:
+                per_program.setdefault(company_id, {}).setdefault("$set", {})[field] = value
+            else:
+                requests.append(ReplaceOne(key, {**value, **key}, upsert=True))
+        for company_id, field, _ in take(unset_fields, list(unset_fields)):
+            if field:
+                per_program.setdefault(company_id, {}).setdefault("$unset", {})[field] = ""
+            else:
+                requests.append(DeleteOne({"member_id": member_id, "company_id": company_id}))
+        for company_id, field, amount in take(inc_fields, list(inc_fields)):
+            per_program.setdefault(company_id, {}).setdefault("$inc", {})[field] = amount
+
+        conditions: Dict[str, Dict[str, Any]] = {}
+        for company_id, field, condition in take(where, list(where)):
+            # A bare ``programs.<id>`` condition is an existence check, which
+            # matching the program document's key already implies
+            program_conditions = conditions.setdefault(company_id, {})
+            if field:
+                program_conditions[field] = condition
+        if len(conditions) > 1:
+            raise ValueError("normalized layout supports conditions on one program per update")
+
+        guarded = None
+        for company_id, update in per_program.items():
+            key = {"member_id": member_id, "company_id": company_id}
+            if company_id in conditions:
+                guarded = (key, conditions.pop(company_id), update)
+            else:
+                requests.append(UpdateOne(key, update, upsert="$unset" not in update))
+        for company_id, condition in conditions.items():
+            # A condition on a program this update does not write is a pure check
+            guarded = ({"member_id": member_id, "company_id": company_id}, condition,
+                       {"$set": {"company_id": company_id}})
+        return guarded, requests
+
+    def delete_member(self, member_id: str) -> bool:
+        deleted = self.members.delete_one({"id": member_id}).deleted_count == 1
+        if deleted and self.normalized:
+            self.programs.delete_many({"member_id": member_id})
+        return deleted
+
+    def count_members(self) -> int:
+        return self.members.count_documents({})
+
+    def total_points(self) -> int:
+        if self.normalized:
+            collection, pipeline = self.programs, []
+            field = "$current_balance"
+        else:
+            collection = self.members
+            pipeline = [
+                {"$project": {"programs": {"$objectToArray": "$programs"}}},
+                {"$unwind": "$programs"},
+            ]
+            field = "$programs.v.current_balance"
+        pipeline.append({"$group": {"_id": None, "total": {"$sum": field}}})
+        result = list(collection.aggregate(pipeline))
+        return result[0]["total"] if result else 0
+
+    # Programs
+    def get_program(self, member_id: str, company_id: str) -> Optional[Dict[str, Any]]:
+        if self.normalized:
+            return self.programs.find_one({"member_id": member_id, "company_id": company_id},
+                                          {"_id": 0, "member_id": 0})
+        member = self.members.find_one({"id": member_id},
+                                       {"_id": 0, f"programs.{company_id}": 1})
+        return (member or {}).get("programs", {}).get(company_id)
+
+    def list_programs_for_company(self, company_id: str) -> List[Dict[str, Any]]:
+        if self.normalized:
+            return list(self.programs.find({"company_id": company_id}, NO_ID))
+        members = self.members.find({f"programs.{company_id}": {"$exists": True}},
+                                    {"_id": 0, "id": 1, f"programs.{company_id}": 1})
+        return [{**m["programs"][company_id], "member_id": m["id"]} for m in members]
+
+    # Global log
+    def insert_log(self, entry: Dict[str, Any]) -> None:
+        self.global_log.insert_one(dict(entry))
+
+    def insert_logs(self, entries: List[Dict[str, Any]]) -> None:
+        if entries:
+            self.global_log.insert_many([dict(entry) for entry in entries])
+
+    def recent_logs(self, limit: int = 50) -> List[Dict[str, Any]]:
+        return list(self.global_log.find({}, NO_ID).sort("timestamp", -1).limit(limit))
+
+    def get_log(self, log_id: str) -> Optional[Dict[str, Any]]:
+        return (self.global_log.find_one({"id": log_id}, NO_ID)
+                or self.log_archive.find_one({"id": log_id}, NO_ID))
+
+    def _both_tiers(self, query: Dict[str, Any], order: int, limit: int = 0) -> List[Dict[str, Any]]:
+        """Entries matching ``query`` in the live log and the archive, merged in
+        (timestamp, id) order; an entry caught mid-archive shows up once."""
+        entries = {}
+        for collection in (self.log_archive, self.global_log):
+            cursor = collection.find(query, NO_ID).sort([("timestamp", order), ("id", order)]).limit(limit)
+            entries.update((entry["id"], entry) for entry in cursor)
+        merged = sorted(entries.values(), key=lambda entry: (entry["timestamp"], entry["id"]), reverse=order < 0)
+        return merged[:limit] if limit else merged
+
+    def logs_between(self, since: datetime, until: datetime) -> List[Dict[str, Any]]:
+        return self._both_tiers({"timestamp": {"$gte": since, "$lte": until}}, ASCENDING)
+
+    def claim_log_revert(self, log_id: str, revert_id: str) -> bool:
+        result = self.global_log.update_one({"id": log_id, "reverted_by": None},
+                                            {"$set": {"reverted_by": revert_id}})
+        return result.matched_count == 1
+
+    def release_log_revert(self, log_id: str) -> None:
+        self.global_log.update_one({"id": log_id}, {"$unset": {"reverted_by": ""}})
+
+    def member_logs(self, member_id: str, company_id: str = None, before: Tuple[datetime, str] = None,
+                    limit: int = 50) -> List[Dict[str, Any]]:
+        subject = {"member_id": member_id, **({"company_id": company_id} if company_id else {})}
+        query: Dict[str, Any] = {"$or": [subject, {"changes": {"$elemMatch": subject}}]}
+        if before:
+            timestamp, log_id = before
+            query = {"$and": [query, {"$or": [{"timestamp": {"$lt": timestamp}},
+                                              {"timestamp": timestamp, "id": {"$lt": log_id}}]}]}
+        return self._both_tiers(query, -1, limit)
+
+    def count_company_logs(self, company_id: str, other_than: str = None) -> int:
+        query = {"company_id": company_id}
+        if other_than is not None:
+            query["company_name"] = {"$ne": other_than}
+        return self.global_log.count_documents(query)
+
+    def rename_company_logs(self, company_id: str, name: str, limit: int) -> int:
+        query = {"company_id": company_id, "company_name": {"$ne": name}}
+        ids = [doc["_id"] for doc in self.global_log.find(query, {"_id": 1}).limit(limit)]
+        if not ids:
+            return 0
+        return self.global_log.update_many({"_id": {"$in": ids}}, {"$set": {"company_name": name}}).modified_count
+
+    def count_logs_since(self, since: datetime) -> int:
+        query = {"timestamp": {"$gte": since}}
+        return self.global_log.count_documents(query) + self.log_archive.count_documents(query)
+
+    def activity_counts(self, since: datetime, until: datetime, unit: str,
+                        by: str = None) -> List[Dict[str, Any]]:
+        # Needs MongoDB 5.0+ for $dateTrunc; the $match is a range on the timestamp index
+        trunc = {"date": "$timestamp", "unit": unit, "timezone": "UTC"}
+        if unit == "week":
+            trunc["startOfWeek"] = "monday"
+        match = {"$match": {"timestamp": {"$gte": since, "$lt": until}}}
+        pipeline = [
+            match,
+            {"$unionWith": {"coll": self.log_archive.name, "pipeline": [match]}},  # MongoDB 4.4+
+            {"$group": {"_id": {"bucket": {"$dateTrunc": trunc}, "key": f"${by}" if by else None},
+                        "count": {"$sum": 1}}},
+            {"$sort": {"_id.bucket": ASCENDING}},
+        ]
+        return [{"bucket": row["_id"]["bucket"], "key": row["_id"].get("key"), "count": row["count"]}
+                for row in self.global_log.aggregate(pipeline)]
+
+    def archive_logs(self, before: datetime, limit: int) -> int:
+        # Upsert first, delete second: a retry after a crash in between is harmless
+        entries = list(self.global_log.find({"timestamp": {"$lt": before}})
+                       .sort([("timestamp", ASCENDING), ("id", ASCENDING)]).limit(limit))
+        if not entries:
+            return 0
+        archived_at = datetime.utcnow()
+        self.log_archive.bulk_write([ReplaceOne({"id": entry["id"]}, {**entry, "archived_at": archived_at},
+                                                upsert=True) for entry in entries], ordered=False)
+        return self.global_log.delete_many({"_id": {"$in": [entry["_id"] for entry in entries]}}).deleted_count
+
+    # Balance history
+    def insert_balance_points(self, points: List[Dict[str, Any]]) -> None:
+        if points:
+            self.balances.insert_many([dict(point) for point in points], ordered=False)
+
+    def balance_history(self, member_id: str, company_id: str, since: datetime = None,
+                        until: datetime = None) -> List[Dict[str, Any]]:
+        query: Dict[str, Any] = {"member_id": member_id, "company_id": company_id}
+        if since or until:
+            query["ts"] = {**({"$gte": since} if since else {}), **({"$lte": until} if until else {})}
+        return list(self.balances.find(query, NO_ID).sort("ts", ASCENDING))
+
+    # State snapshots
+    def insert_state_snapshot(self, snapshot: Dict[str, Any]) -> None:
+        self.state_snapshots.insert_one(dict(snapshot))
+
+    def state_snapshot(self, at: datetime, after: bool = False) -> Optional[Dict[str, Any]]:
+        if after:
+            query, order = {"taken_at": {"$gt": at}}, ASCENDING
+        else:
+            query, order = {"taken_at": {"$lte": at}}, -1
+        return next(iter(self.state_snapshots.find(query, NO_ID).sort("taken_at", order).limit(1)), None)
+
+    # Expiring lots
+    def insert_lot(self, lot: Dict[str, Any]) -> None:
+        self.lots.insert_one(dict(lot))
+
+    def get_lot(self, lot_id: str) -> Optional[Dict[str, Any]]:
+        return self.lots.find_one({"id": lot_id}, NO_ID)
+
+    def delete_lot(self, lot_id: str) -> bool:
+        return self.lots.delete_one({"id": lot_id}).deleted_count == 1
+
+    def program_lots(self, member_id: str, company_id: str) -> List[Dict[str, Any]]:
+        query = {"member_id": member_id, "company_id": company_id}
+        return list(self.lots.find(query, NO_ID).sort("expires_on", ASCENDING))
+
+    def lots_expiring(self, since: str = None, until: str = None) -> List[Dict[str, Any]]:
+        query: Dict[str, Any] = {}
+        if since or until:
+            query["expires_on"] = {**({"$gte": since} if since else {}), **({"$lte": until} if until else {})}
+        return list(self.lots.find(query, NO_ID).sort("expires_on", ASCENDING))
+
+    def delete_lots(self, member_id: str = None, company_id: str = None) -> int:
+        query = {k: v for k, v in (("member_id", member_id), ("company_id", company_id)) if v}
+        return self.lots.delete_many(query).deleted_count
+
+    def move_lots(self, company_id: str, to_company_id: str) -> int:
+        return self.lots.update_many({"company_id": company_id},
+                                     {"$set": {"company_id": to_company_id}}).modified_count
+
+    # Post-its
+    def list_postits(self) -> List[Dict[str, Any]]:
+        return list(self.postits.find({}, NO_ID).sort("created_at", 1))
+
+    def get_postit(self, postit_id: str) -> Optional[Dict[str, Any]]:
+        return self.postits.find_one({"id": postit_id}, NO_ID)
+
+    def insert_postit(self, postit: Dict[str, Any]) -> None:
+        self.postits.insert_one(dict(postit))
+
+    def update_postit(self, postit_id: str, set_fields: Dict[str, Any]) -> bool:
+        result = self.postits.update_one({"id": postit_id}, {"$set": set_fields})
+        return result.matched_count == 1
+
+    def delete_postit(self, postit_id: str) -> bool:
+        return self.postits.delete_one({"id": postit_id}).deleted_count == 1
+
+
+def _carries_stamps(doc: Dict[str, Any], set_fields: Dict[str, Any]) -> bool:
+    stamps = {path: set_fields[path] for path in ("version", "updated_at") if path in set_fields}
+    return bool(stamps) and all(get_path(doc, path) == _stored(value) for path, value in stamps.items())
+
+
+def _stored(value: Any) -> Any:
+    """``value`` as it reads back from MongoDB, which keeps datetimes to the millisecond."""
+    if isinstance(value, datetime):
+        return value.replace(microsecond=value.microsecond // 1000 * 1000)
+    return value
+
+
+def _update_spec(set_fields: Dict[str, Any], unset_fields: Iterable[str],
+                 inc_fields: Dict[str, Any]) -> Dict[str, Any]:
+    update = {}
+    if set_fields:
+        update["$set"] = set_fields
+    if unset_fields:
+        update["$unset"] = {path: "" for path in unset_fields}
+    if inc_fields:
+        update["$inc"] = inc_fields
+    return update
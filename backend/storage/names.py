@@ -0,0 +1,17 @@
+"""Name normalization for uniqueness checks.
+
+``name_key("Tudo Azul") == name_key("TudoAzul") == name_key("tudo-azul")``:
+accents, case, spaces and punctuation are ignored, so names that only differ
+in how they were typed map to the same key.
+"""
+import unicodedata
+
+
+def fold(name: str) -> str:
+    """Accent- and case-insensitive form of ``name``."""
+    decomposed = unicodedata.normalize("NFKD", name)
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch)).casefold()
+
+
+def name_key(name: str) -> str:
+    return "".join(ch for ch in fold(name) if ch.isalnum())
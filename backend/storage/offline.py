@@ -0,0 +1,350 @@
+"""Offline write-ahead journal in front of MongoStorage.
+
+While MongoDB is reachable every call goes to Mongo and successful writes are
+mirrored into an in-memory snapshot, reloaded from Mongo every
+``OFFLINE_SNAPSHOT_REFRESH_SECONDS`` so mirrored logs and history stay bounded. When a call fails with a connection
+error the circuit opens: reads are served from the snapshot and writes are
+applied to it and appended (fsynced) to ``MONGO_OFFLINE_JOURNAL``, together
+with the ``updated_at`` the edit was based on.
+
+Every ``MONGO_RETRY_SECONDS`` the next call probes Mongo. Once it answers, the
+journal is replayed in batches of ``OFFLINE_REPLAY_BATCH``. An entry whose
+target changed remotely after its base ``updated_at`` (or disappeared), or a
+conditional update Mongo no longer matches, is not applied; it is kept in ``<journal>.conflicts`` and reported in the global
+log instead.
+"""
+import inspect
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from pymongo.errors import ConnectionFailure
+
+from . import codec
+from .base import Storage
+from .memory import MemoryStorage
+from .mongo import MongoStorage
+
+READ_METHODS = (
+    "list_companies", "get_company", "find_company_by_name", "count_companies",
+    "list_members", "get_member", "get_members", "find_member_by_name", "count_members", "total_points",
+    "get_program", "list_programs_for_company",
+    "recent_logs", "get_log", "logs_between", "count_logs_since", "count_company_logs", "member_logs",
+    "activity_counts", "balance_history",
+    "state_snapshot", "get_lot", "program_lots", "lots_expiring",
+    "list_postits", "get_postit",
+)
+WRITE_METHODS = (
+    "insert_company", "update_company", "delete_company",
+    "insert_member", "update_member", "bulk_update_members", "update_members", "delete_member",
+    "insert_log", "insert_logs", "rename_company_logs", "archive_logs", "insert_balance_points",
+    "claim_log_revert", "release_log_revert", "insert_state_snapshot",
+    "insert_lot", "delete_lot", "delete_lots", "move_lots",
+    "insert_postit", "update_postit", "delete_postit",
+)
+SNAPSHOT_LOG_LIMIT = 1000
+
+logger = logging.getLogger(__name__)
+
+
+class OfflineJournalStorage(Storage):
+    name = "mongo"
+
+    def __init__(self, primary: MongoStorage, journal_path: str,
+                 retry_seconds: float = None, batch_size: int = None, refresh_seconds: float = None):
+        self.primary = primary
+        self.snapshot = MemoryStorage()
+        self.journal_file = Path(journal_path)
+        self.journal_file.parent.mkdir(parents=True, exist_ok=True)
+        self.conflicts_file = self.journal_file.with_name(self.journal_file.name + ".conflicts")
+        self.retry_seconds = retry_seconds or float(os.getenv("MONGO_RETRY_SECONDS", "15"))
+        self.batch_size = batch_size or int(os.getenv("OFFLINE_REPLAY_BATCH", "100"))
+        self.refresh_seconds = refresh_seconds or float(os.getenv("OFFLINE_SNAPSHOT_REFRESH_SECONDS", "300"))
+        self._next_refresh = 0.0
+        self._lock = threading.RLock()
+        self._offline = False
+        self._next_probe = 0.0
+        self._pending: List[Dict[str, Any]] = self._read_journal()
+        if self.journal_file.exists():
+            self._rewrite_journal()  # drops a torn tail before we append again
+
+        if not self._reconnect():
+            # Keep edits from a previous run visible until we can replay them
+            for entry in self._pending:
+                getattr(self.snapshot, entry["op"])(*entry["args"])
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            **super().status(),
+            "offline": self._offline,
+            "pending_writes": len(self._pending),
+        }
+
+    def close(self) -> None:
+        self.primary.close()
+
+    def ensure_indexes(self) -> None:
+        # Retried on every reconnect while offline
+        self._read("ensure_indexes")
+
+    # Circuit breaker
+    def _open_circuit(self, error: Exception) -> None:
+        if not self._offline:
+            logger.warning("MongoDB unreachable (%s); journaling writes to %s", error, self.journal_file)
+        self._offline = True
+        self._next_probe = time.monotonic() + self.retry_seconds
+
+    def _reconnect(self) -> bool:
+        try:
+            self.primary.client.admin.command("ping")
+            self.primary.ensure_indexes()
+            self._replay()
+            self._refresh_snapshot()
+        except ConnectionFailure as e:
+            self._open_circuit(e)
+            return False
+        except Exception as e:
+            # e.g. an index build refused; stay offline and probe again later
+            logger.exception("Reconnecting to MongoDB failed")
+            self._open_circuit(e)
+            return False
+        if self._offline:
+            logger.info("MongoDB reachable again; offline journal replayed")
+        self._offline = False
+        return True
+
+    def _maybe_reconnect(self) -> None:
+        if self._offline and time.monotonic() >= self._next_probe:
+            self._reconnect()
+
+    def _refresh_snapshot(self) -> None:
+        self._next_refresh = time.monotonic() + self.refresh_seconds
+        self.snapshot._load_state({
+            "companies": self.primary.list_companies(),
+            "members": self.primary.list_members(),
+            "logs": list(reversed(self.primary.recent_logs(SNAPSHOT_LOG_LIMIT))),
+            "expiring_lots": self.primary.lots_expiring(),
+            "state_snapshots": [s for s in [self.primary.state_snapshot(datetime.utcnow())] if s],
+            "postits": self.primary.list_postits(),
+        })
+
+    def _maybe_refresh(self) -> None:
+        # Mirrored logs, balance points and state snapshots only ever grow;
+        # a periodic reload trims them back to what _refresh_snapshot keeps
+        if time.monotonic() >= self._next_refresh:
+            try:
+                self._refresh_snapshot()
+            except ConnectionFailure as e:
+                self._open_circuit(e)
+
+    # Delegation
+    def _read(self, method: str, *args) -> Any:
+        with self._lock:
+            self._maybe_reconnect()
+            if not self._offline:
+                try:
+                    return getattr(self.primary, method)(*args)
+                except ConnectionFailure as e:
+                    self._open_circuit(e)
+            return getattr(self.snapshot, method)(*args)
+
+    def _write(self, method: str, *args) -> Any:
+        with self._lock:
+            self._maybe_reconnect()
+            if not self._offline:
+                try:
+                    result = getattr(self.primary, method)(*args)
+                except ConnectionFailure as e:
+                    self._open_circuit(e)
+                else:
+                    getattr(self.snapshot, method)(*args)
+                    self._maybe_refresh()
+                    return result
+            self._append({
+                "op": method,
+                "args": list(args),
+                "base": self._base_version(method, args),
+                "recorded_at": datetime.utcnow(),
+            })
+            return getattr(self.snapshot, method)(*args)
+
+    def _base_version(self, method: str, args) -> Optional[datetime]:
+        """``updated_at`` of the document the offline edit was made against."""
+        if method == "update_member":
+            doc = self.snapshot.get_member(args[0])
+        elif method == "update_postit":
+            doc = self.snapshot.get_postit(args[0])
+        else:
+            return None
+        return doc.get("updated_at") if doc else None
+
+    # Journal file
+    def _read_journal(self) -> List[Dict[str, Any]]:
+        if not self.journal_file.exists():
+            return []
+        entries = []
+        with open(self.journal_file, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entries.append(codec.loads(line))
+                except ValueError:
+                    break  # torn last line from a crash
+        return entries
+
+    def _append(self, entry: Dict[str, Any]) -> None:
+        with open(self.journal_file, "a", encoding="utf-8") as f:
+            f.write(codec.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._pending.append(entry)
+
+    def _rewrite_journal(self) -> None:
+        tmp = self.journal_file.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            for entry in self._pending:
+                f.write(codec.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.journal_file)
+
+    # Replay
+    def _replay(self) -> None:
+        while self._pending:
+            batch = self._pending[:self.batch_size]
+            remote = self._remote_versions(batch)
+            try:
+                for entry in batch:
+                    try:
+                        conflict = self._conflict(entry, remote)
+                        if conflict:
+                            self._record_conflict(entry, conflict)
+                        else:
+                            result = getattr(self.primary, entry["op"])(*entry["args"])
+                            self._settle(entry, result, remote)
+                    except ConnectionFailure:
+                        raise
+                    except Exception as e:
+                        # Refused remotely (duplicate name, failed operation...): set
+                        # it aside rather than blocking every entry behind it
+                        self._record_conflict(entry, f"erro ao reaplicar: {e}")
+                    self._pending.pop(0)
+            finally:
+                # Checkpoint even on failure so applied entries never replay twice
+                self._rewrite_journal()
+            logger.info("Offline journal: %d writes replayed, %d pending", len(batch), len(self._pending))
+
+    def _settle(self, entry: Dict[str, Any], result: Any, remote: Dict[Any, Any]) -> None:
+        """Track what a replayed entry applied; conditional updates Mongo rejected are conflicts."""
+        op = entry["op"]
+        if op == "update_member" and result is False:
+            self._record_conflict(entry, "registro alterado durante a desconexão")
+        elif op == "bulk_update_members":
+            applied = []
+            for update, ok in zip(entry["args"][0], result):
+                if ok:
+                    applied.append(update)
+                else:
+                    self._record_conflict({**entry, "args": [[update]]}, "registro alterado durante a desconexão")
+            self._track({**entry, "args": [applied]}, remote)
+        else:
+            self._track(entry, remote)
+
+    @staticmethod
+    def _track(entry: Dict[str, Any], remote: Dict[Any, Any]) -> None:
+        """Keep the prefetched versions current as the batch is applied."""
+        op, args = entry["op"], entry["args"]
+        if op in ("insert_member", "insert_postit"):
+            kind = "member" if op == "insert_member" else "postit"
+            remote[(kind, args[0]["id"])] = args[0].get("updated_at")
+        elif op in ("update_member", "update_postit"):
+            kind = "member" if op == "update_member" else "postit"
+            if "updated_at" in args[1]:
+                remote[(kind, args[0])] = args[1]["updated_at"]
+        elif op == "bulk_update_members":
+            for update in args[0]:
+                if "updated_at" in (update.get("set_fields") or {}):
+                    remote[("member", update["member_id"])] = update["set_fields"]["updated_at"]
+        elif op in ("delete_member", "delete_postit"):
+            kind = "member" if op == "delete_member" else "postit"
+            remote.pop((kind, args[0]), None)
+
+    def _remote_versions(self, batch: List[Dict[str, Any]]) -> Dict[Any, Any]:
+        """Current ``updated_at`` of every document the batch touches, one query per collection."""
+        member_ids = {e["args"][0] for e in batch if e["op"] in ("update_member", "delete_member")}
+        member_ids |= {e["args"][0]["id"] for e in batch if e["op"] == "insert_member"}
+        member_ids |= {u["member_id"] for e in batch if e["op"] == "bulk_update_members" for u in e["args"][0]}
+        postit_ids = {e["args"][0] for e in batch if e["op"] in ("update_postit", "delete_postit")}
+        versions: Dict[Any, Any] = {}
+        for doc in self.primary.members.find({"id": {"$in": list(member_ids)}},
+                                             {"_id": 0, "id": 1, "name": 1, "updated_at": 1}):
+            versions[("member", doc["id"])] = doc.get("updated_at")
+        for doc in self.primary.postits.find({"id": {"$in": list(postit_ids)}},
+                                             {"_id": 0, "id": 1, "updated_at": 1}):
+            versions[("postit", doc["id"])] = doc.get("updated_at")
+        return versions
+
+    def _conflict(self, entry: Dict[str, Any], remote: Dict[Any, Any]) -> Optional[str]:
+        op, args = entry["op"], entry["args"]
+        if op == "insert_company":
+            if self.primary.find_company_by_name(args[0]["name"]):
+                return "companhia com esse nome já existe"
+        elif op == "insert_member":
+            if ("member", args[0]["id"]) in remote:
+                return "membro já existe"
+            if self.primary.find_member_by_name(args[0]["name"]):
+                return "membro com esse nome já existe"
+        elif op in ("update_member", "update_postit"):
+            key = ("member" if op == "update_member" else "postit", args[0])
+            if key not in remote:
+                return "registro removido durante a desconexão"
+            current, base = remote[key], entry.get("base")
+            if base is not None and current is not None and current > base:
+                return "registro alterado durante a desconexão"
+        return None
+
+    def _record_conflict(self, entry: Dict[str, Any], reason: str) -> None:
+        with open(self.conflicts_file, "a", encoding="utf-8") as f:
+            f.write(codec.dumps({**entry, "reason": reason}) + "\n")
+        args = entry["args"]
+        if entry["op"] == "update_member":
+            member_id = args[0]
+        elif entry["op"] == "bulk_update_members" and len(args[0]) == 1:
+            member_id = args[0][0]["member_id"]
+        else:
+            member_id = ""
+        self.primary.insert_log({
+            "id": str(uuid.uuid4()),
+            "member_id": member_id,
+            "member_name": "",
+            "company_id": "",
+            "company_name": "",
+            "field_changed": entry["op"],
+            "old_value": "offline",
+            "new_value": f"conflito: {reason}",
+            "timestamp": datetime.utcnow(),
+            "change_type": "conflict",
+        })
+        logger.warning("Offline journal conflict on %s: %s", entry["op"], reason)
+
+
+def _delegate(kind: str, method: str):
+    signature = inspect.signature(getattr(Storage, method))
+
+    def call(self, *args, **kwargs):
+        # Journal entries replay positionally, so normalize keyword arguments
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        return getattr(self, kind)(method, *bound.args[1:])
+    call.__name__ = method
+    return call
+
+
+for _method in READ_METHODS:
+    setattr(OfflineJournalStorage, _method, _delegate("_read", _method))
+for _method in WRITE_METHODS:
+    setattr(OfflineJournalStorage, _method, _delegate("_write", _method))
@@ -0,0 +1,103 @@
+"""Dotted-path helpers shared by the in-process storage engines.
+
+Updates are expressed the same way MongoDB expresses them
+(``{"programs.latam.current_balance": 1000}``) so every engine accepts the
+exact same mutation payloads the endpoints build.
+"""
+from typing import Any, Dict, Iterable, Tuple
+
+_MISSING = object()
+
+
+def clone(value: Any) -> Any:
+    """Copy nested dicts/lists so callers never alias engine state."""
+    if isinstance(value, dict):
+        return {k: clone(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [clone(v) for v in value]
+    return value
+
+
+def split(path: str) -> Tuple[str, ...]:
+    return tuple(path.split("."))
+
+
+def get_path(doc: Dict[str, Any], path: str, default: Any = None) -> Any:
+    current: Any = doc
+    for key in split(path):
+        if not isinstance(current, dict) or key not in current:
+            return default
+        current = current[key]
+    return current
+
+
+def set_path(doc: Dict[str, Any], path: str, value: Any) -> None:
+    keys = split(path)
+    current = doc
+    for key in keys[:-1]:
+        nxt = current.get(key)
+        if not isinstance(nxt, dict):
+            nxt = {}
+            current[key] = nxt
+        current = nxt
+    current[keys[-1]] = clone(value)
+
+
+def unset_path(doc: Dict[str, Any], path: str) -> None:
+    keys = split(path)
+    current = doc
+    for key in keys[:-1]:
+        current = current.get(key)
+        if not isinstance(current, dict):
+            return
+    current.pop(keys[-1], None)
+
+
+def apply_update(doc: Dict[str, Any], set_fields: Dict[str, Any] = None,
+                 unset_fields: Iterable[str] = (), inc_fields: Dict[str, Any] = None) -> None:
+    """Apply ``$set``/``$unset``/``$inc`` style changes to ``doc`` in place."""
+    for path, value in (set_fields or {}).items():
+        set_path(doc, path, value)
+    for path in unset_fields or ():
+        unset_path(doc, path)
+    for path, amount in (inc_fields or {}).items():
+        set_path(doc, path, (get_path(doc, path) or 0) + amount)
+
+
+OPERATORS = ("$in", "$ne", "$exists", "$gte", "$gt", "$lte", "$lt")
+
+
+def _matches(value: Any, condition: Any) -> bool:
+    if isinstance(condition, dict) and any(k.startswith("$") for k in condition):
+        unknown = [op for op in condition if op not in OPERATORS]
+        if unknown:
+            # Matching them as "true" would let a guarded write through unchecked
+            raise ValueError(f"unsupported filter operator {unknown[0]!r}; expected one of {OPERATORS}")
+        for op, operand in condition.items():
+            if op == "$in" and value not in operand:
+                return False
+            if op == "$ne" and value == operand:
+                return False
+            if op == "$exists" and (value is not None) != bool(operand):
+                return False
+            if op in ("$gte", "$gt", "$lte", "$lt"):
+                if value is None:
+                    return False
+                if op == "$gte" and not value >= operand:
+                    return False
+                if op == "$gt" and not value > operand:
+                    return False
+                if op == "$lte" and not value <= operand:
+                    return False
+                if op == "$lt" and not value < operand:
+                    return False
+        return True
+    return value == condition
+
+
+def matches(doc: Dict[str, Any], where: Dict[str, Any] = None) -> bool:
+    """Evaluate a Mongo-style filter (equality, ``$in``, ``$ne``, ``$exists``,
+    ``$gte``/``$gt``/``$lte``/``$lt``) against ``doc``; missing fields read as None.
+
+    Any other ``$`` operator raises ValueError rather than being ignored."""
+    return all(_matches(get_path(doc, path), condition) for path, condition in (where or {}).items())
@@ -0,0 +1,797 @@
+"""SQLite storage engine (WAL mode, one connection per thread).
+
+Members, programs, custom fields, companies, the global log and post-its live
+in normalized tables. Keys the API does not model explicitly are kept in a
+JSON ``extra`` column so documents round-trip unchanged. Dashboard numbers
+come straight from SQL aggregates.
+"""
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from . import codec
+from .base import DuplicateError, Storage
+from .names import fold, name_key
+from .paths import apply_update, get_path, matches, unset_path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS companies (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    color TEXT,
+    extra TEXT,
+    name_key TEXT
+);
+CREATE INDEX IF NOT EXISTS companies_name ON companies(name);
+
+CREATE TABLE IF NOT EXISTS members (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    created_at TEXT,
+    updated_at TEXT,
+    extra TEXT,
+    name_fold TEXT
+);
+CREATE INDEX IF NOT EXISTS members_name ON members(name);
+
+CREATE TABLE IF NOT EXISTS programs (
+    member_id TEXT NOT NULL REFERENCES members(id) ON DELETE CASCADE,
+    company_id TEXT NOT NULL,
+    login TEXT,
+    password TEXT,
+    cpf TEXT,
+    card_number TEXT,
+    current_balance INTEGER,
+    elite_tier TEXT,
+    notes TEXT,
+    last_updated TEXT,
+    last_change TEXT,
+    extra TEXT,
+    PRIMARY KEY (member_id, company_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS programs_company ON programs(company_id);
+
+CREATE TABLE IF NOT EXISTS custom_fields (
+    member_id TEXT NOT NULL,
+    company_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (member_id, company_id, name),
+    FOREIGN KEY (member_id, company_id)
+        REFERENCES programs(member_id, company_id) ON DELETE CASCADE
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS custom_fields_company ON custom_fields(company_id);
+
+CREATE TABLE IF NOT EXISTS global_log (
+    id TEXT PRIMARY KEY,
+    member_id TEXT,
+    member_name TEXT,
+    company_id TEXT,
+    company_name TEXT,
+    field_changed TEXT,
+    old_value TEXT,
+    new_value TEXT,
+    timestamp TEXT NOT NULL,
+    change_type TEXT,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS global_log_timestamp ON global_log(timestamp);
+CREATE INDEX IF NOT EXISTS global_log_member ON global_log(member_id, timestamp);
+CREATE INDEX IF NOT EXISTS global_log_program ON global_log(member_id, company_id, timestamp);
+CREATE INDEX IF NOT EXISTS global_log_company ON global_log(company_id);
+
+-- One row per program touched by a changeset entry, so histories find them too
+CREATE TABLE IF NOT EXISTS log_changes (
+    log_id TEXT NOT NULL REFERENCES global_log(id) ON DELETE CASCADE,
+    member_id TEXT NOT NULL,
+    company_id TEXT,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS log_changes_member ON log_changes(member_id, timestamp);
+CREATE INDEX IF NOT EXISTS log_changes_program ON log_changes(member_id, company_id, timestamp);
+CREATE INDEX IF NOT EXISTS log_changes_log ON log_changes(log_id);
+
+-- Entries past the retention period (archive_logs), same layout plus archived_at
+CREATE TABLE IF NOT EXISTS global_log_archive (
+    id TEXT PRIMARY KEY,
+    member_id TEXT,
+    member_name TEXT,
+    company_id TEXT,
+    company_name TEXT,
+    field_changed TEXT,
+    old_value TEXT,
+    new_value TEXT,
+    timestamp TEXT NOT NULL,
+    change_type TEXT,
+    extra TEXT,
+    archived_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS global_log_archive_timestamp ON global_log_archive(timestamp);
+CREATE INDEX IF NOT EXISTS global_log_archive_member ON global_log_archive(member_id, timestamp);
+CREATE INDEX IF NOT EXISTS global_log_archive_program ON global_log_archive(member_id, company_id, timestamp);
+
+CREATE TABLE IF NOT EXISTS log_changes_archive (
+    log_id TEXT NOT NULL REFERENCES global_log_archive(id) ON DELETE CASCADE,
+    member_id TEXT NOT NULL,
+    company_id TEXT,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS log_changes_archive_member ON log_changes_archive(member_id, timestamp);
+CREATE INDEX IF NOT EXISTS log_changes_archive_program ON log_changes_archive(member_id, company_id, timestamp);
+
+-- Both tiers, for the reads that cover archived entries
+CREATE VIEW IF NOT EXISTS all_logs AS
+    SELECT *, NULL AS archived_at FROM global_log UNION ALL SELECT * FROM global_log_archive;
+CREATE VIEW IF NOT EXISTS all_log_changes AS
+    SELECT * FROM log_changes UNION ALL SELECT * FROM log_changes_archive;
+
+CREATE TABLE IF NOT EXISTS balance_history (
+    member_id TEXT NOT NULL,
+    company_id TEXT NOT NULL,
+    ts TEXT NOT NULL,
+    balance INTEGER
+);
+CREATE INDEX IF NOT EXISTS balance_history_program ON balance_history(member_id, company_id, ts);
+
+CREATE TABLE IF NOT EXISTS state_snapshots (
+    id TEXT PRIMARY KEY,
+    taken_at TEXT NOT NULL,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS state_snapshots_taken ON state_snapshots(taken_at);
+
+CREATE TABLE IF NOT EXISTS expiring_lots (
+    id TEXT PRIMARY KEY,
+    member_id TEXT NOT NULL,
+    company_id TEXT NOT NULL,
+    amount INTEGER,
+    expires_on TEXT NOT NULL,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS expiring_lots_expiry ON expiring_lots(expires_on);
+CREATE INDEX IF NOT EXISTS expiring_lots_program ON expiring_lots(member_id, company_id, expires_on);
+
+CREATE TABLE IF NOT EXISTS postits (
+    id TEXT PRIMARY KEY,
+    content TEXT,
+    created_at TEXT,
+    updated_at TEXT
+);
+CREATE INDEX IF NOT EXISTS postits_created ON postits(created_at);
+"""
+
+COMPANY_COLUMNS = ("id", "name", "color")
+MEMBER_COLUMNS = ("id", "name", "created_at", "updated_at")
+PROGRAM_COLUMNS = ("login", "password", "cpf", "card_number", "current_balance",
+                   "elite_tier", "notes", "last_updated", "last_change")
+LOG_COLUMNS = ("id", "member_id", "member_name", "company_id", "company_name",
+               "field_changed", "old_value", "new_value", "timestamp", "change_type")
+ARCHIVED_LOG_COLUMNS = LOG_COLUMNS + ("archived_at",)
+POSTIT_COLUMNS = ("id", "content", "created_at", "updated_at")
+BALANCE_COLUMNS = ("member_id", "company_id", "ts", "balance")
+LOT_COLUMNS = ("id", "member_id", "company_id", "amount", "expires_on")
+SNAPSHOT_COLUMNS = ("id", "taken_at")
+# Bucket starts as ISO strings (weeks start on Monday, like buckets.truncate)
+BUCKET_EXPRESSIONS = {
+    "hour": "strftime('%Y-%m-%dT%H:00:00', timestamp)",
+    "day": "date(timestamp)",
+    "week": "date(timestamp, 'weekday 0', '-6 days')",
+}
+ACTIVITY_KEYS = ("member_id", "company_id", "change_type")
+DATETIME_COLUMNS = {"created_at", "updated_at", "last_updated", "timestamp", "ts", "taken_at", "archived_at"}
+
+INSERT_PROGRAM = (
+    f"INSERT OR REPLACE INTO programs (member_id, company_id, {', '.join(PROGRAM_COLUMNS)}, extra) "
+    f"VALUES (?, ?, {', '.join('?' * len(PROGRAM_COLUMNS))}, ?)"
+)
+INSERT_LOG = (
+    f"INSERT INTO global_log ({', '.join(LOG_COLUMNS)}, extra) VALUES ({', '.join('?' * len(LOG_COLUMNS))}, ?)"
+)
+INSERT_LOG_CHANGE = "INSERT INTO log_changes (log_id, member_id, company_id, timestamp) VALUES (?, ?, ?, ?)"
+INSERT_CUSTOM_FIELD = (
+    "INSERT OR REPLACE INTO custom_fields (member_id, company_id, name, value) VALUES (?, ?, ?, ?)"
+)
+
+
+def _to_sql(column: str, value: Any) -> Any:
+    if column in DATETIME_COLUMNS and isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        # Fixed width so ISO strings sort chronologically
+        return value.isoformat(timespec="microseconds")
+    return value
+
+
+def _from_row(row: sqlite3.Row, columns: Iterable[str]) -> Dict[str, Any]:
+    doc = {}
+    for column in columns:
+        value = row[column]
+        if value is None:
+            continue
+        if column in DATETIME_COLUMNS and isinstance(value, str):
+            value = datetime.fromisoformat(value)
+        doc[column] = value
+    if "extra" in row.keys() and row["extra"]:
+        doc.update(codec.loads(row["extra"]))
+    return doc
+
+
+def _log_change_rows(entries: Iterable[Dict[str, Any]]) -> List[tuple]:
+    rows = set()
+    for entry in entries:
+        for change in entry.get("changes") or []:
+            if change.get("member_id"):
+                rows.add((entry["id"], change["member_id"], change.get("company_id") or None,
+                          _to_sql("timestamp", entry["timestamp"])))
+    return list(rows)
+
+
+def _split(doc: Dict[str, Any], columns: Iterable[str]) -> Tuple[List[Any], Optional[str]]:
+    """Column values in order plus the JSON-encoded leftovers."""
+    values = [_to_sql(column, doc.get(column)) for column in columns]
+    extra = {k: v for k, v in doc.items() if k not in columns}
+    return values, codec.dumps(extra) if extra else None
+
+
+class SQLiteStorage(Storage):
+    name = "sqlite"
+
+    def __init__(self, path: str = None):
+        self.path = path or os.getenv("SQLITE_PATH") or os.path.join(
+            os.getenv("STORAGE_PATH", "data"), "milhas.db")
+        if self.path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        self._conn().executescript(SCHEMA)
+        self._migrate()
+
+    def _migrate(self) -> None:
+        # Normalized-name columns behind the unique name indexes
+        self._add_key_column("companies", "name_key", name_key)
+        self._add_key_column("members", "name_fold", fold)
+
+    def _add_key_column(self, table: str, column: str, key_of) -> None:
+        conn = self._conn()
+        if column not in {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} TEXT")
+        # Backfill; rows that collide with an earlier one keep NULL until merged/renamed
+        with self._tx() as conn:
+            taken = {row[0] for row in conn.execute(
+                f"SELECT {column} FROM {table} WHERE {column} IS NOT NULL")}
+            for row in conn.execute(
+                    f"SELECT id, name FROM {table} WHERE {column} IS NULL ORDER BY rowid").fetchall():
+                key = key_of(row["name"])
+                if key not in taken:
+                    conn.execute(f"UPDATE {table} SET {column} = ? WHERE id = ?", (key, row["id"]))
+                    taken.add(key)
+        conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {table}_{column} ON {table}({column})")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Autocommit mode; transactions are opened explicitly in _tx()
+            conn = sqlite3.connect(self.path, isolation_level=None,
+                                   check_same_thread=False, cached_statements=256)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            conn.execute("PRAGMA busy_timeout=5000")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextmanager
+    def _tx(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def close(self) -> None:
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+    # Companies
+    def list_companies(self) -> List[Dict[str, Any]]:
+        rows = self._conn().execute("SELECT * FROM companies ORDER BY rowid")
+        return [_from_row(row, COMPANY_COLUMNS) for row in rows]
+
+    def get_company(self, company_id: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute("SELECT * FROM companies WHERE id = ?", (company_id,)).fetchone()
+        return _from_row(row, COMPANY_COLUMNS) if row else None
+
+    def find_company_by_name(self, name: str) -> Optional[Dict[str, Any]]:
+        # Un-keyed rows are duplicates awaiting a merge; prefer the keyed one
+        row = self._conn().execute(
+            "SELECT * FROM companies WHERE name_key = ? OR name = ? "
+            "ORDER BY name_key IS NULL, rowid LIMIT 1", (name_key(name), name)).fetchone()
+        return _from_row(row, COMPANY_COLUMNS) if row else None
+
+    def insert_company(self, company: Dict[str, Any]) -> None:
+        values, extra = _split(company, COMPANY_COLUMNS)
+        try:
+            with self._tx() as conn:
+                conn.execute("INSERT INTO companies (id, name, color, extra, name_key) "
+                             "VALUES (?, ?, ?, ?, ?)", (*values, extra, name_key(company["name"])))
+        except sqlite3.IntegrityError as e:
+            raise DuplicateError(str(e)) from e
+
+    def update_company(self, company_id: str, set_fields: Dict[str, Any]) -> bool:
+        try:
+            with self._tx() as conn:
+                row = conn.execute("SELECT * FROM companies WHERE id = ?", (company_id,)).fetchone()
+                if row is None:
+                    return False
+                company = _from_row(row, COMPANY_COLUMNS)
+                apply_update(company, set_fields)
+                values, extra = _split(company, COMPANY_COLUMNS)
+                key = name_key(company["name"]) if "name" in set_fields else row["name_key"]
+                conn.execute("UPDATE companies SET name = ?, color = ?, extra = ?, name_key = ? WHERE id = ?",
+                             (*values[1:], extra, key, company_id))
+        except sqlite3.IntegrityError as e:
+            raise DuplicateError(str(e)) from e
+        return True
+
+    def delete_company(self, company_id: str) -> bool:
+        with self._tx() as conn:
+            return conn.execute("DELETE FROM companies WHERE id = ?", (company_id,)).rowcount == 1
+
+    def count_companies(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM companies").fetchone()[0]
+
+    # Members
+    def _assemble(self, member_rows, program_rows, field_rows) -> List[Dict[str, Any]]:
+        members = {}
+        for row in member_rows:
+            member = _from_row(row, MEMBER_COLUMNS)
+            member["programs"] = {}
+            members[member["id"]] = member
+        for row in program_rows:
+            program = {"company_id": row["company_id"]}
+            program.update(_from_row(row, PROGRAM_COLUMNS))
+            program["custom_fields"] = {}
+            members[row["member_id"]]["programs"][row["company_id"]] = program
+        for row in field_rows:
+            program = members[row["member_id"]]["programs"][row["company_id"]]
+            program["custom_fields"][row["name"]] = codec.loads(row["value"])
+        return list(members.values())
+
+    def list_members(self) -> List[Dict[str, Any]]:
+        conn = self._conn()
+        return self._assemble(
+            conn.execute("SELECT * FROM members ORDER BY COALESCE(name_fold, lower(name)), name"),
+            conn.execute("SELECT * FROM programs"),
+            conn.execute("SELECT * FROM custom_fields"),
+        )
+
+    def get_member(self, member_id: str, programs: bool = True) -> Optional[Dict[str, Any]]:
+        conn = self._conn()
+        if not programs:
+            row = conn.execute("SELECT * FROM members WHERE id = ?", (member_id,)).fetchone()
+            return _from_row(row, MEMBER_COLUMNS) if row else None
+        members = self._assemble(
+            conn.execute("SELECT * FROM members WHERE id = ?", (member_id,)),
+            conn.execute("SELECT * FROM programs WHERE member_id = ?", (member_id,)),
+            conn.execute("SELECT * FROM custom_fields WHERE member_id = ?", (member_id,)),
+        )
+        return members[0] if members else None
+
+    def get_members(self, member_ids: Iterable[str]) -> List[Dict[str, Any]]:
+        member_ids = list(dict.fromkeys(member_ids))
+        if not member_ids:
+            return []
+        conn = self._conn()
+        marks = ", ".join("?" * len(member_ids))
+        return self._assemble(
+            conn.execute(f"SELECT * FROM members WHERE id IN ({marks}) ORDER BY rowid", member_ids),
+            conn.execute(f"SELECT * FROM programs WHERE member_id IN ({marks})", member_ids),
+            conn.execute(f"SELECT * FROM custom_fields WHERE member_id IN ({marks})", member_ids),
+        )
+
+    def find_member_by_name(self, name: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute(
+            "SELECT id FROM members WHERE name_fold = ? OR name = ? "
+            "ORDER BY name_fold IS NULL, rowid LIMIT 1", (fold(name), name)).fetchone()
+        return self.get_member(row["id"]) if row else None
+
+    def insert_member(self, member: Dict[str, Any]) -> None:
+        member = dict(member)
+        programs = member.pop("programs", {}) or {}
+        values, extra = _split(member, MEMBER_COLUMNS)
+        with self._tx() as conn:
+            try:
+                conn.execute("INSERT INTO members (id, name, created_at, updated_at, extra, name_fold) "
+                             "VALUES (?, ?, ?, ?, ?, ?)", (*values, extra, fold(member["name"])))
+            except sqlite3.IntegrityError as e:
+                raise DuplicateError(str(e)) from e
+            for company_id, program in programs.items():
+                self._write_program(conn, member["id"], company_id, program)
+
+    def _write_program(self, conn, member_id: str, company_id: str, program: Dict[str, Any]) -> None:
+        program = {k: v for k, v in program.items() if k != "company_id"}
+        custom_fields = program.pop("custom_fields", None) or {}
+        values, extra = _split(program, PROGRAM_COLUMNS)
+        conn.execute("DELETE FROM custom_fields WHERE member_id = ? AND company_id = ?",
+                     (member_id, company_id))
+        conn.execute(INSERT_PROGRAM, (member_id, company_id, *values, extra))
+        conn.executemany(INSERT_CUSTOM_FIELD, [
+            (member_id, company_id, name, codec.dumps(value))
+            for name, value in custom_fields.items()
+        ])
+
+    def update_member(self, member_id: str, set_fields: Dict[str, Any] = None,
+                      unset_fields: Iterable[str] = (), inc_fields: Dict[str, Any] = None,
+                      where: Dict[str, Any] = None) -> bool:
+        set_fields = dict(set_fields or {})
+        with self._tx() as conn:
+            row = conn.execute("SELECT * FROM members WHERE id = ?", (member_id,)).fetchone()
+            if row is None:
+                return False
+            # The IMMEDIATE transaction holds the write lock, so checking the
+            # filter and resolving increments here is race-free.
+            doc = None
+            if where or any(not self._is_program_column(p) for p in inc_fields or {}):
+                doc = self.get_member(member_id)
+                if not matches(doc, where):
+                    return False
+            for path, amount in (inc_fields or {}).items():
+                if self._is_program_column(path):
+                    _, company_id, field = path.split(".")
+                    conn.execute("INSERT OR IGNORE INTO programs (member_id, company_id) VALUES (?, ?)",
+                                 (member_id, company_id))
+                    conn.execute(f"UPDATE programs SET {field} = COALESCE({field}, 0) + ? "
+                                 "WHERE member_id = ? AND company_id = ?", (amount, member_id, company_id))
+                else:
+                    set_fields[path] = (get_path(doc, path) or 0) + amount
+            member_set, member_unset = {}, []
+            for path, value in (set_fields or {}).items():
+                if path == "programs":
+                    conn.execute("DELETE FROM programs WHERE member_id = ?", (member_id,))
+                    for company_id, program in (value or {}).items():
+                        self._write_program(conn, member_id, company_id, program)
+                elif path.startswith("programs."):
+                    self._set_program_path(conn, member_id, path.split(".", 2)[1:], value)
+                else:
+                    member_set[path] = value
+            for path in unset_fields or ():
+                if path.startswith("programs."):
+                    self._unset_program_path(conn, member_id, path.split(".", 2)[1:])
+                else:
+                    member_unset.append(path)
+            if member_set or member_unset:
+                member = _from_row(row, MEMBER_COLUMNS)
+                apply_update(member, member_set, member_unset)
+                values, extra = _split(member, MEMBER_COLUMNS)
+                name_fold = fold(member["name"]) if "name" in member_set else row["name_fold"]
+                try:
+                    conn.execute("UPDATE members SET name = ?, created_at = ?, updated_at = ?, extra = ?, "
+                                 "name_fold = ? WHERE id = ?", (*values[1:], extra, name_fold, member_id))
+                except sqlite3.IntegrityError as e:
+                    raise DuplicateError(str(e)) from e
+        return True
+
+    @staticmethod
+    def _is_program_column(path: str) -> bool:
+        parts = path.split(".")
+        return len(parts) == 3 and parts[0] == "programs" and parts[2] in PROGRAM_COLUMNS
+
+    def _set_program_path(self, conn, member_id: str, parts: List[str], value: Any) -> None:
+        company_id = parts[0]
+        if len(parts) == 1:
+            self._write_program(conn, member_id, company_id, value or {})
+            return
+        conn.execute("INSERT OR IGNORE INTO programs (member_id, company_id) VALUES (?, ?)",
+                     (member_id, company_id))
+        field, _, rest = parts[1].partition(".")
+        if field in PROGRAM_COLUMNS and not rest:
+            conn.execute(f"UPDATE programs SET {field} = ? WHERE member_id = ? AND company_id = ?",
+                         (_to_sql(field, value), member_id, company_id))
+        elif field == "custom_fields" and not rest:
+            conn.execute("DELETE FROM custom_fields WHERE member_id = ? AND company_id = ?",
+                         (member_id, company_id))
+            conn.executemany(INSERT_CUSTOM_FIELD, [
+                (member_id, company_id, name, codec.dumps(v)) for name, v in (value or {}).items()
+            ])
+        elif field == "custom_fields":
+            conn.execute(INSERT_CUSTOM_FIELD, (member_id, company_id, rest, codec.dumps(value)))
+        else:
+            self._update_program_extra(conn, member_id, company_id, {parts[1]: value}, [])
+
+    def _unset_program_path(self, conn, member_id: str, parts: List[str]) -> None:
+        company_id = parts[0]
+        if len(parts) == 1:
+            conn.execute("DELETE FROM programs WHERE member_id = ? AND company_id = ?",
+                         (member_id, company_id))
+            return
+        field, _, rest = parts[1].partition(".")
+        if field in PROGRAM_COLUMNS and not rest:
+            conn.execute(f"UPDATE programs SET {field} = NULL WHERE member_id = ? AND company_id = ?",
+                         (member_id, company_id))
+        elif field == "custom_fields":
+            sql = "DELETE FROM custom_fields WHERE member_id = ? AND company_id = ?"
+            params = (member_id, company_id)
+            if rest:
+                sql += " AND name = ?"
+                params += (rest,)
+            conn.execute(sql, params)
+        else:
+            self._update_program_extra(conn, member_id, company_id, {}, [parts[1]])
+
+    def _update_program_extra(self, conn, member_id: str, company_id: str,
+                              set_fields: Dict[str, Any], unset_fields: List[str]) -> None:
+        row = conn.execute("SELECT extra FROM programs WHERE member_id = ? AND company_id = ?",
+                           (member_id, company_id)).fetchone()
+        if row is None:
+            return
+        extra = codec.loads(row["extra"]) if row["extra"] else {}
+        apply_update(extra, set_fields)
+        for path in unset_fields:
+            unset_path(extra, path)
+        conn.execute("UPDATE programs SET extra = ? WHERE member_id = ? AND company_id = ?",
+                     (codec.dumps(extra) if extra else None, member_id, company_id))
+
+    def delete_member(self, member_id: str) -> bool:
+        with self._tx() as conn:
+            return conn.execute("DELETE FROM members WHERE id = ?", (member_id,)).rowcount == 1
+
+    def count_members(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM members").fetchone()[0]
+
+    # Programs
+    def _program_rows(self, program_rows, field_rows) -> List[Dict[str, Any]]:
+        programs = {}
+        for row in program_rows:
+            program = {"company_id": row["company_id"]}
+            program.update(_from_row(row, PROGRAM_COLUMNS))
+            program["custom_fields"] = {}
+            program["member_id"] = row["member_id"]
+            programs[(row["member_id"], row["company_id"])] = program
+        for row in field_rows:
+            programs[(row["member_id"], row["company_id"])]["custom_fields"][row["name"]] = \
+                codec.loads(row["value"])
+        return list(programs.values())
+
+    def get_program(self, member_id: str, company_id: str) -> Optional[Dict[str, Any]]:
+        conn = self._conn()
+        key = (member_id, company_id)
+        programs = self._program_rows(
+            conn.execute("SELECT * FROM programs WHERE member_id = ? AND company_id = ?", key),
+            conn.execute("SELECT * FROM custom_fields WHERE member_id = ? AND company_id = ?", key),
+        )
+        if not programs:
+            return None
+        programs[0].pop("member_id")
+        return programs[0]
+
+    def list_programs_for_company(self, company_id: str) -> List[Dict[str, Any]]:
+        conn = self._conn()
+        return self._program_rows(
+            conn.execute("SELECT * FROM programs WHERE company_id = ?", (company_id,)),
+            conn.execute("SELECT * FROM custom_fields WHERE company_id = ?", (company_id,)),
+        )
+
+    def total_points(self) -> int:
+        return self._conn().execute(
+            "SELECT COALESCE(SUM(current_balance), 0) FROM programs").fetchone()[0]
+
+    # Global log
+    def insert_log(self, entry: Dict[str, Any]) -> None:
+        self.insert_logs([entry])
+
+    def insert_logs(self, entries: List[Dict[str, Any]]) -> None:
+        rows = [(*values, extra) for values, extra in (_split(e, LOG_COLUMNS) for e in entries)]
+        with self._tx() as conn:
+            conn.executemany(INSERT_LOG, rows)
+            conn.executemany(INSERT_LOG_CHANGE, _log_change_rows(entries))
+
+    def recent_logs(self, limit: int = 50) -> List[Dict[str, Any]]:
+        rows = self._conn().execute(
+            "SELECT * FROM global_log ORDER BY timestamp DESC LIMIT ?", (limit,))
+        return [_from_row(row, LOG_COLUMNS) for row in rows]
+
+    def get_log(self, log_id: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute("SELECT * FROM all_logs WHERE id = ?", (log_id,)).fetchone()
+        return _from_row(row, ARCHIVED_LOG_COLUMNS) if row else None
+
+    def logs_between(self, since: datetime, until: datetime) -> List[Dict[str, Any]]:
+        rows = self._conn().execute(
+            "SELECT * FROM all_logs WHERE timestamp >= ? AND timestamp <= ? ORDER BY timestamp, id",
+            (_to_sql("timestamp", since), _to_sql("timestamp", until)))
+        return [_from_row(row, ARCHIVED_LOG_COLUMNS) for row in rows]
+
+    def claim_log_revert(self, log_id: str, revert_id: str) -> bool:
+        with self._tx() as conn:
+            return conn.execute(
+                "UPDATE global_log SET extra = json_set(COALESCE(extra, '{}'), '$.reverted_by', ?) "
+                "WHERE id = ? AND json_extract(COALESCE(extra, '{}'), '$.reverted_by') IS NULL",
+                (revert_id, log_id)).rowcount == 1
+
+    def release_log_revert(self, log_id: str) -> None:
+        with self._tx() as conn:
+            conn.execute("UPDATE global_log SET extra = json_remove(extra, '$.reverted_by') "
+                         "WHERE id = ? AND extra IS NOT NULL", (log_id,))
+
+    def member_logs(self, member_id: str, company_id: str = None, before: Tuple[datetime, str] = None,
+                    limit: int = 50) -> List[Dict[str, Any]]:
+        # Newest `limit` ids from each index, then the page out of their union
+        conditions, args = "member_id = ?", [member_id]
+        if company_id:
+            conditions += " AND company_id = ?"
+            args.append(company_id)
+        if before:
+            conditions += " AND (timestamp, {id}) < (?, ?)"
+            args += [_to_sql("timestamp", before[0]), before[1]]
+        rows = self._conn().execute(
+            f"SELECT * FROM all_logs WHERE id IN ("
+            f"SELECT id FROM (SELECT id FROM all_logs WHERE {conditions.format(id='id')} "
+            f"ORDER BY timestamp DESC, id DESC LIMIT ?) "
+            f"UNION SELECT log_id FROM (SELECT log_id FROM all_log_changes WHERE {conditions.format(id='log_id')} "
+            f"ORDER BY timestamp DESC, log_id DESC LIMIT ?)"
+            f") ORDER BY timestamp DESC, id DESC LIMIT ?",
+            (*args, limit, *args, limit, limit))
+        return [_from_row(row, ARCHIVED_LOG_COLUMNS) for row in rows]
+
+    def count_company_logs(self, company_id: str, other_than: str = None) -> int:
+        if other_than is None:
+            query, args = "SELECT COUNT(*) FROM global_log WHERE company_id = ?", (company_id,)
+        else:
+            query = "SELECT COUNT(*) FROM global_log WHERE company_id = ? AND company_name IS NOT ?"
+            args = (company_id, other_than)
+        return self._conn().execute(query, args).fetchone()[0]
+
+    def rename_company_logs(self, company_id: str, name: str, limit: int) -> int:
+        with self._tx() as conn:
+            return conn.execute(
+                "UPDATE global_log SET company_name = ? WHERE rowid IN ("
+                "SELECT rowid FROM global_log WHERE company_id = ? AND company_name IS NOT ? LIMIT ?)",
+                (name, company_id, name, limit)).rowcount
+
+    def count_logs_since(self, since: datetime) -> int:
+        return self._conn().execute(
+            "SELECT COUNT(*) FROM all_logs WHERE timestamp >= ?",
+            (_to_sql("timestamp", since),)).fetchone()[0]
+
+    def activity_counts(self, since: datetime, until: datetime, unit: str,
+                        by: str = None) -> List[Dict[str, Any]]:
+        if by is not None and by not in ACTIVITY_KEYS:
+            raise ValueError(f"cannot group activity by {by!r}")
+        key = by or "NULL"
+        rows = self._conn().execute(
+            f"SELECT {BUCKET_EXPRESSIONS[unit]} AS bucket, {key} AS key, COUNT(*) AS count FROM all_logs "
+            f"WHERE timestamp >= ? AND timestamp < ? GROUP BY bucket, key ORDER BY bucket",
+            (_to_sql("timestamp", since), _to_sql("timestamp", until)))
+        return [{"bucket": datetime.fromisoformat(row["bucket"]), "key": row["key"], "count": row["count"]}
+                for row in rows]
+
+    def archive_logs(self, before: datetime, limit: int) -> int:
+        with self._tx() as conn:
+            ids = codec.dumps([row[0] for row in conn.execute(
+                "SELECT id FROM global_log WHERE timestamp < ? ORDER BY timestamp, id LIMIT ?",
+                (_to_sql("timestamp", before), limit))])
+            selected = "(SELECT value FROM json_each(?))"
+            conn.execute(f"INSERT INTO global_log_archive SELECT *, ? FROM global_log WHERE id IN {selected}",
+                         (_to_sql("archived_at", datetime.utcnow()), ids))
+            conn.execute(f"INSERT INTO log_changes_archive SELECT * FROM log_changes WHERE log_id IN {selected}",
+                         (ids,))
+            # log_changes rows go with their entries (ON DELETE CASCADE)
+            return conn.execute(f"DELETE FROM global_log WHERE id IN {selected}", (ids,)).rowcount
+
+    # Balance history
+    def insert_balance_points(self, points: List[Dict[str, Any]]) -> None:
+        rows = [[_to_sql(column, point[column]) for column in BALANCE_COLUMNS] for point in points]
+        with self._tx() as conn:
+            conn.executemany("INSERT INTO balance_history (member_id, company_id, ts, balance) "
+                             "VALUES (?, ?, ?, ?)", rows)
+
+    def balance_history(self, member_id: str, company_id: str, since: datetime = None,
+                        until: datetime = None) -> List[Dict[str, Any]]:
+        query = "SELECT * FROM balance_history WHERE member_id = ? AND company_id = ?"
+        args: List[Any] = [member_id, company_id]
+        if since:
+            query += " AND ts >= ?"
+            args.append(_to_sql("ts", since))
+        if until:
+            query += " AND ts <= ?"
+            args.append(_to_sql("ts", until))
+        rows = self._conn().execute(query + " ORDER BY ts", args)
+        return [_from_row(row, BALANCE_COLUMNS) for row in rows]
+
+    # State snapshots
+    def insert_state_snapshot(self, snapshot: Dict[str, Any]) -> None:
+        values, extra = _split(snapshot, SNAPSHOT_COLUMNS)
+        with self._tx() as conn:
+            conn.execute("INSERT INTO state_snapshots (id, taken_at, extra) VALUES (?, ?, ?)", (*values, extra))
+
+    def state_snapshot(self, at: datetime, after: bool = False) -> Optional[Dict[str, Any]]:
+        query = ("SELECT * FROM state_snapshots WHERE taken_at > ? ORDER BY taken_at LIMIT 1" if after else
+                 "SELECT * FROM state_snapshots WHERE taken_at <= ? ORDER BY taken_at DESC LIMIT 1")
+        row = self._conn().execute(query, (_to_sql("taken_at", at),)).fetchone()
+        return _from_row(row, SNAPSHOT_COLUMNS) if row else None
+
+    # Expiring lots
+    def insert_lot(self, lot: Dict[str, Any]) -> None:
+        values, extra = _split(lot, LOT_COLUMNS)
+        with self._tx() as conn:
+            conn.execute("INSERT INTO expiring_lots (id, member_id, company_id, amount, expires_on, extra) "
+                         "VALUES (?, ?, ?, ?, ?, ?)", (*values, extra))
+
+    def get_lot(self, lot_id: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute("SELECT * FROM expiring_lots WHERE id = ?", (lot_id,)).fetchone()
+        return _from_row(row, LOT_COLUMNS) if row else None
+
+    def delete_lot(self, lot_id: str) -> bool:
+        with self._tx() as conn:
+            return conn.execute("DELETE FROM expiring_lots WHERE id = ?", (lot_id,)).rowcount == 1
+
+    def program_lots(self, member_id: str, company_id: str) -> List[Dict[str, Any]]:
+        rows = self._conn().execute(
+            "SELECT * FROM expiring_lots WHERE member_id = ? AND company_id = ? ORDER BY expires_on",
+            (member_id, company_id))
+        return [_from_row(row, LOT_COLUMNS) for row in rows]
+
+    def lots_expiring(self, since: str = None, until: str = None) -> List[Dict[str, Any]]:
+        query, args = "SELECT * FROM expiring_lots WHERE 1 = 1", []
+        if since:
+            query += " AND expires_on >= ?"
+            args.append(since)
+        if until:
+            query += " AND expires_on <= ?"
+            args.append(until)
+        rows = self._conn().execute(query + " ORDER BY expires_on", args)
+        return [_from_row(row, LOT_COLUMNS) for row in rows]
+
+    def delete_lots(self, member_id: str = None, company_id: str = None) -> int:
+        conditions = [(c, v) for c, v in (("member_id", member_id), ("company_id", company_id)) if v]
+        where = " AND ".join(f"{c} = ?" for c, _ in conditions) or "1 = 1"
+        with self._tx() as conn:
+            return conn.execute(f"DELETE FROM expiring_lots WHERE {where}",
+                                [v for _, v in conditions]).rowcount
+
+    def move_lots(self, company_id: str, to_company_id: str) -> int:
+        with self._tx() as conn:
+            return conn.execute("UPDATE expiring_lots SET company_id = ? WHERE company_id = ?",
+                                (to_company_id, company_id)).rowcount
+
+    # Post-its
+    def list_postits(self) -> List[Dict[str, Any]]:
+        rows = self._conn().execute("SELECT * FROM postits ORDER BY created_at")
+        return [_from_row(row, POSTIT_COLUMNS) for row in rows]
+
+    def get_postit(self, postit_id: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute("SELECT * FROM postits WHERE id = ?", (postit_id,)).fetchone()
+        return _from_row(row, POSTIT_COLUMNS) if row else None
+
+    def insert_postit(self, postit: Dict[str, Any]) -> None:
+        values, _ = _split(postit, POSTIT_COLUMNS)
+        with self._tx() as conn:
+            conn.execute("INSERT INTO postits (id, content, created_at, updated_at) "
+                         "VALUES (?, ?, ?, ?)", values)
+
+    def update_postit(self, postit_id: str, set_fields: Dict[str, Any]) -> bool:
+        columns = [c for c in set_fields if c in POSTIT_COLUMNS and c != "id"]
+        if not columns:
+            return self.get_postit(postit_id) is not None
+        assignments = ", ".join(f"{c} = ?" for c in columns)
+        params = [_to_sql(c, set_fields[c]) for c in columns]
+        with self._tx() as conn:
+            cursor = conn.execute(f"UPDATE postits SET {assignments} WHERE id = ?",
+                                  (*params, postit_id))
+            return cursor.rowcount == 1
+
+    def delete_postit(self, postit_id: str) -> bool:
+        with self._tx() as conn:
+            return conn.execute("DELETE FROM postits WHERE id = ?", (postit_id,)).rowcount == 1
@@ -0,0 +1,75 @@
+"""Balance history: samples taken from log entries, and server-side downsampling.
+
+Every ``current_balance`` change is logged, either as its own entry or as an
+item of a changeset's ``changes`` list, so the same extraction feeds both the
+live recording and the backfill from an existing log.
+"""
+from typing import Any, Dict, Iterable, List
+
+DOWNSAMPLE_METHODS = ("lttb", "day")
+
+
+def balance_points(entries: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """``{member_id, company_id, ts, balance}`` for each balance change in ``entries``."""
+    points = []
+    for entry in entries:
+        # A changeset's own old/new values are a summary; its items carry the numbers
+        for change in entry.get("changes") or [entry]:
+            if change.get("field_changed") != "current_balance" or not change.get("member_id"):
+                continue
+            try:
+                balance = int(change["new_value"])
+            except (KeyError, TypeError, ValueError):
+                continue
+            points.append({
+                "member_id": change["member_id"],
+                "company_id": change["company_id"],
+                "ts": entry["timestamp"],
+                "balance": balance,
+            })
+    return points
+
+
+def last_per_day(points: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Closing balance of each (UTC) day."""
+    daily: List[Dict[str, Any]] = []
+    for point in points:
+        if daily and daily[-1]["ts"].date() == point["ts"].date():
+            daily[-1] = point
+        else:
+            daily.append(point)
+    return daily
+
+
+def lttb(points: List[Dict[str, Any]], threshold: int) -> List[Dict[str, Any]]:
+    """Largest-Triangle-Three-Buckets: ``threshold`` points that keep the series' shape."""
+    if threshold >= len(points) or threshold < 3:
+        return list(points)
+    xs = [point["ts"].timestamp() for point in points]
+    ys = [point["balance"] for point in points]
+    sampled = [points[0]]
+    every = (len(points) - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # Average of the next bucket is the third vertex of the triangle
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, len(points))
+        avg_x = sum(xs[next_start:next_end]) / (next_end - next_start)
+        avg_y = sum(ys[next_start:next_end]) / (next_end - next_start)
+
+        start, end = int(i * every) + 1, int((i + 1) * every) + 1
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            area = abs((xs[a] - avg_x) * (ys[j] - ys[a]) - (xs[a] - xs[j]) * (avg_y - ys[a]))
+            if area > best_area:
+                best, best_area = j, area
+        sampled.append(points[best])
+        a = best
+    sampled.append(points[-1])
+    return sampled
+
+
+def downsample(points: List[Dict[str, Any]], limit: int, method: str = "lttb") -> List[Dict[str, Any]]:
+    if method == "day":
+        points = last_per_day(points)
+    return lttb(points, limit)
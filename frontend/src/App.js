@@ -3,6 +3,13 @@ import './App.css';
 
 const API_BASE_URL = process.env.REACT_APP_BACKEND_URL;
 
+// Program fields the exports render themselves or keep internal; anything
+// else in a program object is listed as-is
+const STANDARD_PROGRAM_FIELDS = [
+  'company_id', 'login', 'password', 'cpf', 'card_number', 'current_balance', 'elite_tier', 'notes',
+  'last_updated', 'last_change', 'custom_fields', 'version', 'next_expiry', 'next_expiry_amount'
+];
+
 // Debounce utility function
 const debounce = (func, delay) => {
   let timeoutId;
@@ -59,9 +66,6 @@ function App() {
     name: ''
   });
 
-  // Fixed order for family members
-  const familyOrder = ["Osvandré", "Marilise", "Graciela", "Leonardo"];
-
   // UI-Smart System - Continuously monitor and fix UI issues
   useEffect(() => {
     if (!uiSmartSystem.isActive) return;
@@ -347,13 +351,8 @@ function App() {
     try {
       const response = await fetch(`${API_BASE_URL}/api/members`);
       const data = await response.json();
-      // Sort members according to family order
-      const sortedMembers = data.sort((a, b) => {
-        const indexA = familyOrder.indexOf(a.name);
-        const indexB = familyOrder.indexOf(b.name);
-        return indexA - indexB;
-      });
-      setMembers(sortedMembers);
+      // Already sorted by name (case/accent-insensitive) by the API
+      setMembers(data);
     } catch (error) {
       console.error('Erro ao buscar membros:', error);
     }
@@ -481,15 +480,27 @@ function App() {
       changesForSave.current_balance = parseInt(changesForSave.current_balance) || 0;
     }
 
+    // Version the edit was based on; the server rejects it (409) only if
+    // another device changed one of these same fields in the meantime
+    const baseProgram = members.find(m => m.id === memberId)?.programs?.[companyId];
+
     try {
       const response = await fetch(`${API_BASE_URL}/api/members/${memberId}/programs/${companyId}`, {
         method: 'PUT',
         headers: {
           'Content-Type': 'application/json',
+          ...(baseProgram ? { 'If-Match': `"${baseProgram.version || 0}"` } : {}),
         },
         body: JSON.stringify(changesForSave),
       });
       
+      if (response.status === 409) {
+        alert('Este programa foi alterado em outro dispositivo. Os dados foram recarregados.');
+        await fetchMembers();
+        await fetchGlobalLog();
+        return;
+      }
+      
       if (response.ok) {
         await fetchMembers();
         await fetchGlobalLog();
@@ -664,8 +675,8 @@ function App() {
     if (!fieldName) return;
 
     try {
-      const response = await fetch(`${API_BASE_URL}/api/members/${memberId}/programs/${companyId}`, {
-        method: 'PUT',
+      const response = await fetch(`${API_BASE_URL}/api/members/${memberId}/programs/${companyId}/fields`, {
+        method: 'PATCH',
         headers: {
           'Content-Type': 'application/json',
         },
@@ -785,9 +796,8 @@ function App() {
         }
         
         // Add any other fields that might exist in the program object
-        const standardFields = ['company_id', 'login', 'password', 'cpf', 'card_number', 'current_balance', 'elite_tier', 'notes', 'last_updated', 'last_change', 'custom_fields'];
         Object.entries(program).forEach(([key, value]) => {
-          if (!standardFields.includes(key) && value && value !== '') {
+          if (!STANDARD_PROGRAM_FIELDS.includes(key) && value && value !== '') {
             message += `  - ${key}: ${value}\n`;
           }
         });
@@ -891,9 +901,8 @@ function App() {
         }
         
         // Any additional fields
-        const standardFields = ['company_id', 'login', 'password', 'cpf', 'card_number', 'current_balance', 'elite_tier', 'notes', 'last_updated', 'last_change', 'custom_fields'];
         Object.entries(program).forEach(([key, value]) => {
-          if (!standardFields.includes(key) && value && value !== '') {
+          if (!STANDARD_PROGRAM_FIELDS.includes(key) && value && value !== '') {
             message += `  - ${key}: ${value}\n`;
           }
         });
@@ -939,9 +948,9 @@ function App() {
     if (!confirm(`Tem certeza que deseja excluir o campo "${fieldName}"?`)) return;
 
     try {
-      // Backend supports field deletion by setting value to null
-      const response = await fetch(`${API_BASE_URL}/api/members/${memberId}/programs/${companyId}`, {
-        method: 'PUT',
+      // Merge patch: a null value removes the custom field
+      const response = await fetch(`${API_BASE_URL}/api/members/${memberId}/programs/${companyId}/fields`, {
+        method: 'PATCH',
         headers: {
           'Content-Type': 'application/json',
         },
@@ -995,47 +1004,25 @@ function App() {
       const member = members.find(m => m.id === memberId);
       const program = member.programs[companyId];
       
-      // Get the current value from the field
-      let currentValue = '';
-      if (program[fieldName] !== undefined) {
-        currentValue = program[fieldName];
-      } else if (program.custom_fields && program.custom_fields[fieldName] !== undefined) {
-        currentValue = program.custom_fields[fieldName];
-      }
+      // Custom fields are renamed in place; anything else is copied into a new custom field
+      const patch = program.custom_fields && program.custom_fields[fieldName] !== undefined
+        ? { $rename: { [fieldName]: newName } }
+        : { [newName]: program[fieldName] !== undefined ? program[fieldName] : '' };
       
-      // Manual renaming: add new field and remove old field
-      // Step 1: Add new field with the current value
-      const addResponse = await fetch(`${API_BASE_URL}/api/members/${memberId}/programs/${companyId}/fields`, {
-        method: 'PUT',
+      const response = await fetch(`${API_BASE_URL}/api/members/${memberId}/programs/${companyId}/fields`, {
+        method: 'PATCH',
         headers: {
           'Content-Type': 'application/json',
         },
-        body: JSON.stringify({
-          [newName]: currentValue
-        }),
+        body: JSON.stringify(patch),
       });
       
-      if (addResponse.ok) {
-        // Step 2: Remove old field by setting it to null
-        const deleteResponse = await fetch(`${API_BASE_URL}/api/members/${memberId}/programs/${companyId}`, {
-          method: 'PUT',
-          headers: {
-            'Content-Type': 'application/json',
-          },
-          body: JSON.stringify({
-            [fieldName]: null
-          }),
-        });
-        
-        if (deleteResponse.ok) {
-          await fetchMembers();
-          await fetchGlobalLog();
-          cancelFieldRenaming();
-        } else {
-          console.error('Erro ao remover campo antigo durante renomeação');
-        }
+      if (response.ok) {
+        await fetchMembers();
+        await fetchGlobalLog();
+        cancelFieldRenaming();
       } else {
-        console.error('Erro ao adicionar novo campo durante renomeação');
+        console.error('Erro ao renomear campo');
       }
     } catch (error) {
       console.error('Erro ao renomear campo:', error);
@@ -20,8 +20,7 @@ app.add_middleware(
 # Try to import backend routes
 try:
     from backend.server import (
-        companies_collection, members_collection, global_log_collection, 
-        postits_collection, Company, ProgramData, Member, ProgramUpdate,
+        storage, Company, ProgramData, Member, ProgramUpdate,
         GlobalLogEntry, PostIt, PostItUpdate
     )
     
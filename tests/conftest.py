@@ -0,0 +1,49 @@
+"""Fixtures shared by the backend tests.
+
+Every engine that runs in-process (memory, journal, sqlite) goes through the
+same tests; MongoDB needs a server and is left to the scripts at the root.
+"""
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("STORAGE_ENGINE", "memory")
+
+from storage import JournalStorage, MemoryStorage, SQLiteStorage  # noqa: E402
+
+ENGINES = ("memory", "journal", "sqlite")
+
+
+def make_storage(engine: str, path: Path):
+    if engine == "memory":
+        return MemoryStorage()
+    if engine == "journal":
+        return JournalStorage(str(path / "journal"), fsync_ms=0)
+    return SQLiteStorage(str(path / "milhas.db"))
+
+
+@pytest.fixture(params=ENGINES)
+def storage(request, tmp_path):
+    engine = make_storage(request.param, tmp_path)
+    engine.ensure_indexes()
+    yield engine
+    engine.close()
+
+
+@pytest.fixture(params=ENGINES)
+def client(request, tmp_path, monkeypatch):
+    """A TestClient on the API, seeded with the default family, over each engine."""
+    from fastapi.testclient import TestClient
+    import server
+
+    engine = make_storage(request.param, tmp_path)
+    monkeypatch.setattr(server, "storage", engine)
+    monkeypatch.setattr(server, "MAINTENANCE_TASKS", ())  # no background writes racing the test
+    server.derived_cache.clear()
+    server.activity_cache.clear()  # closed buckets would leak across engines
+    with TestClient(server.app) as client:  # startup seeds, shutdown closes the engine
+        client.storage = engine
+        yield client
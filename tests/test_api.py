@@ -0,0 +1,480 @@
+"""API behaviour through TestClient, on every in-process engine."""
+import uuid
+from datetime import datetime, timedelta
+
+
+def family(client):
+    members = {m["name"]: m["id"] for m in client.get("/api/members").json()}
+    return members["Osvandré"], members["Marilise"]
+
+
+def set_balance(client, member_id, company_id, balance):
+    response = client.put(f"/api/members/{member_id}/programs/{company_id}", json={"current_balance": balance})
+    assert response.status_code == 200
+
+
+def balance(client, member_id, company_id):
+    return client.get(f"/api/members/{member_id}/programs/{company_id}").json()["current_balance"]
+
+
+# Members
+def test_member_names_are_unique_ignoring_case_and_accents(client):
+    a, _ = family(client)
+    assert client.post("/api/members", json={"name": "OSVANDRE"}).status_code == 400
+    response = client.post("/api/members", json={"name": "Rosângela"})
+    assert response.status_code == 200
+    assert client.put(f"/api/members/{response.json()['member_id']}", json={"name": "marilise"}).status_code == 400
+    assert client.put(f"/api/members/{a}", json={"name": "Osvandre"}).status_code == 200
+    assert len(client.get("/api/members").json()) == 5
+
+
+# Optimistic concurrency
+def test_stale_update_to_other_fields_is_merged(client):
+    a, _ = family(client)
+    version = client.get(f"/api/members/{a}/programs/latam").json()["version"]
+    first = client.put(f"/api/members/{a}/programs/latam", json={"notes": "primeira", "expected_version": version})
+    assert first.status_code == 200
+    assert first.headers["ETag"] == f'"{first.json()["version"]}"'
+
+    second = client.put(f"/api/members/{a}/programs/latam", json={"login": "osv", "expected_version": version})
+    assert second.status_code == 200
+    program = client.get(f"/api/members/{a}/programs/latam").json()
+    assert (program["notes"], program["login"]) == ("primeira", "osv")
+
+
+def test_stale_update_to_the_same_field_conflicts(client):
+    a, _ = family(client)
+    version = client.get(f"/api/members/{a}/programs/latam").json()["version"]
+    client.put(f"/api/members/{a}/programs/latam", json={"notes": "primeira"})
+
+    response = client.put(f"/api/members/{a}/programs/latam", json={"notes": "segunda"},
+                          headers={"If-Match": f'"{version}"'})
+    assert response.status_code == 409
+    assert response.json()["detail"]["fields"] == ["notes"]
+    assert response.json()["detail"]["current"]["notes"] == "primeira"
+    assert client.put(f"/api/members/{a}/programs/latam", json={"notes": "x"},
+                      headers={"If-Match": "abc"}).status_code == 400
+
+
+# Balance adjustments
+def test_adjust_applies_and_rejects_per_item(client):
+    a, b = family(client)
+    set_balance(client, a, "latam", 1000)
+    response = client.post("/api/balances/adjust", json={"deltas": [
+        {"member_id": a, "company_id": "latam", "delta": 500},
+        {"member_id": a, "company_id": "latam", "delta": -200},
+        {"member_id": b, "company_id": "latam", "delta": -1},
+        {"member_id": b, "company_id": "nada", "delta": 10},
+    ], "note": "extrato"})
+    assert response.status_code == 200
+    statuses = [(r["status"], r.get("detail")) for r in response.json()["results"]]
+    assert statuses == [("aplicado", None), ("aplicado", None), ("rejeitado", "Saldo insuficiente"),
+                        ("rejeitado", "Programa não encontrado")]
+    assert balance(client, a, "latam") == 1300
+
+    entry = client.storage.recent_logs(1)[0]
+    assert entry["change_type"] == "changeset"
+    assert [(c["old_value"], c["new_value"], c["delta"]) for c in entry["changes"]] == [("1000", "1300", 300)]
+    assert client.post("/api/balances/adjust", json={"deltas": []}).status_code == 400
+
+
+# Transfers
+def test_transfer_debits_and_credits(client):
+    a, b = family(client)
+    set_balance(client, a, "smiles", 1000)
+    response = client.post("/api/transfers", json={
+        "from_member_id": a, "from_company_id": "smiles", "to_member_id": b, "to_company_id": "latam",
+        "amount": 300, "ratio": 0.5,
+    })
+    assert response.status_code == 200
+    assert (response.json()["debited"], response.json()["credited"]) == (300, 150)
+    assert (balance(client, a, "smiles"), balance(client, b, "latam")) == (700, 150)
+
+
+def test_transfer_validation(client):
+    a, b = family(client)
+    set_balance(client, a, "smiles", 100)
+    transfer = {"from_member_id": a, "from_company_id": "smiles", "to_member_id": b, "to_company_id": "latam"}
+    assert client.post("/api/transfers", json={**transfer, "amount": 500}).status_code == 400
+    assert client.post("/api/transfers", json={**transfer, "amount": 1, "ratio": 0.1}).status_code == 400
+    assert client.post("/api/transfers", json={**transfer, "amount": 10, "to_member_id": a,
+                                               "to_company_id": "smiles"}).status_code == 400
+    assert client.post("/api/transfers", json={**transfer, "amount": 10, "to_member_id": "zz"}).status_code == 404
+    assert balance(client, a, "smiles") == 100
+
+
+def test_transfer_undoes_a_half_applied_write_and_retries(client, monkeypatch):
+    a, b = family(client)
+    set_balance(client, a, "smiles", 1000)
+    storage = client.storage
+    bulk_update_members = storage.bulk_update_members
+    raced = []
+
+    def racing(updates):
+        if not raced:
+            # Another session saves the target member between our read and write
+            raced.append(storage.update_member(b, {"programs.latam.notes": "outra sessão"},
+                                               inc_fields={"version": 1}))
+        return bulk_update_members(updates)
+
+    monkeypatch.setattr(storage, "bulk_update_members", racing)
+    response = client.post("/api/transfers", json={
+        "from_member_id": a, "from_company_id": "smiles", "to_member_id": b, "to_company_id": "latam",
+        "amount": 400,
+    })
+    assert response.status_code == 200
+    assert (balance(client, a, "smiles"), balance(client, b, "latam")) == (600, 400)
+
+    change_types = [entry["change_type"] for entry in storage.recent_logs(2)]
+    assert change_types == ["changeset", "rollback"]
+
+
+# Bulk program updates
+def test_bulk_update_logs_after_the_write(client):
+    a, b = family(client)
+    response = client.post("/api/programs/bulk-update", json={"updates": [
+        {"member_id": a, "company_id": "latam", "changes": {"elite_tier": "Ouro"}},
+        {"member_id": b, "company_id": "latam", "changes": {"elite_tier": "Prata", "notes": "x"}},
+        {"member_id": b, "company_id": "nada", "changes": {"notes": "x"}},
+    ]})
+    assert [r["status"] for r in response.json()["results"]] == ["aplicado", "aplicado", "rejeitado"]
+
+    entries = client.storage.recent_logs(3)
+    assert sorted((e["field_changed"], e["new_value"]) for e in entries) == [
+        ("elite_tier", "Ouro"), ("elite_tier", "Prata"), ("notes", "x")]
+    for entry in entries:
+        assert entry["timestamp"] >= client.storage.get_member(entry["member_id"])["updated_at"]
+
+
+# Company merge
+def test_company_names_are_unique_once_normalized(client):
+    assert client.post("/api/companies", json={"company_name": "Tudo Azul"}).status_code == 400
+    livelo = client.post("/api/companies", json={"company_name": "Livelo"}).json()["id"]
+    assert client.put(f"/api/companies/{livelo}", json={"name": "SMILES"}).status_code == 400
+    assert client.put(f"/api/companies/{livelo}", json={"name": "LIVELO"}).status_code == 200
+    assert client.get("/api/companies/duplicates").json() == []
+
+
+def test_merge_applies_the_balance_policy(client):
+    a, b = family(client)
+    source = client.post(f"/api/members/{a}/companies", json={"company_name": "Azul Fidelidade"}).json()["company_id"]
+    client.post(f"/api/members/{b}/companies", json={"company_name": "Azul Fidelidade"})
+    set_balance(client, a, source, 500)
+    set_balance(client, a, "azul", 300)
+    set_balance(client, b, source, 70)
+    url = f"/api/companies/{source}/merge"
+    assert client.post(url, json={"into": "azul", "balance_policy": "media"}).status_code == 400
+    assert client.post(url, json={"into": source}).status_code == 400
+    assert client.post(url, json={"into": "nada"}).status_code == 404
+
+    response = client.post(url, json={"into": "azul", "balance_policy": "max"})
+    assert response.json()["members_merged"] == 2
+    assert (balance(client, a, "azul"), balance(client, b, "azul")) == (500, 70)
+    assert client.get(f"/api/companies/{source}").status_code == 404
+    assert all(source not in m["programs"] for m in client.get("/api/members").json())
+    entry = client.storage.recent_logs(1)[0]
+    assert (entry["change_type"], entry["merged_company_id"]) == ("changeset", source)
+
+
+def test_merge_keeps_partner_edges_and_rates(client):
+    source = client.post("/api/companies", json={"company_name": "Azul Fidelidade", "color": "#00f"}).json()["id"]
+    livelo = client.post("/api/companies", json={"company_name": "Livelo", "color": "#e4007c"}).json()["id"]
+    client.put(f"/api/companies/{livelo}/partners/{source}", json={"ratio": 1.0})
+    client.put(f"/api/companies/{source}/partners/smiles", json={"ratio": 0.5})
+    client.put(f"/api/companies/{source}/partners/azul", json={"ratio": 2.0})
+    client.put("/api/companies/azul/partners/latam", json={"ratio": 1.0})
+    client.put(f"/api/companies/{source}/partners/latam", json={"ratio": 9.0})
+    client.put(f"/api/companies/{source}/rates", json={"brl_per_1000": 15, "effective_from": "2025-01-01"})
+    client.put(f"/api/companies/{source}/rates", json={"brl_per_1000": 99, "effective_from": "2025-03-01"})
+    client.put("/api/companies/azul/rates", json={"brl_per_1000": 16, "effective_from": "2025-03-01"})
+
+    assert client.post(f"/api/companies/{source}/merge", json={"into": "azul"}).status_code == 200
+    edges = {(e["from_company_id"], e["to_company_id"]): e["ratio"] for e in client.get("/api/transfer-partners").json()}
+    assert edges == {(livelo, "azul"): 1.0, ("azul", "latam"): 1.0, ("azul", "smiles"): 0.5}
+    assert client.get("/api/valuation/rates").json()["azul"] == [
+        {"effective_from": "2025-01-01", "brl_per_1000": 15}, {"effective_from": "2025-03-01", "brl_per_1000": 16}]
+
+
+# Company cascades
+def test_rename_rewrites_the_log_in_the_background(client):
+    a, _ = family(client)
+    set_balance(client, a, "smiles", 10)
+    response = client.put("/api/companies/smiles", json={"name": "Smiles Club"})
+    job = client.get(f"/api/jobs/{response.json()['job_id']}").json()
+    assert (job["status"], job["progress"]) == ("completed", 100.0)
+    entries = [e for e in client.storage.recent_logs(50) if e["company_id"] == "smiles"]
+    assert entries and all(e["company_name"] == "Smiles Club" for e in entries)
+
+
+def test_add_and_remove_a_program_everywhere(client):
+    response = client.post("/api/companies/programs", json={"company_name": "Livelo"})
+    livelo = response.json()["company_id"]
+    assert response.json()["message"] == "Programa adicionado a 4 membros"
+    assert "adicionado a 0" in client.post("/api/companies/programs", json={"company_name": "livelo"}).json()["message"]
+    assert client.delete(f"/api/companies/{livelo}/programs").json()["message"] == "Programa removido de 4 membros"
+    assert all(livelo not in m["programs"] for m in client.get("/api/members").json())
+
+
+def test_delete_company_cascades(client):
+    a, _ = family(client)
+    client.post(f"/api/members/{a}/programs/azul/lots", json={"amount": 100, "expires_on": "2030-01-01"})
+    response = client.delete("/api/companies/azul")
+    assert response.json()["programs_removed"] == 4
+    assert all("azul" not in m["programs"] for m in client.get("/api/members").json())
+    assert client.storage.program_lots(a, "azul") == []
+    assert client.delete("/api/companies/azul").status_code == 404
+
+
+def test_delete_company_drops_its_routes(client):
+    import server
+
+    livelo = client.post("/api/companies", json={"company_name": "Livelo", "color": "#e4007c"}).json()["id"]
+    client.put(f"/api/companies/{livelo}/partners/latam", json={"ratio": 1.0})
+    assert (livelo, "latam") in server.partner_paths()
+
+    assert client.delete(f"/api/companies/{livelo}").status_code == 200
+    assert not any(livelo in pair for pair in server.partner_paths())
+
+
+# Custom fields
+def test_patch_sets_removes_and_renames_fields(client):
+    a, _ = family(client)
+    url = f"/api/members/{a}/programs/latam/fields"
+    assert client.patch(url, json={"cartao": "1", "conta": "x", "vence": "10"}).status_code == 200
+
+    response = client.patch(url, json={"conta": None, "$rename": {"cartao": "cartão"}, "nova": "y"})
+    assert response.status_code == 200
+    assert response.headers["ETag"] == f'"{response.json()["version"]}"'
+    fields = client.get(f"/api/members/{a}/programs/latam").json()["custom_fields"]
+    assert fields == {"cartão": "1", "vence": "10", "nova": "y"}
+    entries = client.storage.recent_logs(3)
+    assert sorted((e["field_changed"], e["change_type"]) for e in entries) == [
+        ("campo: cartao", "rename"), ("campo: conta", "delete"), ("campo: nova", "create")]
+
+    assert client.patch(url, json={"vence": "10"}).json()["message"] == "Nenhuma alteração"
+    assert client.patch(url, json={"$rename": {"nada": "x"}}).status_code == 404
+    assert client.patch(url, json={"$rename": {"vence": "nova"}}).status_code == 400
+    assert client.patch(url, json={"nova": "1", "$rename": {"nova": "z"}}).status_code == 400
+    assert client.patch(url, json={"a.b": "1"}).status_code == 400
+    assert client.patch(url, json={}).status_code == 400
+
+
+def test_number_fields_are_converted_and_enforced(client):
+    a, b = family(client)
+    client.patch(f"/api/members/{a}/programs/latam/fields", json={"milhas": "1.234", "obs": "abc"})
+    client.patch(f"/api/members/{b}/programs/latam/fields", json={"milhas": "12,5"})
+
+    response = client.put("/api/companies/latam/fields/milhas", json={"field_type": "number"})
+    assert response.json()["converted"] == 2
+    assert client.get("/api/companies/latam/fields").json()["fields"] == {"milhas": {"type": "number"}}
+    assert client.get(f"/api/members/{b}/programs/latam").json()["custom_fields"]["milhas"] == 12.5
+
+    url = f"/api/members/{a}/programs/latam/fields"
+    assert client.patch(url, json={"milhas": "2.000"}).status_code == 200
+    assert client.get(f"/api/members/{a}/programs/latam").json()["custom_fields"]["milhas"] == 2000
+    assert client.patch(url, json={"milhas": "muitas"}).status_code == 400
+    refused = client.put("/api/companies/latam/fields/obs", json={"field_type": "number"})
+    assert refused.status_code == 400 and refused.json()["detail"]["invalid"] == [{"member_id": a, "value": "abc"}]
+    assert client.put("/api/companies/latam/fields/obs", json={"field_type": "data"}).status_code == 400
+
+    assert client.delete("/api/companies/latam/fields/milhas").status_code == 200
+    assert client.patch(url, json={"milhas": "muitas"}).status_code == 200
+    assert client.delete("/api/companies/latam/fields/milhas").status_code == 404
+
+
+def test_put_custom_fields_stamps_what_changed(client):
+    a, _ = family(client)
+    url = f"/api/members/{a}/programs/latam/fields"
+    client.patch(url, json={"cartao": "1", "conta": "x"})
+    version = client.get(f"/api/members/{a}/programs/latam").json()["version"]
+
+    assert client.put(url, json={"cartao": "2", "conta": "x"}).status_code == 200
+    program = client.get(f"/api/members/{a}/programs/latam").json()
+    assert program["version"] > version
+
+    headers = {"If-Match": f'"{version}"'}
+    assert client.patch(url, json={"conta": "y"}, headers=headers).status_code == 200
+    response = client.patch(url, json={"cartao": "3"}, headers=headers)
+    assert response.status_code == 409
+    assert response.json()["detail"]["fields"] == ["cartao"]
+    assert client.put(url, json={"a.b": "1"}).status_code == 400
+
+
+# Award planner
+def test_planner_prefers_fewest_transfers(client):
+    a, b = family(client)
+    set_balance(client, a, "latam", 70000)
+    set_balance(client, b, "latam", 20000)
+    set_balance(client, b, "smiles", 20000)
+    client.put("/api/companies/smiles/partners/latam", json={"ratio": 1.0, "block": 1000})
+    version = client.get("/api/analytics").json()["data_version"]
+
+    response = client.post("/api/planner/awards", json={
+        "options": [{"company_id": "latam", "points": 35000}], "seats": 2})
+    assert response.json()["complete"]
+    plans = response.json()["plans"]
+    assert [(p["name"], p["seats"]) for p in plans[0]["payers"]] == [("Osvandré", 2)]
+    assert plans[0]["transfer_count"] == 0
+    assert [(t["from_company_id"], t["amount"]) for t in plans[1]["transfers"]] == [("smiles", 15000)]
+    assert client.get("/api/analytics").json()["data_version"] == version
+
+    # An explicit graph replaces the stored one
+    response = client.post("/api/planner/awards", json={
+        "options": [{"company_id": "latam", "points": 35000}], "seats": 2, "transfers": []})
+    assert all(p["transfer_count"] == 0 for p in response.json()["plans"])
+
+
+def test_planner_validation(client):
+    option = [{"company_id": "latam", "points": 1000}]
+    assert client.post("/api/planner/awards", json={"options": []}).status_code == 400
+    assert client.post("/api/planner/awards", json={"options": option, "seats": 0}).status_code == 400
+    assert client.post("/api/planner/awards", json={"options": [{"company_id": "latam", "points": 0}]}).status_code == 400
+    assert client.post("/api/planner/awards", json={"options": option, "transfers": [
+        {"from_company_id": "smiles", "to_company_id": "latam", "block": 0}]}).status_code == 400
+
+
+# Point-in-time state and reverts
+def state_balance(client, at, member_id, company_id):
+    state = client.get("/api/state", params={"at": at.isoformat()}).json()
+    member = next(m for m in state["members"] if m["member_id"] == member_id)
+    return next(p["current_balance"] for p in member["programs"] if p["company_id"] == company_id)
+
+
+def test_state_replays_from_the_nearest_snapshot(client):
+    a, _ = family(client)
+    set_balance(client, a, "latam", 1000)
+    first = datetime.utcnow()
+    client.post("/api/state/snapshots")
+    set_balance(client, a, "latam", 1500)
+    second = datetime.utcnow()
+    set_balance(client, a, "latam", 400)
+
+    assert state_balance(client, first, a, "latam") == 1000
+    assert state_balance(client, second, a, "latam") == 1500
+    assert state_balance(client, first - timedelta(days=1), a, "latam") == 0
+    assert client.get("/api/state", params={"at": second.isoformat()}).json()["entries_replayed"] == 1
+
+
+def test_revert_applies_the_opposite_delta_once(client):
+    a, _ = family(client)
+    set_balance(client, a, "latam", 1000)
+    client.post("/api/balances/adjust", json={"deltas": [{"member_id": a, "company_id": "latam", "delta": 300}]})
+    adjusted = client.storage.recent_logs(1)[0]["id"]
+    set_balance(client, a, "latam", 2000)
+
+    assert client.post(f"/api/global-log/{adjusted}/revert").status_code == 200
+    assert balance(client, a, "latam") == 1700
+    assert client.post(f"/api/global-log/{adjusted}/revert").status_code == 409
+    assert client.storage.recent_logs(1)[0]["reverts"] == adjusted
+
+    created = client.post("/api/companies", json={"company_name": "Livelo"})
+    entry = client.storage.recent_logs(1)[0]
+    assert entry["company_id"] == created.json()["id"]
+    assert client.post(f"/api/global-log/{entry['id']}/revert").status_code == 400
+    assert client.post("/api/global-log/nada/revert").status_code == 404
+
+
+# Balance history
+def test_balance_history_downsamples_keeping_the_peak(client):
+    a, _ = family(client)
+    for value in (100, 200, 300, 9000, 400, 500, 600, 700, 800, 900):
+        set_balance(client, a, "latam", value)
+    url = f"/api/members/{a}/programs/latam/balance-history"
+
+    full = client.get(url).json()
+    assert (full["total"], [p["balance"] for p in full["points"]][:3]) == (10, [100, 200, 300])
+    sampled = [p["balance"] for p in client.get(url, params={"points": 4}).json()["points"]]
+    assert len(sampled) == 4
+    assert (sampled[0], sampled[-1]) == (100, 900) and 9000 in sampled
+    assert [p["balance"] for p in client.get(url, params={"method": "day"}).json()["points"]] == [900]
+    later = (datetime.utcnow() + timedelta(minutes=1)).isoformat()
+    assert client.get(url, params={"since": later}).json()["total"] == 0
+    assert client.get(url, params={"points": 2}).status_code == 400
+    assert client.get(url, params={"method": "media"}).status_code == 400
+
+
+# Activity histogram
+def log_at(client, timestamp, **fields):
+    client.storage.insert_logs([{
+        "id": str(uuid.uuid4()), "member_id": "a", "member_name": "", "company_id": "latam",
+        "company_name": "", "field_changed": "current_balance", "old_value": "0", "new_value": "1",
+        "timestamp": timestamp, "change_type": "update", **fields,
+    }])
+
+
+def test_activity_counts_per_bucket(client):
+    monday = datetime(2025, 1, 6)
+    for hours in (1, 2, 23):
+        log_at(client, monday + timedelta(hours=hours))
+    log_at(client, monday + timedelta(days=2, hours=5), company_id="azul", change_type="create")
+    window = {"since": monday.isoformat(), "until": (monday + timedelta(days=2, hours=12)).isoformat()}
+
+    days = client.get("/api/activity", params=window).json()
+    assert [(b["start"][:10], b["total"]) for b in days["buckets"]] == [
+        ("2025-01-06", 3), ("2025-01-07", 0), ("2025-01-08", 1)]
+    by_company = client.get("/api/activity", params={**window, "by": "company"}).json()
+    assert by_company["keys"] == [{"key": "azul", "label": "TudoAzul"}, {"key": "latam", "label": "LATAM Pass"}]
+    assert by_company["buckets"][0]["counts"] == {"latam": 3}
+    weeks = client.get("/api/activity", params={**window, "unit": "week"}).json()
+    assert [(b["start"][:10], b["total"]) for b in weeks["buckets"]] == [("2025-01-06", 4)]
+
+    assert client.get("/api/activity", params={"unit": "month"}).status_code == 400
+    assert client.get("/api/activity", params={"by": "tier"}).status_code == 400
+    assert client.get("/api/activity", params={"unit": "hour", "since": "2020-01-01T00:00:00"}).status_code == 400
+
+
+# Member history
+def test_history_pages_by_keyset(client):
+    start = datetime(2025, 1, 1)
+    for minutes in (0, 1, 1, 1, 2):
+        log_at(client, start + timedelta(minutes=minutes), member_id="gone")
+    log_at(client, start, member_id="gone", company_id="azul")
+
+    seen, params = [], {"limit": 2}
+    while True:
+        page = client.get("/api/members/gone/history", params=params).json()
+        seen += page["entries"]
+        if not page["next_cursor"]:
+            break
+        params["before"] = page["next_cursor"]
+    assert len(seen) == len({e["id"] for e in seen}) == 6
+    assert [e["timestamp"] for e in seen] == sorted((e["timestamp"] for e in seen), reverse=True)
+    program = client.get("/api/members/gone/programs/azul/history").json()
+    assert [e["company_id"] for e in program["entries"]] == ["azul"] and program["next_cursor"] is None
+
+    assert client.get("/api/members/gone/history", params={"before": "nada"}).status_code == 400
+    assert client.get("/api/members/gone/history", params={"limit": 0}).status_code == 400
+
+
+def test_history_includes_changesets(client):
+    a, b = family(client)
+    set_balance(client, a, "smiles", 1000)
+    client.post("/api/transfers", json={"from_member_id": a, "from_company_id": "smiles", "to_member_id": b,
+                                        "to_company_id": "latam", "amount": 300})
+    entries = client.get(f"/api/members/{b}/programs/latam/history").json()["entries"]
+    assert entries[0]["change_type"] == "changeset"
+    assert [c["delta"] for c in entries[0]["changes"]] == [-300, 300]
+
+
+# Log retention
+def test_archive_moves_old_entries_out_of_the_live_log(client, monkeypatch):
+    import server
+
+    old = datetime.utcnow() - timedelta(days=server.LOG_RETENTION_DAYS + 1)
+    for minutes in range(3):
+        log_at(client, old + timedelta(minutes=minutes), member_id="gone")
+    monkeypatch.setattr(server, "LOG_ARCHIVE_BATCH", 2)  # several batches
+
+    assert client.post("/api/logs/archive").json()["archived"] == 3
+    assert client.post("/api/logs/archive").json()["archived"] == 0
+    assert all(e["member_id"] != "gone" for e in client.get("/api/global-log", params={"limit": 500}).json())
+
+    # Still read by history and activity, but no longer revertible
+    entries = client.get("/api/members/gone/history").json()["entries"]
+    assert len(entries) == 3 and all(e["archived_at"] for e in entries)
+    window = {"since": old.isoformat(), "until": (old + timedelta(minutes=5)).isoformat()}
+    assert client.get("/api/activity", params=window).json()["total"] == 3
+    assert client.post(f"/api/global-log/{entries[0]['id']}/revert").status_code == 400
+
+    monkeypatch.setattr(server, "LOG_RETENTION_DAYS", 0)
+    assert client.post("/api/logs/archive").status_code == 400
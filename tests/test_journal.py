@@ -0,0 +1,60 @@
+"""Journal engine recovery: snapshot plus journal replay, torn tails dropped."""
+from datetime import datetime
+
+from storage import JournalStorage
+
+
+def seed(storage):
+    storage.insert_company({"id": "latam", "name": "LATAM Pass", "color": "#d31b2c"})
+    storage.insert_member({
+        "id": "a",
+        "name": "Osvandré",
+        "programs": {"latam": {"company_id": "latam", "current_balance": 1000, "custom_fields": {}}},
+        "created_at": datetime(2025, 1, 1),
+        "updated_at": datetime(2025, 1, 1),
+    })
+
+
+def test_reopen_replays_the_journal(tmp_path):
+    storage = JournalStorage(str(tmp_path), fsync_ms=0)
+    seed(storage)
+    storage.update_member("a", inc_fields={"programs.latam.current_balance": 500})
+    storage._journal.close()  # crash: no final snapshot
+
+    reopened = JournalStorage(str(tmp_path), fsync_ms=0)
+    assert reopened.get_program("a", "latam")["current_balance"] == 1500
+    assert reopened.get_company("latam")["name"] == "LATAM Pass"
+    reopened.close()
+
+
+def test_torn_tail_is_discarded(tmp_path):
+    storage = JournalStorage(str(tmp_path), fsync_ms=0)
+    seed(storage)
+    storage._journal.close()
+    journal = tmp_path / "journal.log"
+    intact = journal.stat().st_size
+    with open(journal, "ab") as f:
+        f.write(b'{"seq": 3, "op": "update_member", "args": ["a", {"programs.lat')
+
+    reopened = JournalStorage(str(tmp_path), fsync_ms=0)
+    assert journal.stat().st_size == intact
+    assert reopened.get_program("a", "latam")["current_balance"] == 1000
+
+    # Writes after recovery land on a clean line and survive the next restart
+    reopened.update_member("a", {"programs.latam.notes": "depois"})
+    reopened._journal.close()
+    again = JournalStorage(str(tmp_path), fsync_ms=0)
+    assert again.get_program("a", "latam")["notes"] == "depois"
+    again.close()
+
+
+def test_snapshot_then_journal(tmp_path):
+    storage = JournalStorage(str(tmp_path), fsync_ms=0, snapshot_every=2)
+    seed(storage)  # two mutations: snapshot taken, journal truncated
+    assert (tmp_path / "snapshot.json").exists()
+    storage.update_member("a", inc_fields={"programs.latam.current_balance": -250})
+    storage._journal.close()
+
+    reopened = JournalStorage(str(tmp_path), fsync_ms=0, snapshot_every=2)
+    assert reopened.get_program("a", "latam")["current_balance"] == 750
+    reopened.close()
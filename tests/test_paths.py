@@ -0,0 +1,35 @@
+"""Mongo-style filters evaluated by the in-process engines."""
+import pytest
+
+from storage.paths import apply_update, matches
+
+DOC = {"version": 3, "programs": {"latam": {"current_balance": 1000}}}
+
+
+@pytest.mark.parametrize("where, expected", [
+    ({"version": 3}, True),
+    ({"version": {"$in": [None, 0]}}, False),
+    ({"missing": {"$in": [None, 0]}}, True),
+    ({"version": {"$ne": 3}}, False),
+    ({"programs.latam": {"$exists": True}}, True),
+    ({"programs.azul": {"$exists": True}}, False),
+    ({"programs.latam.current_balance": {"$gte": 1000, "$lt": 2000}}, True),
+    ({"programs.latam.current_balance": {"$gt": 1000}}, False),
+    ({"programs.azul.current_balance": {"$lte": 0}}, False),
+    ({"programs.latam": {"current_balance": 1000}}, True),
+])
+def test_matches(where, expected):
+    assert matches(DOC, where) is expected
+
+
+@pytest.mark.parametrize("condition", [{"$nin": [1]}, {"$regex": "x"}, {"$in": [3], "extra": 1}])
+def test_unknown_operators_raise(condition):
+    with pytest.raises(ValueError):
+        matches(DOC, {"version": condition})
+
+
+def test_apply_update():
+    doc = {"programs": {"latam": {"current_balance": 10, "notes": "x"}}}
+    apply_update(doc, {"programs.azul.current_balance": 5}, ["programs.latam.notes"],
+                 {"programs.latam.current_balance": 5, "version": 1})
+    assert doc == {"programs": {"latam": {"current_balance": 15}, "azul": {"current_balance": 5}}, "version": 1}
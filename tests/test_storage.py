@@ -0,0 +1,178 @@
+"""Storage contract: what every engine must do the same way (see storage/base.py)."""
+from datetime import datetime, timedelta
+
+import pytest
+
+from storage import DuplicateError
+
+
+def program(company_id, balance=0, **fields):
+    return {"company_id": company_id, "current_balance": balance, "custom_fields": {}, **fields}
+
+
+def member(member_id, name, **balances):
+    now = datetime(2025, 1, 1)
+    return {
+        "id": member_id,
+        "name": name,
+        "programs": {company_id: program(company_id, balance) for company_id, balance in balances.items()},
+        "created_at": now,
+        "updated_at": now,
+    }
+
+
+def log_entry(log_id, timestamp, **fields):
+    return {
+        "id": log_id,
+        "member_id": "",
+        "member_name": "",
+        "company_id": "",
+        "company_name": "",
+        "field_changed": "current_balance",
+        "old_value": "0",
+        "new_value": "1",
+        "timestamp": timestamp,
+        "change_type": "update",
+        **fields,
+    }
+
+
+@pytest.fixture
+def family(storage):
+    storage.insert_company({"id": "latam", "name": "LATAM Pass", "color": "#d31b2c"})
+    storage.insert_company({"id": "azul", "name": "TudoAzul", "color": "#0072ce"})
+    storage.insert_member(member("a", "Osvandré", latam=1000, azul=50))
+    storage.insert_member(member("b", "Marilise", latam=200))
+    return storage
+
+
+# Companies
+def test_companies_are_found_by_normalized_name(family):
+    assert family.find_company_by_name("Tudo Azul")["id"] == "azul"
+    assert {c["id"] for c in family.list_companies()} == {"latam", "azul"}
+    assert family.count_companies() == 2
+
+
+def test_company_names_are_unique(family):
+    with pytest.raises(DuplicateError):
+        family.insert_company({"id": "azul2", "name": "tudo azul", "color": "#000"})
+    with pytest.raises(DuplicateError):
+        family.update_company("latam", {"name": "TudoAzul"})
+    assert family.get_company("latam")["name"] == "LATAM Pass"
+
+
+def test_delete_company(family):
+    assert family.delete_company("azul")
+    assert family.get_company("azul") is None
+    assert not family.delete_company("azul")
+
+
+# Members
+def test_get_member(family):
+    assert family.get_member("a")["programs"]["latam"]["current_balance"] == 1000
+    assert "programs" not in family.get_member("a", programs=False)
+    assert family.get_member("zz") is None
+    assert [m["id"] for m in family.get_members(["b", "zz"])] == ["b"]
+
+
+def test_member_names_ignore_case_and_accents(family):
+    assert family.find_member_by_name("osvandre")["id"] == "a"
+    with pytest.raises(DuplicateError):
+        family.insert_member(member("c", "OSVANDRE"))
+
+
+def test_update_member_set_unset_inc(family):
+    assert family.update_member("a", {"programs.latam.notes": "x"}, ["programs.azul"],
+                                {"programs.latam.current_balance": -300})
+    a = family.get_member("a")
+    assert a["programs"]["latam"]["current_balance"] == 700
+    assert a["programs"]["latam"]["notes"] == "x"
+    assert "azul" not in a["programs"]
+    assert not family.update_member("zz", {"name": "x"})
+
+
+def test_update_member_where_guards_the_write(family):
+    # Documents written before versioning have no version field
+    assert family.update_member("a", {"version": 1}, where={"version": {"$in": [None, 0]}})
+    assert not family.update_member("a", {"version": 2, "programs.latam.notes": "stale"}, where={"version": 0})
+    a = family.get_member("a")
+    assert a["version"] == 1
+    assert not a["programs"]["latam"].get("notes")
+    assert family.update_member("a", inc_fields={"programs.latam.current_balance": 5},
+                                where={"programs.latam.current_balance": {"$gte": 1000}})
+    assert not family.update_member("a", inc_fields={"programs.latam.current_balance": 5},
+                                    where={"programs.smiles": {"$exists": True}})
+
+
+def test_unknown_filter_operator_is_rejected(family):
+    with pytest.raises(ValueError):
+        family.update_member("a", {"programs.latam.notes": "x"}, where={"version": {"$nin": [5]}})
+    assert not family.get_member("a")["programs"]["latam"].get("notes")
+
+
+def test_bulk_update_members_reports_each_item(family):
+    results = family.bulk_update_members([
+        {"member_id": "a", "inc_fields": {"programs.latam.current_balance": -100}},
+        {"member_id": "b", "inc_fields": {"programs.latam.current_balance": 100}, "where": {"version": 9}},
+        {"member_id": "zz", "set_fields": {"name": "x"}},
+    ])
+    assert results == [True, False, False]
+    assert family.get_program("a", "latam")["current_balance"] == 900
+    assert family.get_program("b", "latam")["current_balance"] == 200
+
+
+def test_update_members_applies_to_every_match(family):
+    assert family.update_members(unset_fields=["programs.azul"], where={"programs.azul": {"$exists": True}}) == 1
+    assert all("azul" not in m["programs"] for m in family.list_members())
+
+
+def test_programs_for_company(family):
+    programs = family.list_programs_for_company("latam")
+    assert sorted((p["member_id"], p["current_balance"]) for p in programs) == [("a", 1000), ("b", 200)]
+    assert family.total_points() == 1250
+    assert family.delete_member("b")
+    assert family.count_members() == 1
+
+
+# Global log
+def test_recent_logs_newest_first(family):
+    start = datetime(2025, 1, 1)
+    family.insert_logs([log_entry(f"l{i}", start + timedelta(minutes=i)) for i in range(3)])
+    assert [e["id"] for e in family.recent_logs(2)] == ["l2", "l1"]
+    assert family.get_log("l0")["timestamp"] == start
+    assert [e["id"] for e in family.logs_between(start, start + timedelta(minutes=1))] == ["l0", "l1"]
+    assert family.count_logs_since(start + timedelta(minutes=1)) == 2
+
+
+def test_log_revert_claims(family):
+    family.insert_log(log_entry("l0", datetime(2025, 1, 1)))
+    assert family.claim_log_revert("l0", "r1")
+    assert not family.claim_log_revert("l0", "r2")
+    family.release_log_revert("l0")
+    assert family.claim_log_revert("l0", "r3")
+    assert not family.claim_log_revert("zz", "r4")
+
+
+# Expiring lots
+def test_lots(family):
+    for lot_id, company_id, day in (("x", "latam", "2025-03-01"), ("y", "latam", "2025-02-01"),
+                                    ("z", "azul", "2025-04-01")):
+        family.insert_lot({"id": lot_id, "member_id": "a", "company_id": company_id, "amount": 10,
+                           "expires_on": day})
+    assert [lot["id"] for lot in family.program_lots("a", "latam")] == ["y", "x"]
+    assert [lot["id"] for lot in family.lots_expiring("2025-02-15", "2025-04-01")] == ["x", "z"]
+    assert family.move_lots("azul", "latam") == 1
+    assert [lot["id"] for lot in family.program_lots("a", "latam")] == ["y", "x", "z"]
+    assert family.delete_lot("y")
+    assert family.delete_lots(member_id="a") == 2
+    assert family.get_lot("x") is None
+
+
+# Post-its
+def test_postits(family):
+    family.insert_postit({"id": "p1", "content": "hi", "created_at": datetime(2025, 1, 1),
+                          "updated_at": datetime(2025, 1, 1)})
+    assert family.update_postit("p1", {"content": "yo"})
+    assert [p["content"] for p in family.list_postits()] == ["yo"]
+    assert family.delete_postit("p1")
+    assert not family.delete_postit("p1")